@@ -0,0 +1,3 @@
+# SPDX-FileCopyrightText: 2023-present Amazon.com, Inc. or its affiliates
+#
+# SPDX-License-Identifier: Apache-2.0
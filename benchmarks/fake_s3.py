@@ -0,0 +1,343 @@
+# SPDX-FileCopyrightText: 2023-present Amazon.com, Inc. or its affiliates
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import datetime
+import hashlib
+import re
+import shutil
+import threading
+import time
+import uuid
+from collections import Counter
+from io import BytesIO
+from botocore.exceptions import ClientError
+
+
+class FakeEvents:
+    """Accepts the event handlers registered on a boto3 client and ignores them"""
+
+    def register(self, *args, **kwargs):
+        pass
+
+    def register_first(self, *args, **kwargs):
+        pass
+
+
+class FakeMeta:
+    def __init__(self):
+        self.events = FakeEvents()
+
+
+class FakeS3:
+    """In-process stand-in for the boto3 S3 client, for benchmarks.
+
+    Objects are kept in memory. Only the operations and parameters used by
+    git-remote-s3 are implemented. Every call is counted by operation and can
+    be delayed by a fixed latency to simulate the round trip to S3.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.objects = {}
+        self.uploads = {}
+        self.calls = Counter()
+        self.bytes = Counter()
+        self.meta = FakeMeta()
+        # Reentrant, conditional writes check and write under the same lock
+        self._lock = threading.RLock()
+
+    def _call(self, operation: str) -> None:
+        with self._lock:
+            self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _get(self, bucket: str, key: str, operation: str) -> dict:
+        with self._lock:
+            obj = self.objects.get((bucket, key))
+        if obj is None:
+            code = "404" if operation == "HeadObject" else "NoSuchKey"
+            raise ClientError(
+                {
+                    "Error": {"Code": code, "Message": "Not Found"},
+                    "ResponseMetadata": {"HTTPStatusCode": 404},
+                },
+                operation,
+            )
+        return obj
+
+    def _put(
+        self, bucket: str, key: str, data: bytes, uploaded: bool = True, **extra_args
+    ) -> dict:
+        obj = {
+            "Body": data,
+            "ETag": f'"{hashlib.md5(data).hexdigest()}"',
+            "LastModified": datetime.datetime.now(datetime.timezone.utc),
+            "Metadata": dict(extra_args.get("Metadata", {})),
+        }
+        with self._lock:
+            self.objects[(bucket, key)] = obj
+            if uploaded:
+                self.bytes["uploaded"] += len(data)
+        return obj
+
+    @staticmethod
+    def _read(body) -> bytes:
+        if isinstance(body, (bytes, bytearray)):
+            return bytes(body)
+        if isinstance(body, str):
+            return body.encode("utf8")
+        return body.read()
+
+    def put_object(
+        self, *, Bucket, Key, Body=b"", IfMatch=None, IfNoneMatch=None, **extra_args
+    ):
+        self._call("PutObject")
+        data = self._read(Body)
+        with self._lock:
+            current = self.objects.get((Bucket, Key))
+            if IfMatch is not None and current is None:
+                self._get(Bucket, Key, "PutObject")
+            if (IfNoneMatch == "*" and current is not None) or (
+                IfMatch is not None and IfMatch != current["ETag"]
+            ):
+                raise ClientError(
+                    {
+                        "Error": {"Code": "PreconditionFailed", "Message": "Changed"},
+                        "ResponseMetadata": {"HTTPStatusCode": 412},
+                    },
+                    "PutObject",
+                )
+            obj = self._put(Bucket, Key, data, **extra_args)
+        return {"ETag": obj["ETag"]}
+
+    def get_object(self, *, Bucket, Key, Range=None, IfMatch=None, **kwargs):
+        self._call("GetObject")
+        obj = self._get(Bucket, Key, "GetObject")
+        if IfMatch is not None and IfMatch != obj["ETag"]:
+            raise ClientError(
+                {
+                    "Error": {"Code": "PreconditionFailed", "Message": "Changed"},
+                    "ResponseMetadata": {"HTTPStatusCode": 412},
+                },
+                "GetObject",
+            )
+        data = obj["Body"]
+        res = {}
+        if Range:
+            start, end = re.match(r"bytes=(\d+)-(\d*)", Range).groups()
+            if int(start) >= len(data):
+                raise ClientError(
+                    {
+                        "Error": {"Code": "InvalidRange", "Message": "Invalid"},
+                        "ResponseMetadata": {"HTTPStatusCode": 416},
+                    },
+                    "GetObject",
+                )
+            data = data[int(start) : int(end) + 1 if end else None]
+            last = int(start) + len(data) - 1
+            res["ContentRange"] = f"bytes {start}-{last}/{len(obj['Body'])}"
+        with self._lock:
+            self.bytes["downloaded"] += len(data)
+        return res | {
+            "Body": BytesIO(data),
+            "ContentLength": len(data),
+            "ETag": obj["ETag"],
+            "LastModified": obj["LastModified"],
+            "Metadata": dict(obj["Metadata"]),
+        }
+
+    def head_object(self, *, Bucket, Key, **kwargs):
+        self._call("HeadObject")
+        obj = self._get(Bucket, Key, "HeadObject")
+        return {
+            "ContentLength": len(obj["Body"]),
+            "ETag": obj["ETag"],
+            "LastModified": obj["LastModified"],
+            "Metadata": dict(obj["Metadata"]),
+        }
+
+    def delete_object(self, *, Bucket, Key, **kwargs):
+        self._call("DeleteObject")
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, *, Bucket, Delete, **kwargs):
+        self._call("DeleteObjects")
+        with self._lock:
+            for o in Delete["Objects"]:
+                self.objects.pop((Bucket, o["Key"]), None)
+        return {"Deleted": [{"Key": o["Key"]} for o in Delete["Objects"]]}
+
+    def list_objects_v2(
+        self,
+        *,
+        Bucket,
+        Prefix="",
+        Delimiter=None,
+        ContinuationToken=None,
+        StartAfter=None,
+        MaxKeys=1000,
+        **kwargs,
+    ):
+        self._call("ListObjectsV2")
+        with self._lock:
+            keys = sorted(
+                k for b, k in self.objects if b == Bucket and k.startswith(Prefix)
+            )
+        start_after = ContinuationToken or StartAfter
+        if start_after:
+            keys = [k for k in keys if k > start_after]
+        contents, prefixes = [], []
+        token = None
+        for key in keys:
+            if token is not None and key > token:
+                # One more key after a full page: the listing is truncated
+                break
+            if Delimiter and Delimiter in key[len(Prefix) :]:
+                common = key[: key.index(Delimiter, len(Prefix)) + len(Delimiter)]
+                if common in prefixes:
+                    continue
+                prefixes.append(common)
+                # The next page starts after all the keys of the prefix
+                last = common + "\U0010ffff"
+            else:
+                obj = self.objects[(Bucket, key)]
+                contents.append(
+                    {
+                        "Key": key,
+                        "Size": len(obj["Body"]),
+                        "ETag": obj["ETag"],
+                        "LastModified": obj["LastModified"],
+                    }
+                )
+                last = key
+            if len(contents) + len(prefixes) == MaxKeys:
+                token = last
+        res = {"KeyCount": len(contents) + len(prefixes), "IsTruncated": False}
+        if contents:
+            res["Contents"] = contents
+        if prefixes:
+            res["CommonPrefixes"] = [{"Prefix": p} for p in prefixes]
+        if token is not None and any(k > token for k in keys):
+            res["IsTruncated"] = True
+            res["NextContinuationToken"] = token
+        return res
+
+    def copy_object(self, *, CopySource, Bucket, Key, **extra_args):
+        self._call("CopyObject")
+        src = self._get(CopySource["Bucket"], CopySource["Key"], "CopyObject")
+        if extra_args.get("MetadataDirective") != "REPLACE":
+            extra_args["Metadata"] = src["Metadata"]
+        obj = self._put(Bucket, Key, src["Body"], uploaded=False, **extra_args)
+        return {"CopyObjectResult": {"ETag": obj["ETag"]}}
+
+    def copy(self, CopySource, Bucket, Key, ExtraArgs=None, **kwargs):
+        self.copy_object(CopySource=CopySource, Bucket=Bucket, Key=Key)
+
+    def create_multipart_upload(self, *, Bucket, Key, **extra_args):
+        self._call("CreateMultipartUpload")
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self.uploads[upload_id] = {"parts": {}, "extra_args": extra_args}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, *, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self._call("UploadPart")
+        data = self._read(Body)
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        with self._lock:
+            self.uploads[UploadId]["parts"][PartNumber] = (etag, data)
+            self.bytes["uploaded"] += len(data)
+        return {"ETag": etag}
+
+    def complete_multipart_upload(self, *, Bucket, Key, UploadId, MultipartUpload):
+        self._call("CompleteMultipartUpload")
+        with self._lock:
+            upload = self.uploads.pop(UploadId)
+        data = b"".join(
+            upload["parts"][p["PartNumber"]][1] for p in MultipartUpload["Parts"]
+        )
+        obj = self._put(Bucket, Key, data, uploaded=False, **upload["extra_args"])
+        return {"ETag": obj["ETag"]}
+
+    def abort_multipart_upload(self, *, Bucket, Key, UploadId):
+        self._call("AbortMultipartUpload")
+        with self._lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Callback=None, **_):
+        data = Fileobj.read()
+        self.put_object(Bucket=Bucket, Key=Key, Body=data, **(ExtraArgs or {}))
+        if Callback:
+            Callback(len(data))
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Callback=None, **_):
+        with open(Filename, "rb") as f:
+            self.upload_fileobj(f, Bucket, Key, ExtraArgs=ExtraArgs, Callback=Callback)
+
+    def download_fileobj(self, Bucket, Key, Fileobj, ExtraArgs=None, Callback=None, **_):
+        body = self.get_object(Bucket=Bucket, Key=Key)["Body"]
+        shutil.copyfileobj(body, Fileobj)
+        if Callback:
+            Callback(Fileobj.tell())
+
+    def download_file(self, Bucket, Key, Filename, ExtraArgs=None, Callback=None, **_):
+        with open(Filename, "wb") as f:
+            self.download_fileobj(Bucket, Key, f, ExtraArgs=ExtraArgs, Callback=Callback)
+
+
+class FakeObjectSummary:
+    def __init__(self, key: str, size: int):
+        self.key = key
+        self.size = size
+
+
+class FakeObjects:
+    def __init__(self, bucket: "FakeBucket"):
+        self.bucket = bucket
+
+    def filter(self, Prefix=""):
+        s3 = self.bucket.client
+        kwargs = {"Bucket": self.bucket.name, "Prefix": Prefix}
+        while True:
+            res = s3.list_objects_v2(**kwargs)
+            for o in res.get("Contents", []):
+                yield FakeObjectSummary(o["Key"], o["Size"])
+            if not res.get("IsTruncated"):
+                return
+            kwargs["ContinuationToken"] = res["NextContinuationToken"]
+
+
+class FakeBucketMeta:
+    def __init__(self, client: FakeS3):
+        self.client = client
+
+
+class FakeBucket:
+    """Stand-in for the boto3 Bucket resource, backed by a FakeS3 client"""
+
+    def __init__(self, client: FakeS3, name: str):
+        self.client = client
+        self.name = name
+        self.meta = FakeBucketMeta(client)
+        self.objects = FakeObjects(self)
+
+    def upload_file(self, Filename, Key, ExtraArgs=None, Callback=None, Config=None):
+        self.client.upload_file(
+            Filename, self.name, Key, ExtraArgs=ExtraArgs, Callback=Callback
+        )
+
+    def download_file(self, Key, Filename, ExtraArgs=None, Callback=None, Config=None):
+        self.client.download_file(
+            self.name, Key, Filename, ExtraArgs=ExtraArgs, Callback=Callback
+        )
+
+    def download_fileobj(self, Key, Fileobj, ExtraArgs=None, Callback=None, Config=None):
+        body = self.client.get_object(Bucket=self.name, Key=Key)["Body"].read()
+        Fileobj.write(body)
+        if Callback:
+            Callback(len(body))
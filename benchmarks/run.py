@@ -0,0 +1,378 @@
+# SPDX-FileCopyrightText: 2023-present Amazon.com, Inc. or its affiliates
+#
+# SPDX-License-Identifier: Apache-2.0
+
+"""Benchmarks of git-remote-s3 against an in-process S3 stand-in.
+
+Synthetic repos are pushed, listed, fetched and checked with `git-s3 doctor`
+through the real S3Remote, Doctor and LFSProcess entry points, and the
+results are written as JSON so that two runs can be compared:
+
+    python -m benchmarks.run --refs 50 --depth 200 --output new.json
+    python -m benchmarks.run --compare old.json --output new.json
+"""
+
+import argparse
+import datetime
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from contextlib import contextmanager, redirect_stdout
+from .fake_s3 import FakeS3, FakeBucket
+
+BUCKET = "bench-bucket"
+PREFIX = "bench-repo"
+RESULTS_VERSION = 1
+SCENARIOS = ["push", "list", "fetch", "doctor", "lfs_upload", "lfs_download"]
+
+
+@contextmanager
+def working_directory(path: str):
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def git(*args: str, cwd: str, input: bytes = None) -> str:
+    return subprocess.run(
+        ["git", *args],
+        cwd=cwd,
+        input=input,
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout.decode("utf8")
+
+
+def make_repo(path: str, *, refs: int, depth: int, commit_size: int, seed: int):
+    """Creates a repo with a linear history and refs spread along it
+
+    Every commit adds a blob of commit_size random bytes, so that the size of
+    the bundles grows with the depth of the history. The refs are main plus
+    branches and tags pointing to commits evenly spaced in the history.
+
+    Args:
+        path (str): the folder of the repo
+        refs (int): the number of refs
+        depth (int): the number of commits of main
+        commit_size (int): the size of the blob added by every commit
+        seed (int): the seed of the random content
+    """
+    git("init", "-q", "-b", "main", path, cwd=os.path.dirname(path))
+    rnd = random.Random(seed)
+    stream = io.BytesIO()
+    for i in range(depth):
+        data = rnd.randbytes(commit_size)
+        message = f"commit {i}".encode("utf8")
+        stream.write(b"blob\nmark :%d\ndata %d\n%b\n" % (2 * i + 1, len(data), data))
+        stream.write(b"commit refs/heads/main\nmark :%d\n" % (2 * i + 2))
+        stream.write(b"committer Bench <bench@example.com> %d +0000\n" % (1.7e9 + i))
+        stream.write(b"data %d\n%b\n" % (len(message), message))
+        if i > 0:
+            stream.write(b"from :%d\n" % (2 * i))
+        stream.write(b"M 100644 :%d file-%d.bin\n\n" % (2 * i + 1, i % 16))
+    for j in range(1, refs):
+        ref = f"refs/heads/branch-{j}" if j % 2 else f"refs/tags/v{j}"
+        commit = depth - 1 - (j * depth) // refs
+        stream.write(b"reset %b\nfrom :%d\n\n" % (ref.encode("utf8"), 2 * commit + 2))
+    git("fast-import", "--quiet", cwd=path, input=stream.getvalue())
+
+
+def list_local_refs(path: str) -> list[tuple[str, str]]:
+    output = git("for-each-ref", "--format=%(objectname) %(refname)", cwd=path)
+    return [tuple(line.split(" ")) for line in output.splitlines()]
+
+
+def make_lfs_objects(path: str, *, count: int, size: int, seed: int) -> list[dict]:
+    """Creates random LFS objects, as the upload events of git-lfs"""
+    os.makedirs(path, exist_ok=True)
+    rnd = random.Random(seed)
+    events = []
+    for _ in range(count):
+        data = rnd.randbytes(size)
+        oid = hashlib.sha256(data).hexdigest()
+        with open(os.path.join(path, oid), "wb") as f:
+            f.write(data)
+        events.append(
+            {
+                "event": "upload",
+                "oid": oid,
+                "size": size,
+                "path": os.path.join(path, oid),
+            }
+        )
+    return events
+
+
+def create_remote(s3: FakeS3):
+    from git_remote_s3 import S3Remote, UriScheme
+
+    remote = S3Remote(UriScheme.S3, None, BUCKET, PREFIX)
+    remote._s3 = s3
+    return remote
+
+
+def run_remote(s3: FakeS3, cmds: list[str]) -> None:
+    """Runs protocol commands through a new S3Remote, as a git process would"""
+    remote = create_remote(s3)
+    with redirect_stdout(io.StringIO()):
+        for cmd in cmds:
+            remote.process_cmd(cmd)
+
+
+def bench_push(s3: FakeS3, repo: str, refs: list[tuple[str, str]]) -> None:
+    with working_directory(repo):
+        run_remote(
+            s3, ["list for-push\n"] + [f"push {r}:{r}\n" for _, r in refs] + ["\n"]
+        )
+
+
+def bench_list(s3: FakeS3, repo: str, refs: list[tuple[str, str]]) -> None:
+    with working_directory(repo):
+        run_remote(s3, ["list\n"])
+
+
+def bench_fetch(s3: FakeS3, clone: str, refs: list[tuple[str, str]]) -> None:
+    with working_directory(clone):
+        run_remote(s3, ["list\n"] + [f"fetch {s} {r}\n" for s, r in refs] + ["\n"])
+
+
+def bench_doctor(s3: FakeS3, repo: str) -> None:
+    from git_remote_s3 import Doctor
+
+    doctor = Doctor(None, BUCKET, PREFIX, False)
+    doctor.s3 = s3
+    with working_directory(repo), redirect_stdout(io.StringIO()):
+        doctor.run()
+
+
+def create_lfs_process(s3: FakeS3):
+    from git_remote_s3.lfs import LFSProcess
+
+    with redirect_stdout(io.StringIO()):
+        process = LFSProcess(f"s3://{BUCKET}/{PREFIX}")
+    process.s3_bucket = FakeBucket(s3, BUCKET)
+    return process
+
+
+def bench_lfs(s3: FakeS3, clone: str, events: list[dict], direction: str) -> None:
+    with working_directory(clone), redirect_stdout(io.StringIO()):
+        process = create_lfs_process(s3)
+        for event in events:
+            process.run({**event, "event": direction})
+        process.close()
+
+
+def measure(s3: FakeS3, func, *args) -> dict:
+    calls, transferred = Counter(s3.calls), Counter(s3.bytes)
+    start = time.perf_counter()
+    func(s3, *args)
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": seconds,
+        "requests": dict(s3.calls - calls),
+        "bytes": dict(s3.bytes - transferred),
+    }
+
+
+def summarize(runs: list[dict], lfs_bytes: int = 0) -> dict:
+    seconds = [r["seconds"] for r in runs]
+    summary = {
+        "seconds": seconds,
+        "median": statistics.median(seconds),
+        "min": min(seconds),
+        # The requests of a scenario do not depend on the run
+        "requests": runs[-1]["requests"],
+        "bytes": runs[-1]["bytes"],
+    }
+    if lfs_bytes:
+        summary["throughput_mb_s"] = lfs_bytes / summary["median"] / 1024**2
+    return summary
+
+
+def run_benchmarks(
+    *,
+    refs: int = 10,
+    depth: int = 50,
+    commit_size: int = 16 * 1024,
+    lfs_objects: int = 20,
+    lfs_size: int = 1024 * 1024,
+    repeat: int = 3,
+    latency: float = 0.0,
+    seed: int = 0,
+    scenarios: list[str] = SCENARIOS,
+) -> dict:
+    """Runs the benchmarks and returns the results
+
+    Args:
+        refs (int): the number of refs of the synthetic repo
+        depth (int): the number of commits of its main branch
+        commit_size (int): the bytes added by every commit
+        lfs_objects (int): the number of LFS objects
+        lfs_size (int): the size of every LFS object
+        repeat (int): the number of runs of every scenario
+        latency (float): the simulated latency of every S3 request, in seconds
+        seed (int): the seed of the random content
+        scenarios (list[str]): the scenarios to run
+
+    Returns:
+        dict: the results, see README.md
+    """
+    parameters = {
+        "refs": refs,
+        "depth": depth,
+        "commit_size": commit_size,
+        "lfs_objects": lfs_objects,
+        "lfs_size": lfs_size,
+        "repeat": repeat,
+        "latency": latency,
+        "seed": seed,
+    }
+    runs = {s: [] for s in scenarios}
+    work_dir = tempfile.mkdtemp(prefix="git_remote_s3_bench_")
+    # Isolate the benchmarks from the git config of the user, eg s3.cache
+    env = {
+        k: os.environ.get(k)
+        for k in ["GIT_CONFIG_GLOBAL", "GIT_CONFIG_NOSYSTEM", "XDG_CACHE_HOME"]
+    }
+    os.environ["GIT_CONFIG_GLOBAL"] = os.devnull
+    os.environ["GIT_CONFIG_NOSYSTEM"] = "1"
+    os.environ["XDG_CACHE_HOME"] = os.path.join(work_dir, "cache")
+    try:
+        repo = os.path.join(work_dir, "repo")
+        make_repo(repo, refs=refs, depth=depth, commit_size=commit_size, seed=seed)
+        local_refs = list_local_refs(repo)
+        events = make_lfs_objects(
+            os.path.join(work_dir, "lfs"), count=lfs_objects, size=lfs_size, seed=seed
+        )
+
+        for i in range(repeat):
+            s3 = FakeS3(latency=latency)
+            clone = os.path.join(work_dir, f"clone-{i}")
+            git("init", "-q", clone, cwd=work_dir)
+            os.makedirs(os.path.join(clone, ".git", "lfs", "tmp"))
+            # Push first, the other scenarios read what it wrote
+            push = measure(s3, bench_push, repo, local_refs)
+            if "push" in runs:
+                runs["push"].append(push)
+            if "list" in runs:
+                runs["list"].append(measure(s3, bench_list, repo, local_refs))
+            if "fetch" in runs:
+                runs["fetch"].append(measure(s3, bench_fetch, clone, local_refs))
+            if "doctor" in runs:
+                runs["doctor"].append(measure(s3, bench_doctor, repo))
+            if "lfs_upload" in runs or "lfs_download" in runs:
+                upload = measure(s3, bench_lfs, clone, events, "upload")
+                if "lfs_upload" in runs:
+                    runs["lfs_upload"].append(upload)
+            if "lfs_download" in runs:
+                runs["lfs_download"].append(
+                    measure(s3, bench_lfs, clone, events, "download")
+                )
+            shutil.rmtree(clone)
+    finally:
+        for k, v in env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    lfs_bytes = lfs_objects * lfs_size
+    return {
+        "version": RESULTS_VERSION,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "git": git("--version", cwd=".").strip(),
+        },
+        "parameters": parameters,
+        "results": {
+            s: summarize(r, lfs_bytes if s.startswith("lfs") else 0)
+            for s, r in runs.items()
+        },
+    }
+
+
+def compare(baseline: dict, results: dict) -> dict:
+    """Computes the ratio of the median times of two runs, per scenario"""
+    return {
+        s: results["results"][s]["median"] / baseline["results"][s]["median"]
+        for s in results["results"]
+        if s in baseline["results"] and baseline["results"][s]["median"] > 0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--refs", type=int, default=10)
+    parser.add_argument("--depth", type=int, default=50)
+    parser.add_argument("--commit-size", type=int, default=16 * 1024)
+    parser.add_argument("--lfs-objects", type=int, default=20)
+    parser.add_argument("--lfs-size", type=int, default=1024 * 1024)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="latency of S3 requests in ms"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--scenario", action="append", choices=SCENARIOS, help="default: all"
+    )
+    parser.add_argument("--output", help="the JSON file to write the results to")
+    parser.add_argument("--compare", help="the JSON results of a previous run")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=None,
+        help="fail if a scenario is slower than the compared run by this ratio",
+    )
+    args = parser.parse_args()
+
+    results = run_benchmarks(
+        refs=args.refs,
+        depth=args.depth,
+        commit_size=args.commit_size,
+        lfs_objects=args.lfs_objects,
+        lfs_size=args.lfs_size,
+        repeat=args.repeat,
+        latency=args.latency / 1000,
+        seed=args.seed,
+        scenarios=args.scenario or SCENARIOS,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+    ratios = {}
+    if args.compare:
+        with open(args.compare) as f:
+            ratios = compare(json.load(f), results)
+    for scenario, result in results["results"].items():
+        line = f"{scenario:<14} {result['median'] * 1000:10.1f} ms"
+        line += f" {sum(result['requests'].values()):6d} requests"
+        if "throughput_mb_s" in result:
+            line += f" {result['throughput_mb_s']:8.1f} MB/s"
+        if scenario in ratios:
+            line += f"  x{ratios[scenario]:.2f}"
+        print(line)
+
+    if args.max_regression and any(r > args.max_regression for r in ratios.values()):
+        sys.stderr.write(f"regression above x{args.max_regression}\n")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
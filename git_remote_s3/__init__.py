@@ -1,11 +1,17 @@
 # SPDX-FileCopyrightText: 2023-present Amazon.com, Inc. or its affiliates
 #
 # SPDX-License-Identifier: Apache-2.0
-from .remote import S3Remote
-from . import git
-from .common import parse_git_url
-from .manage import Doctor
-from .enums import UriScheme
+import importlib
+
+# Git starts the remote helper for every fetch and push: the exports are imported
+# on first access, so that the helper does not load boto3 before it needs it
+_exports = {
+    "S3Remote": ".remote",
+    "git": ".git",
+    "parse_git_url": ".common",
+    "Doctor": ".manage",
+    "UriScheme": ".enums",
+}
 
 __all__ = [
     "S3Remote",
@@ -14,3 +20,10 @@ __all__ = [
     "Doctor",
     "UriScheme"
 ]
+
+
+def __getattr__(name: str):
+    if name not in _exports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(_exports[name], __name__)
+    return module if name == "git" else getattr(module, name)
@@ -0,0 +1,251 @@
+# SPDX-FileCopyrightText: 2023-present Amazon.com, Inc. or its affiliates
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 2 * 1024**3
+HASH_CHUNK_SIZE = 1024 * 1024
+# Eviction brings the cache down to this fraction of its size limit, so that
+# the next entries do not walk the cache again
+EVICT_TARGET = 0.9
+
+
+def default_cache_dir(name: str) -> str:
+    """Gets the default location of a cache, following the XDG convention
+
+    Args:
+        name (str): the name of the cache
+
+    Returns:
+        str: the cache folder
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "git-remote-s3", name)
+
+
+class ObjectCache:
+    """Machine-wide on-disk cache of S3 objects, shared by all git processes.
+
+    Entries are keyed by bucket, object key and ETag of the object, so a bundle
+    rewritten in place is never served stale. Every
+    file is written to a temporary name and renamed into place, so concurrent
+    processes only ever see complete entries. When the cache grows beyond its
+    size limit, the least recently used entries are evicted.
+
+    The size of the cache is computed once per process, on the first entry
+    added, and kept up to date with the entries added since. The cache is only
+    walked again when this total goes over the limit.
+    """
+
+    def __init__(self, folder: str, max_size: int = DEFAULT_CACHE_SIZE):
+        self.folder = folder
+        self.max_size = max_size
+        self._size = None
+        self._size_lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, bucket: str, key: str, etag: str) -> str:
+        digest = hashlib.sha256(f"{bucket}/{key}:{etag}".encode("utf8")).hexdigest()
+        return os.path.join(self.folder, digest[:2], digest)
+
+    def get(self, *, bucket: str, key: str, etag: str, path: str) -> dict:
+        """Copies a cached object to path if its ETag matches
+
+        Args:
+            bucket (str): the bucket of the object
+            key (str): the key of the object
+            etag (str): the current ETag of the object
+            path (str): the destination file
+
+        Returns:
+            dict: the user metadata of the object or None on a cache miss
+        """
+        entry = self._path(bucket, key, etag)
+        try:
+            with open(f"{entry}.json") as f:
+                meta = json.load(f)
+            if os.path.getsize(entry) != meta["size"]:
+                return None
+            _link_or_copy(entry, path)
+            # The modification time orders the entries for eviction
+            os.utime(entry)
+        except (OSError, ValueError, KeyError):
+            # Missing, being evicted or corrupted: a miss either way
+            return None
+        logger.info(f"cache hit {key}")
+        return meta["metadata"]
+
+    def put(
+        self, *, bucket: str, key: str, etag: str, path: str, metadata: dict
+    ) -> None:
+        """Adds a downloaded object to the cache
+
+        Args:
+            bucket (str): the bucket of the object
+            key (str): the key of the object
+            etag (str): the ETag of the object
+            path (str): the downloaded file
+            metadata (dict): the user metadata of the object
+        """
+        entry = self._path(bucket, key, etag)
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            size = os.path.getsize(path)
+            _atomic_link_or_copy(path, entry)
+            _atomic_write(
+                f"{entry}.json",
+                json.dumps({"key": key, "size": size, "metadata": metadata}),
+            )
+            self.added(size)
+        except OSError as e:
+            # The cache is an optimisation, a full disk must not fail the fetch
+            logger.info(f"cannot cache {key}: {e}")
+
+    def added(self, size: int) -> None:
+        """Counts an entry added to the cache, evicting entries over the limit
+
+        Args:
+            size (int): the size of the entry
+        """
+        with self._size_lock:
+            if self._size is None:
+                # The walk includes the entry just added
+                self._size = sum(size for _, size, _ in self.entries())
+            else:
+                self._size += size
+            if self._size > self.max_size:
+                self._size = self.evict()
+
+    def entries(self) -> list[tuple]:
+        """Lists the entries of the cache
+
+        Returns:
+            list[tuple]: the modification time, size and path of the entries
+        """
+        entries = []
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                if name.endswith(".json") or name.startswith("."):
+                    continue
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, os.path.join(root, name)))
+        return entries
+
+    def evict(self) -> int:
+        """Removes the least recently used entries beyond the size limit
+
+        Returns:
+            int: the size of the cache after the eviction
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_size:
+            return total
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size * EVICT_TARGET:
+                break
+            for path in [f"{entry}.json", entry]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+        return total
+
+
+class LFSCache(ObjectCache):
+    """Machine-wide on-disk cache of LFS objects, shared by all clones.
+
+    LFS objects are content addressed, so entries are keyed by oid alone and
+    never go stale. An object only enters the cache once the sha256 of its
+    content has been checked against its oid.
+    """
+
+    def _oid_path(self, oid: str) -> str:
+        return os.path.join(self.folder, oid[:2], oid)
+
+    def get_object(self, *, oid: str, path: str) -> bool:
+        """Copies a cached LFS object to path
+
+        Args:
+            oid (str): the oid of the object
+            path (str): the destination file
+
+        Returns:
+            bool: true on a cache hit
+        """
+        entry = self._oid_path(oid)
+        try:
+            _link_or_copy(entry, path)
+            os.utime(entry)
+        except OSError:
+            return False
+        logger.info(f"cache hit {oid}")
+        return True
+
+    def put_object(self, *, oid: str, path: str, verified: bool = False) -> None:
+        """Adds an uploaded or downloaded LFS object to the cache
+
+        Args:
+            oid (str): the oid of the object
+            path (str): the file holding the object
+            verified (bool): true if the sha256 of the file was already
+                checked against the oid
+        """
+        entry = self._oid_path(oid)
+        try:
+            if os.path.exists(entry):
+                return
+            if not verified and file_sha256(path) != oid:
+                logger.info(f"not caching {oid}: the content does not match")
+                return
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            size = os.path.getsize(path)
+            _atomic_link_or_copy(path, entry)
+            self.added(size)
+        except OSError as e:
+            logger.info(f"cannot cache {oid}: {e}")
+
+
+def file_sha256(path: str) -> str:
+    """Computes the sha256 of a file, reading it in chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _atomic_link_or_copy(src: str, dst: str) -> None:
+    tmp = os.path.join(os.path.dirname(dst), f".{uuid.uuid4().hex}")
+    _link_or_copy(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _atomic_write(dst: str, content: str) -> None:
+    fd, tmp = tempfile.mkstemp(prefix=".", dir=os.path.dirname(dst))
+    with os.fdopen(fd, "w") as f:
+        f.write(content)
+    os.replace(tmp, dst)
@@ -19,7 +19,7 @@ def parse_git_url(url: str) -> tuple[UriScheme, str, str, str]:
     """
     if url is None:
         return None, None, None, None
-    m = re.match(r"(s3|s3\+zip)://([^@]+@)?([a-z0-9][a-z0-9\.-]{2,62})/?(.+)?", url)
+    m = re.match(r"(s3|s3\+zip|s3\+pack)://([^@]+@)?([a-z0-9][a-z0-9\.-]{2,62})/?(.+)?", url)
     if m is None or len(m.groups()) != 4:
         return None, None, None, None
     uri_scheme, profile, bucket, prefix = m.groups()
@@ -32,5 +32,24 @@ def parse_git_url(url: str) -> tuple[UriScheme, str, str, str]:
             uri_scheme = UriScheme.S3
         if uri_scheme == "s3+zip":
             uri_scheme = UriScheme.S3_ZIP
+        if uri_scheme == "s3+pack":
+            uri_scheme = UriScheme.S3_PACK
 
     return uri_scheme, profile, bucket, prefix
+
+
+def lfs_key(prefix: str, oid: str, sharded: bool = False) -> str:
+    """Gets the key of an LFS object
+
+    Args:
+        prefix (str): the prefix of the repo
+        oid (str): the oid of the object
+        sharded (bool): true for the sharded layout, which spreads the objects
+            over prefixes derived from their oid, eg lfs/ab/cd/abcd...
+
+    Returns:
+        str: the key of the object
+    """
+    if sharded:
+        return f"{prefix}/lfs/{oid[:2]}/{oid[2:4]}/{oid}"
+    return f"{prefix}/lfs/{oid}"
@@ -2,65 +2,102 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+import functools
 import subprocess
 import sys
 import re
+import threading
+from contextlib import contextmanager
+from .metrics import metrics
 
 
 class GitError(Exception):
     pass
 
 
-def archive(*, folder: str, ref: str) -> str:
-    """Archive the content of the folder into a repo.zip file
+def _timed(name: str):
+    """Records the duration of the git command run by the decorated function"""
 
-    Args:
-        folder (str): the folder to archive
-        ref (str): the ref to archive
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.timer("git", name):
+                return func(*args, **kwargs)
 
-    Returns:
-        str: the path to the archive file
-    """
+        return wrapper
 
-    file_path = f"{folder}/repo.zip"
-    result = subprocess.run(
-        ["git", "archive", "--format", "zip", "--output", file_path, ref],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        check=True,
-    )
+    return decorator
 
-    if result.returncode == 0:
-        return file_path
-    else:
-        raise GitError(result.stderr.decode("utf8"))
 
+class ProcessOutput:
+    """Read-only file object over the stdout of a git process
+
+    Reaching the end of the output waits for the process to exit and raises a
+    GitError if it failed, so that a truncated output is never mistaken for a
+    complete one.
+    """
 
-def bundle(*, folder: str, sha: str, ref: str) -> str:
-    """Bundles the content of the folder into a sha.bundle file
+    def __init__(self, process: subprocess.Popen):
+        self.process = process
+        self.stderr = b""
+        self._stderr_reader = threading.Thread(target=self._read_stderr, daemon=True)
+        self._stderr_reader.start()
+
+    def _read_stderr(self):
+        # Drained in the background so that git never blocks on a full pipe
+        self.stderr = self.process.stderr.read()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.process.stdout.read(size)
+        if size < 0 or len(data) < size:
+            self.process.wait()
+            self._stderr_reader.join()
+            if self.process.returncode != 0:
+                raise GitError(self.stderr.decode("utf8"))
+        return data
+
+
+@contextmanager
+def _stream(args: list[str]):
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        with metrics.timer("git", args[1]):
+            yield ProcessOutput(process)
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        process.stdout.close()
+
+
+def bundle_stream(*, ref: str, exclude: list[str] = None):
+    """Streams a bundle of the ref, without writing it to disk
 
     Args:
-        folder (str): the folder to bundle
-        sha (str): the sha of the bundle. A bundle is stored as sha.bundle
         ref (str): the ref to bundle
+        exclude (list[str]): shas whose history is left out of the bundle
 
     Returns:
-        str: the path to the bundle file
+        a context manager yielding a ProcessOutput with the bundle content
     """
-    file_path = f"{folder}/{sha}.bundle"
-    result = subprocess.run(
-        ["git", "bundle", "create", file_path, ref],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        check=True,
+    return _stream(
+        ["git", "bundle", "create", "-", ref] + [f"^{e}" for e in exclude or []]
     )
 
-    if result.returncode == 0:
-        return file_path
-    else:
-        raise GitError(result.stderr.decode("utf8"))
+
+def archive_stream(*, ref: str):
+    """Streams a zip archive of the ref, without writing it to disk
+
+    Args:
+        ref (str): the ref to archive
+
+    Returns:
+        a context manager yielding a ProcessOutput with the zip content
+    """
+    return _stream(["git", "archive", "--format", "zip", ref])
 
 
+@_timed("unbundle")
 def unbundle(*, folder: str, sha: str, ref: str):
     """Unbundles the content of the bundle referred by the sha
 
@@ -76,6 +113,7 @@ def unbundle(*, folder: str, sha: str, ref: str):
     )
 
 
+@_timed("rev-parse")
 def rev_parse(ref: str) -> str:
     """Gets the sha of a ref
 
@@ -96,6 +134,124 @@ def rev_parse(ref: str) -> str:
     return sha
 
 
+@_timed("cat-file")
+def object_exists(sha: str) -> bool:
+    """Checks if a commit exists in the local object store
+
+    Args:
+        sha (str): the sha of the commit
+
+    Returns:
+        bool: true if the commit exists locally
+    """
+    result = subprocess.run(
+        ["git", "cat-file", "-e", f"{sha}^{{commit}}"],
+        stderr=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+    )
+    return result.returncode == 0
+
+
+@_timed("cat-file")
+def missing_objects(shas: list[str]) -> list[str]:
+    """Finds the objects missing from the local object store, in a single call
+
+    Args:
+        shas (list[str]): the shas to check
+
+    Returns:
+        list[str]: the shas that are not present locally
+    """
+    result = subprocess.run(
+        ["git", "cat-file", "--batch-check"],
+        input="".join(f"{sha}\n" for sha in shas).encode("utf8"),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    if result.returncode != 0:
+        return list(shas)
+    return [
+        line.split(" ")[0]
+        for line in result.stdout.decode("utf8").splitlines()
+        if line.endswith(" missing")
+    ]
+
+
+@_timed("pack-objects")
+def pack_objects(*, folder: str, tips: list[str], exclude: list[str] = None) -> str:
+    """Packs the history of the tips into a pack and its index
+
+    Args:
+        folder (str): the folder where the pack is written
+        tips (list[str]): the shas whose history is packed
+        exclude (list[str]): shas whose history is left out of the pack. They
+            must be present locally
+
+    Returns:
+        str: the name of the pack, stored as <name>.pack and <name>.idx
+    """
+    result = subprocess.run(
+        ["git", "pack-objects", "--revs", "--quiet", f"{folder}/pack"],
+        input="".join(
+            [f"{sha}\n" for sha in tips] + [f"^{sha}\n" for sha in exclude or []]
+        ).encode("utf8"),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if result.returncode != 0:
+        raise GitError(result.stderr.decode("utf8"))
+    return f"pack-{result.stdout.decode('utf8').strip()}"
+
+
+def pack_object_count(path: str) -> int:
+    """Reads the number of objects of a pack from its header"""
+    with open(path, "rb") as f:
+        header = f.read(12)
+    return int.from_bytes(header[8:12], "big")
+
+
+def index_pack(path: str) -> str:
+    """Checks a pack and writes its index next to it
+
+    Args:
+        path (str): the pack, as <name>.pack
+
+    Raises:
+        GitError: if the pack is truncated or corrupted
+
+    Returns:
+        str: the checksum of the pack
+    """
+    result = subprocess.run(
+        ["git", "index-pack", path], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    if result.returncode != 0:
+        raise GitError(result.stderr.decode("utf8"))
+    return result.stdout.decode("utf8").strip()
+
+
+@_timed("rev-parse")
+def pack_dir() -> str:
+    """Gets the folder holding the packs of the local repo"""
+    result = subprocess.run(
+        ["git", "rev-parse", "--git-path", "objects/pack"], stdout=subprocess.PIPE
+    )
+    if result.returncode != 0:
+        raise GitError("fatal: not a git repository")
+    return result.stdout.decode("utf8").strip()
+
+
+def lfs_objects_dir() -> str:
+    """Gets the folder holding the LFS objects of the local repo"""
+    result = subprocess.run(
+        ["git", "rev-parse", "--git-path", "lfs/objects"], stdout=subprocess.PIPE
+    )
+    if result.returncode != 0:
+        raise GitError("fatal: not a git repository")
+    return result.stdout.decode("utf8").strip()
+
+
+@_timed("merge-base")
 def is_ancestor(ancestor: str, descendant: str) -> bool:
     """Checks if the ancestor is an ancestor of the descendant
 
@@ -114,6 +270,7 @@ def is_ancestor(ancestor: str, descendant: str) -> bool:
     return result.returncode == 0
 
 
+@_timed("remote")
 def get_remote_url(remote: str) -> str:
     result = subprocess.run(
         ["git", "remote", "get-url", remote], stdout=subprocess.PIPE
@@ -136,6 +293,7 @@ def validate_ref_name(name: str) -> bool:
     )
 
 
+@_timed("log")
 def get_last_commit_message() -> str:
     result = subprocess.run(
         ["git", "log", "-1", "--pretty=%h %s"], stdout=subprocess.PIPE
@@ -3,14 +3,25 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import sys
+import hashlib
 import logging
 import json
+import queue
 import subprocess
 import boto3
+import botocore.config
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
 import threading
+import time
 import os
-from .common import parse_git_url
+import uuid
+from .cache import LFSCache, default_cache_dir, DEFAULT_CACHE_SIZE
+from .common import lfs_key, parse_git_url
 from .git import validate_ref_name
+from .lfspack import PackIndex, pack_key, DEFAULT_PACK_READAHEAD
+from .metrics import metrics
+from .settings import Settings
 
 if "lfs" in __name__:
     logging.basicConfig(
@@ -21,114 +32,647 @@ if "lfs" in __name__:
 
 logger = logging.getLogger(__name__)
 
+# Progress is reported at most every interval (in milliseconds) or bytes
+DEFAULT_PROGRESS_INTERVAL = 100
+DEFAULT_PROGRESS_BYTES = 8 * 1024 * 1024
+# The defaults of boto3
+DEFAULT_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+DEFAULT_MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_MAX_CONCURRENCY = 10
+# A download whose content does not match its oid is attempted again
+DOWNLOAD_ATTEMPTS = 2
+# Beyond this many pages of 1000 objects, existence is checked object by object
+MAX_INDEX_PAGES = 100
+# The packed objects read ahead of their download, shared by the processes
+READAHEAD_DIR = ".git/lfs/tmp/git-lfs-s3-readahead"
+# Objects read ahead by processes that did not terminate are removed after this
+# many seconds
+READAHEAD_MAX_AGE = 3600
+
+
+class EventWriter:
+    """Writes the events of the transfer protocol to stdout, from any thread.
+
+    Events are queued and written by a single thread, one JSON document per
+    line and in the order they were queued, so that the progress events
+    reported by the transfer threads of boto3 are never interleaved. The
+    output is flushed whenever the queue is drained.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, event: dict) -> None:
+        self._queue.put(event)
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            if event is None:
+                self.stream.flush()
+                return
+            self.stream.write(f"{json.dumps(event)}\n")
+            if self._queue.empty():
+                self.stream.flush()
+
+    def close(self) -> None:
+        """Writes the queued events and stops the writer"""
+        self._queue.put(None)
+        self._thread.join()
+
 
 class ProgressPercentage:
-    def __init__(self, oid: str):
+    """Reports the progress of a transfer to git-lfs.
+
+    boto3 calls it from its transfer threads for every chunk transferred. The
+    bytes are aggregated and reported at most every `interval` seconds or
+    `threshold` bytes, as well as when the transfer reaches its size and when
+    it is flushed, so that the last progress event is exact.
+
+    A restarted transfer is not reported until it has transferred more than
+    the bytes already reported, so that git-lfs never sees the progress of a
+    transfer go back.
+    """
+
+    def __init__(
+        self,
+        oid: str,
+        writer: EventWriter,
+        *,
+        size: int = None,
+        interval: float = DEFAULT_PROGRESS_INTERVAL / 1000,
+        threshold: int = DEFAULT_PROGRESS_BYTES,
+    ):
         self._seen_so_far = 0
+        self._reported = 0
+        self._last_report = time.monotonic()
         self._lock = threading.Lock()
         self.oid = oid
+        self.writer = writer
+        self.size = size
+        self.interval = interval
+        self.threshold = threshold
 
     def __call__(self, bytes_amount):
         with self._lock:
             self._seen_so_far += bytes_amount
-            progress_event = {
+            now = time.monotonic()
+            if self._seen_so_far <= self._reported or (
+                self._seen_so_far - self._reported < self.threshold
+                and now - self._last_report < self.interval
+                and self._seen_so_far != self.size
+            ):
+                return
+            self._report(now)
+
+    def flush(self) -> None:
+        """Reports the bytes transferred since the last progress event"""
+        with self._lock:
+            if self._seen_so_far > self._reported:
+                self._report(time.monotonic())
+
+    def restart(self) -> None:
+        """Counts the bytes of the transfer from zero again, eg for a retry"""
+        with self._lock:
+            self._seen_so_far = 0
+
+    def _report(self, now: float) -> None:
+        self.writer.write(
+            {
                 "event": "progress",
                 "oid": self.oid,
                 "bytesSoFar": self._seen_so_far,
-                "bytesSinceLast": bytes_amount,
+                "bytesSinceLast": self._seen_so_far - self._reported,
             }
-            sys.stdout.write(f"{json.dumps(progress_event)}\n")
-            sys.stdout.flush()
+        )
+        self._reported = self._seen_so_far
+        self._last_report = now
+
+
+class HashingWriter:
+    """Write-only file object computing the sha256 of what it writes.
+
+    Having no seek method, boto3 writes the ranges of a multipart download to
+    it in order, holding the ranges received early in memory, within the
+    limits of the transfer config. The object is hashed as it arrives and is
+    never read back.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self.sha256.update(data)
+        return self.f.write(data)
 
+    def hexdigest(self) -> str:
+        return self.sha256.hexdigest()
 
-def write_error_event(*, oid: str, error: str, flush=False):
+
+def write_error_event(writer: EventWriter, *, oid: str, error: str):
     err_event = {
         "event": "complete",
         "oid": oid,
         "error": {"code": 2, "message": error},
     }
-    sys.stdout.write(f"{json.dumps(err_event)}\n")
-    if flush:
-        sys.stdout.flush()
+    writer.write(err_event)
 
 
 class LFSProcess:
-    def __init__(self, s3uri: str):
+    def __init__(self, s3uri: str, settings: Settings = None):
+        self.settings = settings or Settings(
+            "lfs.customtransfer.git-lfs-s3", "GIT_LFS_S3_"
+        )
+        self.progress_interval = (
+            self.settings.get_int("progressInterval", DEFAULT_PROGRESS_INTERVAL) / 1000
+        )
+        self.progress_bytes = self.settings.get_int(
+            "progressBytes", DEFAULT_PROGRESS_BYTES
+        )
+        self.transfer_config = self.create_transfer_config()
+        self.sharded = self.settings.get_bool("shardedKeys", False)
+        self.packs = self.settings.get_bool("packs", False)
+        self.pack_readahead = self.settings.get_int(
+            "packReadahead", DEFAULT_PACK_READAHEAD
+        )
+        self.cache = None
+        if self.settings.get_bool("cache", False):
+            self.cache = LFSCache(
+                self.settings.get("cacheDir") or default_cache_dir("lfs"),
+                self.settings.get_int("cacheSize", DEFAULT_CACHE_SIZE),
+            )
+        self.writer = EventWriter()
+        self._readahead = set()
         uri_scheme, profile, bucket, prefix = parse_git_url(s3uri)
-        if bucket is None or prefix is None:
+        self.valid = bucket is not None and prefix is not None
+        if not self.valid:
             logger.error(f"s3 uri {s3uri} is invalid")
             error_event = {
                 "error": {"code": 32, "message": f"s3 uri {s3uri} is invalid"}
             }
-            sys.stdout.write(f"{json.dumps(error_event)}\n")
-            sys.stdout.flush()
+            self.writer.write(error_event)
             return
         self.prefix = prefix
         self.bucket = bucket
         self.profile = profile
         self.s3_bucket = None
-        sys.stdout.write("{}\n")
-        sys.stdout.flush()
+        self._s3_lock = threading.Lock()
+        self._index = None
+        self._index_loaded = False
+        self._index_lock = threading.Lock()
+        self._pack_index = None
+        self._pack_index_lock = threading.Lock()
+        self.writer.write({})
+
+    def create_transfer_config(self) -> TransferConfig:
+        """Creates the configuration of the multipart transfers of boto3
+
+        Returns:
+            TransferConfig: the configuration applied to every transfer
+        """
+        config = TransferConfig(
+            multipart_threshold=self.settings.get_int(
+                "multipartThreshold", DEFAULT_MULTIPART_THRESHOLD
+            ),
+            multipart_chunksize=self.settings.get_int(
+                "multipartChunkSize", DEFAULT_MULTIPART_CHUNK_SIZE
+            ),
+            max_concurrency=max(
+                1, self.settings.get_int("maxConcurrency", DEFAULT_MAX_CONCURRENCY)
+            ),
+        )
+        max_memory = self.settings.get_int("maxMemory", 0)
+        if max_memory > 0:
+            # Parts read ahead of their upload, and chunks downloaded ahead of
+            # their write, are the memory held by a transfer
+            config.max_in_memory_upload_chunks = max(
+                1, max_memory // config.multipart_chunksize
+            )
+            config.max_in_memory_download_chunks = max(
+                1, max_memory // config.io_chunksize
+            )
+            config.max_io_queue = config.max_in_memory_download_chunks
+        logger.debug(
+            f"transfer config: multipart threshold {config.multipart_threshold}, "
+            f"chunk size {config.multipart_chunksize}, "
+            f"concurrency {config.max_concurrency}, "
+            f"max memory {max_memory or 'default'}"
+        )
+        return config
 
     def init_s3_bucket(self):
         if self.s3_bucket is not None:
             return
-        if self.profile is None:
-            session = boto3.Session()
+        with self._s3_lock:
+            if self.s3_bucket is not None:
+                return
+            if self.profile is None:
+                session = boto3.Session()
+            else:
+                session = boto3.Session(profile_name=self.profile)
+            # A transfer runs up to max_concurrency requests at a time
+            s3 = session.resource(
+                "s3",
+                config=botocore.config.Config(
+                    max_pool_connections=max(10, self.transfer_config.max_concurrency)
+                ),
+            )
+            metrics.attach(s3.meta.client)
+            self.s3_bucket = s3.Bucket(self.bucket)
+
+    def get_index(self) -> dict:
+        """Gets the LFS objects of the repo, listed once per session
+
+        Returns:
+            dict: the size of the objects by oid, or None if they cannot be
+            listed, in which case they are checked one by one
+        """
+        with self._index_lock:
+            if not self._index_loaded:
+                self._index = self.list_lfs_objects()
+                self._index_loaded = True
+            return self._index
+
+    def list_lfs_objects(self) -> dict:
+        client = self.s3_bucket.meta.client
+        prefix = f"{self.prefix}/lfs/"
+        kwargs = {"Bucket": self.bucket, "Prefix": prefix}
+        index = {}
+        try:
+            for _ in range(MAX_INDEX_PAGES):
+                res = client.list_objects_v2(**kwargs)
+                for o in res.get("Contents", []):
+                    # The oid is the last part of both the flat and sharded keys
+                    index[o["Key"].rsplit("/", 1)[-1]] = o["Size"]
+                if not res.get("IsTruncated"):
+                    logger.debug(f"{len(index)} LFS objects on the remote")
+                    return index
+                kwargs["ContinuationToken"] = res["NextContinuationToken"]
+        except ClientError as e:
+            logger.debug(f"cannot list the LFS objects: {e}")
+            return None
+        logger.debug("too many LFS objects to list")
+        return None
+
+    def object_exists(self, oid: str, size: int = None) -> bool:
+        """Checks if an LFS object is already stored on the remote
+
+        Args:
+            oid (str): the oid of the object
+            size (int): the expected size of the object, if known. An object
+                of another size, eg a truncated one, is not counted
+
+        Returns:
+            bool: true if the object does not need to be uploaded
+        """
+        index = self.get_index()
+        if index is not None:
+            found = index.get(oid)
         else:
-            session = boto3.Session(profile_name=self.profile)
-        s3 = session.resource("s3")
-        self.s3_bucket = s3.Bucket(self.bucket)
+            found = None
+            for key in self.object_keys(oid):
+                try:
+                    found = self.s3_bucket.meta.client.head_object(
+                        Bucket=self.bucket, Key=key
+                    )["ContentLength"]
+                    break
+                except ClientError as e:
+                    if e.response["Error"]["Code"] not in ["404", "NoSuchKey"]:
+                        raise e
+        return found is not None and (size is None or found == size)
+
+    def object_keys(self, oid: str) -> list[str]:
+        """Gets the keys an LFS object may be stored under
+
+        Returns:
+            list[str]: the key of the configured layout, where objects are
+            uploaded, then the key of the other layout
+        """
+        return [
+            lfs_key(self.prefix, oid, self.sharded),
+            lfs_key(self.prefix, oid, not self.sharded),
+        ]
+
+    def get_pack_index(self) -> PackIndex:
+        """Gets the packed LFS objects of the repo, loaded once per session"""
+        with self._pack_index_lock:
+            if self._pack_index is None:
+                try:
+                    self._pack_index = PackIndex.load(
+                        self.s3_bucket.meta.client, self.bucket, self.prefix
+                    )
+                except ClientError as e:
+                    logger.error(f"cannot load the LFS packs: {e}")
+                    self._pack_index = PackIndex()
+            return self._pack_index
+
+    def add_to_index(self, oid: str, size: int) -> None:
+        with self._index_lock:
+            if self._index is not None:
+                self._index[oid] = size
+
+    def progress(self, event: dict) -> ProgressPercentage:
+        return ProgressPercentage(
+            event["oid"],
+            self.writer,
+            size=event.get("size"),
+            interval=self.progress_interval,
+            threshold=self.progress_bytes,
+        )
+
+    def run(self, event: dict) -> None:
+        """Runs an upload or download event"""
+        if not self.valid:
+            # The init failed, the error was reported already
+            write_error_event(self.writer, oid=event["oid"], error="invalid s3 uri")
+            return
+        with metrics.timer("commands", event["event"]):
+            if event["event"] == "upload":
+                self.upload(event)
+            else:
+                self.download(event)
+
+    def close(self) -> None:
+        """Writes the last events and removes the unclaimed readahead"""
+        self.writer.close()
+        self.prune_readahead()
+
+    def prune_readahead(self) -> None:
+        """Removes the objects read ahead that git-lfs did not ask for
+
+        git-lfs terminates its processes once all the objects were requested,
+        so the objects this process read ahead that are still there will not
+        be claimed. Objects left by processes that did not terminate are
+        removed once they are older than READAHEAD_MAX_AGE.
+        """
+        for path in self._readahead:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._readahead.clear()
+        readahead_dir = os.path.abspath(READAHEAD_DIR)
+        if not os.path.isdir(readahead_dir):
+            return
+        now = time.time()
+        for name in os.listdir(readahead_dir):
+            path = os.path.join(readahead_dir, name)
+            try:
+                if now - os.path.getmtime(path) > READAHEAD_MAX_AGE:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
 
     def upload(self, event: dict):
         logger.debug("upload")
         try:
             self.init_s3_bucket()
-            if list(
-                self.s3_bucket.objects.filter(
-                    Prefix=f"{self.prefix}/lfs/{event['oid']}"
-                )
-            ):
+            if self.object_exists(event["oid"], event.get("size")):
                 logger.debug("object already exists")
-                sys.stdout.write(
-                    f"{json.dumps({'event': 'complete', 'oid': event['oid']})}\n"
-                )
-                sys.stdout.flush()
+                self.writer.write({"event": "complete", "oid": event["oid"]})
                 return
+            progress = self.progress(event)
             self.s3_bucket.upload_file(
                 event["path"],
-                f"{self.prefix}/lfs/{event['oid']}",
-                Callback=ProgressPercentage(event["oid"]),
-            )
-            sys.stdout.write(
-                f"{json.dumps({'event': 'complete', 'oid': event['oid']})}\n"
+                self.object_keys(event["oid"])[0],
+                Callback=progress,
+                Config=self.transfer_config,
             )
+            size = os.path.getsize(event["path"])
+            metrics.add_bytes("uploaded", size)
+            self.add_to_index(event["oid"], size)
+            progress.flush()
+            if self.cache is not None:
+                self.cache.put_object(oid=event["oid"], path=event["path"])
+            self.writer.write({"event": "complete", "oid": event["oid"]})
         except Exception as e:
             logger.error(e)
-            write_error_event(oid=event["oid"], error=str(e))
-        sys.stdout.flush()
+            write_error_event(self.writer, oid=event["oid"], error=str(e))
 
     def download(self, event: dict):
         logger.debug("download")
         try:
-            self.init_s3_bucket()
             temp_dir = os.path.abspath(".git/lfs/tmp")
-            self.s3_bucket.download_file(
-                Key=f"{self.prefix}/lfs/{event['oid']}",
-                Filename=f"{temp_dir}/{event['oid']}",
-                Callback=ProgressPercentage(event["oid"]),
-            )
+            progress = self.progress(event)
+            path = f"{temp_dir}/{event['oid']}"
+            if self.cache is not None and self.cache.get_object(
+                oid=event["oid"], path=path
+            ):
+                metrics.count("cache.hit")
+                progress(os.path.getsize(path))
+            else:
+                if self.cache is not None:
+                    metrics.count("cache.miss")
+                self.init_s3_bucket()
+                if not self.download_packed(event["oid"], path, progress):
+                    self.download_verified(event["oid"], path, progress)
+                if self.cache is not None:
+                    self.cache.put_object(oid=event["oid"], path=path, verified=True)
+            progress.flush()
             done_event = {
                 "event": "complete",
                 "oid": event["oid"],
-                "path": f"{temp_dir}/{event['oid']}",
+                "path": path,
             }
-            sys.stdout.write(f"{json.dumps(done_event)}\n")
+            self.writer.write(done_event)
         except Exception as e:
             logger.error(e)
-            write_error_event(oid=event["oid"], error=str(e))
+            write_error_event(self.writer, oid=event["oid"], error=str(e))
+
+    def download_verified(self, oid: str, path: str, progress) -> None:
+        """Downloads an LFS object, checking its sha256 against its oid
+
+        Args:
+            oid (str): the oid of the object
+            path (str): the file to write
+            progress (ProgressPercentage): the progress of the transfer
+
+        Raises:
+            ValueError: if the content does not match the oid
+        """
+        keys = self.object_keys(oid)
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            with open(path, "wb") as f:
+                writer = HashingWriter(f)
+                keys = self.download_first(keys, writer, progress)
+                size = f.tell()
+            metrics.add_bytes("downloaded", size)
+            if writer.hexdigest() == oid:
+                return
+            logger.error(f"{oid} does not match its content, attempt {attempt}")
+            metrics.count("errors.sha256")
+            # The bytes of the corrupted download do not count
+            progress.restart()
+        raise ValueError(f"content of {oid} does not match its oid")
+
+    def download_packed(self, oid: str, path: str, progress) -> bool:
+        """Gets an LFS object from its pack, if it is packed
+
+        The object is requested with a ranged GET of its pack covering the
+        objects following it, up to the readahead. These are checked against
+        their oid and kept for their own download, by this process or by
+        the other processes of the clone.
+
+        Args:
+            oid (str): the oid of the object
+            path (str): the file to write
+            progress (ProgressPercentage): the progress of the transfer
+
+        Returns:
+            bool: true if the object was written, false to download it from
+            its own S3 object
+        """
+        if not self.packs:
+            return False
+        if self.claim_readahead(oid, path, progress):
+            return True
+        index = self.get_pack_index()
+        if oid not in index:
+            return False
+        pack, entries = index.neighbours(oid, self.pack_readahead)
+        data = self.read_pack_range(pack, entries)
+        if data is None:
+            return False
+        return self.spill_readahead(oid, path, progress, pack, entries, data)
+
+    def claim_readahead(self, oid: str, path: str, progress) -> bool:
+        """Moves an LFS object read ahead from its pack to path
+
+        Returns:
+            bool: true if the object was read ahead
+        """
+        try:
+            os.replace(os.path.join(os.path.abspath(READAHEAD_DIR), oid), path)
+        except FileNotFoundError:
+            return False
+        metrics.count("packs.readahead")
+        progress(os.path.getsize(path))
+        return True
 
-        sys.stdout.flush()
+    def read_pack_range(self, pack: str, entries: list[tuple]) -> bytes:
+        """Reads the bytes of consecutive objects of a pack with a ranged GET
+
+        Args:
+            pack (str): the name of the pack
+            entries (list[tuple]): the oid, offset and size of the objects
+
+        Returns:
+            bytes: the bytes from the first object to the end of the last one,
+            or None if the pack cannot be read
+        """
+        start = entries[0][1]
+        end = entries[-1][1] + entries[-1][2] - 1
+        try:
+            obj = self.s3_bucket.meta.client.get_object(
+                Bucket=self.bucket,
+                Key=pack_key(self.prefix, pack, "pack"),
+                Range=f"bytes={start}-{end}",
+            )
+            data = obj["Body"].read()
+        except ClientError as e:
+            logger.error(f"cannot read pack {pack}: {e}")
+            return None
+        metrics.add_bytes("downloaded", len(data))
+        return data
+
+    def spill_readahead(
+        self,
+        oid: str,
+        path: str,
+        progress,
+        pack: str,
+        entries: list[tuple],
+        data: bytes,
+    ) -> bool:
+        """Writes an LFS object read from its pack, and the objects read ahead
+
+        Objects are checked against their oid. Those read ahead that another
+        process did not claim yet are written to the readahead folder.
+
+        Args:
+            oid (str): the oid of the object
+            path (str): the file to write
+            progress (ProgressPercentage): the progress of the transfer
+            pack (str): the name of the pack
+            entries (list[tuple]): the oid, offset and size of the objects read
+            data (bytes): the bytes read, from the offset of the first entry
+
+        Returns:
+            bool: true if the object was written
+        """
+        readahead_dir = os.path.abspath(READAHEAD_DIR)
+        os.makedirs(readahead_dir, exist_ok=True)
+        start = entries[0][1]
+        found = False
+        for entry_oid, offset, size in entries:
+            if entry_oid != oid and self.is_claimed(entry_oid):
+                continue
+            content = data[offset - start : offset - start + size]
+            if hashlib.sha256(content).hexdigest() != entry_oid:
+                logger.error(f"{entry_oid} does not match its content in {pack}")
+                metrics.count("errors.sha256")
+                continue
+            if entry_oid == oid:
+                with open(path, "wb") as f:
+                    f.write(content)
+                progress(size)
+                found = True
+                continue
+            # Written aside and renamed, so that other processes only ever
+            # claim complete objects
+            tmp = os.path.join(readahead_dir, f".{entry_oid}.{uuid.uuid4().hex}")
+            with open(tmp, "wb") as f:
+                f.write(content)
+            os.replace(tmp, os.path.join(readahead_dir, entry_oid))
+            self._readahead.add(os.path.join(readahead_dir, entry_oid))
+        return found
+
+    def is_claimed(self, oid: str) -> bool:
+        """Checks if an LFS object is read ahead, downloading or downloaded
+
+        Args:
+            oid (str): the oid of the object
+
+        Returns:
+            bool: true if this process or another one already got the object,
+            which is then not read ahead again
+        """
+        return any(
+            os.path.exists(os.path.abspath(path))
+            for path in [
+                os.path.join(READAHEAD_DIR, oid),
+                f".git/lfs/tmp/{oid}",
+                f".git/lfs/objects/{oid[0:2]}/{oid[2:4]}/{oid}",
+            ]
+        )
+
+    def download_first(self, keys: list[str], writer, progress) -> list[str]:
+        """Downloads the first of the keys that exists
+
+        Returns:
+            list[str]: the keys from the one downloaded on, so that another
+            attempt does not request the missing ones again
+        """
+        for i, key in enumerate(keys):
+            try:
+                self.s3_bucket.download_fileobj(
+                    Key=key,
+                    Fileobj=writer,
+                    Callback=progress,
+                    Config=self.transfer_config,
+                )
+                return keys[i:]
+            except ClientError as e:
+                if (
+                    e.response["Error"]["Code"] not in ["404", "NoSuchKey"]
+                    or i == len(keys) - 1
+                ):
+                    raise e
+                logger.debug(f"{key} not found, trying {keys[i + 1]}")
 
 
 def first_git_config_key(keys):
@@ -194,37 +738,61 @@ def main():  # noqa: C901
             print(f"unknown command {sys.argv[1]}")
             sys.exit(1)
 
+    metrics.start("git-lfs-s3", Settings("s3", "GIT_REMOTE_S3_").get("metricsFile"))
     lfs_process = None
-    while True:
-        logger.debug("git-lfs-s3 starting")
-        line = sys.stdin.readline()
-        logger.debug(line)
-        event = json.loads(line)
-        if event["event"] == "init":
-            # This is just another precaution but not strictly necessary since git would
-            # already have validated the origin name
-            if not validate_ref_name(event["remote"]):
-                logger.error(f"invalid ref {event['remote']}")
-                sys.stdout.write("{}\n")
-                sys.stdout.flush()
-                sys.exit(1)
-            # input(str([f"remote.{event["remote"]}.lfspushurl", f"remote.{event["remote"]}.lfsurl", "lfs.pushurl", "lfs.url"]))
-            result = first_git_config_key([f"remote.{event["remote"]}.lfspushurl", f"remote.{event["remote"]}.lfsurl", "lfs.pushurl", "lfs.url"])
-            if result == None:
-                logger.error(result.stderr.decode("utf-8").strip())
-                error_event = {
-                    "error": {
-                        "code": 2,
-                        "message": f"cannot resolve remote \"{event['remote']}\"",
-                    }
+    try:
+        while True:
+            logger.debug("git-lfs-s3 starting")
+            line = sys.stdin.readline()
+            logger.debug(line)
+            if not line:
+                break
+            event = json.loads(line)
+            if event["event"] == "terminate":
+                break
+            lfs_process = handle_event(lfs_process, event)
+    finally:
+        if lfs_process is not None:
+            lfs_process.close()
+        metrics.write()
+
+
+def handle_event(lfs_process: LFSProcess, event: dict) -> LFSProcess:
+    """Handles an event of the custom transfer protocol
+
+    git-lfs waits for the complete event of an upload or download before it
+    sends the next one to the process, so transfers run one at a time. It
+    runs several processes, up to `lfs.concurrenttransfers`, to transfer
+    objects in parallel.
+
+    Returns:
+        LFSProcess: the process, created by the init event
+    """
+    if event["event"] == "init":
+        # This is just another precaution but not strictly necessary since git would
+        # already have validated the origin name
+        if not validate_ref_name(event["remote"]):
+            logger.error(f"invalid ref {event['remote']}")
+            sys.stdout.write("{}\n")
+            sys.stdout.flush()
+            sys.exit(1)
+        # input(str([f"remote.{event['remote']}.lfspushurl", f"remote.{event['remote']}.lfsurl", "lfs.pushurl", "lfs.url"]))
+        result = first_git_config_key([f"remote.{event['remote']}.lfspushurl", f"remote.{event['remote']}.lfsurl", "lfs.pushurl", "lfs.url"])
+        if result == None:
+            logger.error(result.stderr.decode("utf-8").strip())
+            error_event = {
+                "error": {
+                    "code": 2,
+                    "message": f"cannot resolve remote \"{event['remote']}\"",
                 }
-                sys.stdout.write(f"{json.dumps(error_event)}")
-                sys.stdout.flush()
-                sys.exit(1)
-            s3uri = result
+            }
+            sys.stdout.write(f"{json.dumps(error_event)}")
+            sys.stdout.flush()
+            sys.exit(1)
+        s3uri = result
+        with metrics.timer("commands", "init"):
             lfs_process = LFSProcess(s3uri=s3uri)
 
-        elif event["event"] == "upload":
-            lfs_process.upload(event)
-        elif event["event"] == "download":
-            lfs_process.download(event)
+    elif event["event"] in ["upload", "download"]:
+        lfs_process.run(event)
+    return lfs_process
@@ -0,0 +1,147 @@
+# SPDX-FileCopyrightText: 2023-present Amazon.com, Inc. or its affiliates
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+PACKS_FOLDER = "lfs-packs"
+# Objects up to this size are packed, larger ones keep their own S3 object
+DEFAULT_PACK_THRESHOLD = 1024 * 1024
+DEFAULT_PACK_SIZE = 64 * 1024 * 1024
+# Bytes of the following objects of a pack requested along with an object
+DEFAULT_PACK_READAHEAD = 1024 * 1024
+
+
+def pack_key(prefix: str, pack: str, ext: str) -> str:
+    """Gets the key of a pack of LFS objects or of its index
+
+    Args:
+        prefix (str): the prefix of the repo
+        pack (str): the name of the pack, the sha256 of its content
+        ext (str): pack or json
+
+    Returns:
+        str: the key
+    """
+    return f"{prefix}/{PACKS_FOLDER}/{pack}.{ext}"
+
+
+class PackIndex:
+    """The packed LFS objects of a repo, by oid.
+
+    A pack is the concatenation of small LFS objects, stored as
+    `<prefix>/lfs-packs/<sha256>.pack` next to its index
+    `<prefix>/lfs-packs/<sha256>.json`:
+
+        {"objects": [["<oid>", <offset>, <size>], ...]}
+
+    The index is uploaded after its pack, so a listed index always points to
+    a complete pack. The objects keep their own S3 object as well, packs only
+    serve them in fewer requests.
+    """
+
+    def __init__(self):
+        self.packs = {}
+        self.objects = {}
+
+    def add(self, pack: str, entries: list) -> None:
+        """Adds the objects of a pack
+
+        Args:
+            pack (str): the name of the pack
+            entries (list): the oid, offset and size of its objects
+        """
+        entries = sorted((tuple(e) for e in entries), key=lambda e: e[1])
+        self.packs[pack] = entries
+        for i, (oid, _, _) in enumerate(entries):
+            self.objects.setdefault(oid, (pack, i))
+
+    def __contains__(self, oid: str) -> bool:
+        return oid in self.objects
+
+    def neighbours(self, oid: str, readahead: int) -> tuple[str, list]:
+        """Gets an object and the objects following it in its pack
+
+        Args:
+            oid (str): the oid of the object
+            readahead (int): the maximum number of bytes of the range
+
+        Returns:
+            tuple[str, list]: the pack and the oid, offset and size of the
+            object and of its neighbours within the range, in order
+        """
+        pack, i = self.objects[oid]
+        entries = self.packs[pack]
+        start = entries[i][1]
+        limit = max(readahead, entries[i][2])
+        j = i + 1
+        while j < len(entries) and entries[j][1] + entries[j][2] - start <= limit:
+            j += 1
+        return pack, entries[i:j]
+
+    @classmethod
+    def load(cls, s3, bucket: str, prefix: str) -> "PackIndex":
+        """Loads the indexes of the packs of a repo
+
+        Args:
+            s3: the boto3 S3 client
+            bucket (str): the bucket of the repo
+            prefix (str): the prefix of the repo
+
+        Returns:
+            PackIndex: the packed objects
+        """
+        index = cls()
+        kwargs = {"Bucket": bucket, "Prefix": f"{prefix}/{PACKS_FOLDER}/"}
+        while True:
+            res = s3.list_objects_v2(**kwargs)
+            for o in res.get("Contents", []):
+                if not o["Key"].endswith(".json"):
+                    continue
+                pack = o["Key"].rsplit("/", 1)[-1][: -len(".json")]
+                obj = s3.get_object(Bucket=bucket, Key=o["Key"])
+                index.add(pack, json.loads(obj["Body"].read())["objects"])
+            if not res.get("NextContinuationToken"):
+                break
+            kwargs["ContinuationToken"] = res["NextContinuationToken"]
+        logger.debug(f"{len(index.objects)} LFS objects in {len(index.packs)} packs")
+        return index
+
+
+def write_pack(s3, bucket: str, prefix: str, objects) -> str:
+    """Uploads a pack of LFS objects and its index
+
+    Args:
+        s3: the boto3 S3 client
+        bucket (str): the bucket of the repo
+        prefix (str): the prefix of the repo
+        objects: the oid and content of the objects, in the order they are
+            packed
+
+    Returns:
+        str: the name of the pack
+    """
+    digest = hashlib.sha256()
+    entries = []
+    with tempfile.TemporaryDirectory(prefix="git_remote_s3_lfs_pack_") as tmp:
+        path = os.path.join(tmp, "pack")
+        with open(path, "wb") as f:
+            for oid, content in objects:
+                entries.append([oid, f.tell(), len(content)])
+                digest.update(content)
+                f.write(content)
+        pack = digest.hexdigest()
+        s3.upload_file(path, bucket, pack_key(prefix, pack, "pack"))
+    s3.put_object(
+        Bucket=bucket,
+        Key=pack_key(prefix, pack, "json"),
+        Body=json.dumps({"objects": entries}),
+    )
+    logger.info(f"packed {len(entries)} LFS objects in {pack}")
+    return pack
@@ -5,8 +5,12 @@
 import boto3
 from .remote import parse_git_url
 import argparse
+import hashlib
+import os
+import re
 import sys
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import (
     ClientError,
     ProfileNotFound,
@@ -14,7 +18,20 @@ from botocore.exceptions import (
     NoCredentialsError,
     UnknownCredentialError,
 )
-from .git import get_remote_url, GitError
+from .common import lfs_key
+from .git import get_remote_url, lfs_objects_dir, GitError
+from .lfspack import (
+    PackIndex,
+    write_pack,
+    DEFAULT_PACK_SIZE,
+    DEFAULT_PACK_THRESHOLD,
+)
+from .manifest import Manifest, MANIFEST_ATTEMPTS, MANIFEST_KEY, PACK_LAYOUT
+from .settings import Settings
+
+DEFAULT_MIGRATE_CONCURRENCY = 16
+# CopyObject is limited to 5 GiB, larger objects are copied in parts
+MAX_COPY_OBJECT_SIZE = 5 * 1024**3
 
 
 class Doctor:
@@ -41,6 +58,33 @@ class Doctor:
             print(f"  HEAD: {head_ref}")
 
         self.fix_issues(repos)
+        self.rebuild_manifest()
+
+    def rebuild_manifest(self):
+        """Rewrites the manifest of the repo from the bundles stored under it"""
+        manifest = Manifest.load(self.s3, self.bucket, self.prefix)
+        if manifest is not None and manifest.layout == PACK_LAYOUT:
+            # The manifest is the only record of the refs of the pack layout
+            print(f"\nManifest {self.prefix}/{MANIFEST_KEY} kept (pack layout)")
+            return
+        objs = []
+        kwargs = {"Bucket": self.bucket, "Prefix": f"{self.prefix}/refs/"}
+        while True:
+            res = self.s3.list_objects_v2(**kwargs)
+            objs.extend(res.get("Contents", []))
+            if not res.get("NextContinuationToken"):
+                break
+            kwargs["ContinuationToken"] = res["NextContinuationToken"]
+        rebuilt = Manifest.from_objects(objs, self.prefix)
+        # Replaces the manifest read above, unless a push wrote it meanwhile
+        rebuilt.etag = manifest.etag if manifest is not None else None
+        if not rebuilt.save(self.s3, self.bucket, self.prefix):
+            print(
+                f"\nManifest {self.prefix}/{MANIFEST_KEY} changed during the "
+                "rebuild, run git-s3 doctor again"
+            )
+            return
+        print(f"\nManifest {self.prefix}/{MANIFEST_KEY} rebuilt")
 
     def fix_issues(self, repos):
         for r in repos.keys():
@@ -64,6 +108,8 @@ class Doctor:
             if repo_name not in repos:
                 repos[repo_name] = {"refs": {}, "HEAD": "Missing"}
             refs = "/".join(key_parts[1:-1])
+            if key_parts[1] == MANIFEST_KEY:
+                continue
             if key_parts[1] == "HEAD":
                 head_ref = (
                     self.s3.get_object(Bucket=self.bucket, Key=key)
@@ -74,6 +120,9 @@ class Doctor:
                 )
                 repos[repo_name]["HEAD"] = head_ref
                 continue
+            if "CHAIN#" in key_parts:
+                # links of an incremental bundle chain, not a bundle of their own
+                continue
             if not repos[repo_name]["refs"].get(refs, None):
                 repos[repo_name]["refs"][refs] = {"protected": False, "bundles": []}
             if "PROTECTED#" == key_parts[-1]:
@@ -151,7 +200,8 @@ class ManageBranch:
         self.prefix = prefix
         self.s3 = boto3.Session(profile_name=profile).client("s3")
         self.branch = branch
-        if not self.get_branch_content():
+        self.ref = f"refs/heads/{branch}"
+        if not self.get_branch_content() and not self.in_manifest():
             raise ValueError(f"Branch {self.branch} does not exist")
 
     def process_cmd(self, cmd):
@@ -168,6 +218,7 @@ class ManageBranch:
         if resp.lower() == "yes":
             for o in objs:
                 self.s3.delete_object(Bucket=self.bucket, Key=o["Key"])
+            self.update_manifest(lambda m: m.remove_ref(self.ref))
             print(f"Branch {self.branch} has been deleted")
         else:
             print("Aborted")
@@ -178,11 +229,17 @@ class ManageBranch:
         ).get("Contents", [])
         return objs
 
+    def in_manifest(self) -> bool:
+        """Checks if the manifest has the branch, as with the pack layout"""
+        manifest = Manifest.load(self.s3, self.bucket, self.prefix)
+        return manifest is not None and self.ref in manifest.refs
+
     def protect_branch(self):
         self.s3.put_object(
             Bucket=self.bucket,
             Key=f"{self.prefix}/refs/heads/{self.branch}/PROTECTED#",
         )
+        self.update_manifest(lambda m: m.set_protected(self.ref, True))
         print(f"Branch {self.branch} is now protected")
 
     def unprotect_branch(self):
@@ -190,8 +247,232 @@ class ManageBranch:
             Bucket=self.bucket,
             Key=f"{self.prefix}/refs/heads/{self.branch}/PROTECTED#",
         )
+        self.update_manifest(lambda m: m.set_protected(self.ref, False))
         print(f"Branch {self.branch} is now unprotected")
 
+    def update_manifest(self, update) -> None:
+        """Applies a change to the manifest of the repo, if it has one"""
+        for _ in range(MANIFEST_ATTEMPTS):
+            manifest = Manifest.load(self.s3, self.bucket, self.prefix)
+            if manifest is None:
+                return
+            update(manifest)
+            if manifest.save(self.s3, self.bucket, self.prefix):
+                return
+        print(f"Manifest {self.prefix}/{MANIFEST_KEY} keeps changing, not updated")
+
+
+class MigrateLFSKeys:
+    """Moves the LFS objects of a repo from flat keys to sharded keys.
+
+    Objects are copied server side, in parallel. The flat keys are kept, as
+    clients that predate the sharded keys only read those: once every client is
+    upgraded, a second run with delete_flat deletes the flat keys whose sharded
+    copy exists.
+    """
+
+    def __init__(self, profile, bucket, prefix, concurrency, delete_flat=False) -> None:
+        self.bucket = bucket
+        self.prefix = prefix
+        self.concurrency = max(1, concurrency)
+        self.delete_flat = delete_flat
+        self.s3 = boto3.Session(profile_name=profile).client("s3")
+
+    def run(self):
+        count = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for objs in self.list_flat_objects():
+                if self.delete_flat:
+                    count += self.delete_copied(executor, objs)
+                else:
+                    list(executor.map(self.copy_object, objs))
+                    count += len(objs)
+        if self.delete_flat:
+            print(f"{count} flat LFS keys deleted")
+            return
+        print(f"{count} LFS objects copied to sharded keys")
+        print(
+            "Enable the sharded keys with "
+            "`git config lfs.customtransfer.git-lfs-s3.shardedKeys true`, then, "
+            "once every client is upgraded, delete the flat keys with "
+            "`git s3 migrate-lfs-keys --delete-flat <remote>`"
+        )
+
+    def list_flat_objects(self):
+        """Lists the LFS objects stored under flat keys, a page at a time
+
+        Yields:
+            list[dict]: the objects of a page of the listing
+        """
+        kwargs = {
+            "Bucket": self.bucket,
+            "Prefix": f"{self.prefix}/lfs/",
+            # The keys below the shard prefixes are sharded already
+            "Delimiter": "/",
+        }
+        while True:
+            res = self.s3.list_objects_v2(**kwargs)
+            yield [
+                o
+                for o in res.get("Contents", [])
+                if re.fullmatch(r"[0-9a-f]{64}", o["Key"].rsplit("/", 1)[-1])
+            ]
+            if not res.get("NextContinuationToken"):
+                break
+            kwargs["ContinuationToken"] = res["NextContinuationToken"]
+
+    def delete_copied(self, executor: ThreadPoolExecutor, objs: list[dict]) -> int:
+        """Deletes the flat keys of a page whose sharded copy exists
+
+        Returns:
+            int: the number of flat keys deleted
+        """
+        copied = [o for o, ok in zip(objs, executor.map(self.is_copied, objs)) if ok]
+        if copied:
+            self.s3.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": o["Key"]} for o in copied]},
+            )
+        if len(copied) < len(objs):
+            print(
+                f"{len(objs) - len(copied)} LFS objects are not copied yet, "
+                "their flat keys are kept"
+            )
+        return len(copied)
+
+    def is_copied(self, obj: dict) -> bool:
+        oid = obj["Key"].rsplit("/", 1)[-1]
+        key = lfs_key(self.prefix, oid, sharded=True)
+        try:
+            res = self.s3.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ["404", "NoSuchKey"]:
+                raise
+            return False
+        return res["ContentLength"] == obj["Size"]
+
+    def copy_object(self, obj: dict) -> None:
+        oid = obj["Key"].rsplit("/", 1)[-1]
+        source = {"Bucket": self.bucket, "Key": obj["Key"]}
+        key = lfs_key(self.prefix, oid, sharded=True)
+        if obj["Size"] > MAX_COPY_OBJECT_SIZE:
+            self.s3.copy(source, self.bucket, key)
+        else:
+            self.s3.copy_object(CopySource=source, Bucket=self.bucket, Key=key)
+
+
+class PackLFSObjects:
+    """Packs the small LFS objects of a repo, to download them in fewer requests.
+
+    Objects up to the pack threshold that are not packed yet are read from the
+    local LFS store, or downloaded when missing from it, and checked against
+    their oid. They are packed in the order they were uploaded, which follows
+    the order of the pushes, so that the objects of a checkout are close to
+    each other. The objects keep their own S3 object.
+    """
+
+    def __init__(self, profile, bucket, prefix, concurrency) -> None:
+        self.bucket = bucket
+        self.prefix = prefix
+        self.concurrency = max(1, concurrency)
+        self.s3 = boto3.Session(profile_name=profile).client("s3")
+        settings = Settings("lfs.customtransfer.git-lfs-s3", "GIT_LFS_S3_")
+        self.threshold = settings.get_int("packThreshold", DEFAULT_PACK_THRESHOLD)
+        self.pack_size = settings.get_int("packSize", DEFAULT_PACK_SIZE)
+        self.local = lfs_objects_dir()
+
+    def run(self):
+        packed = PackIndex.load(self.s3, self.bucket, self.prefix)
+        objs = self.list_small_objects(packed)
+        count = packs = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for group in self.groups(objs):
+                # A pack of a single object would not save any request
+                if len(group) < 2:
+                    continue
+                contents = executor.map(self.read_object, group)
+                objects = [
+                    (o["oid"], c) for o, c in zip(group, contents) if c is not None
+                ]
+                if len(objects) < 2:
+                    continue
+                write_pack(self.s3, self.bucket, self.prefix, objects)
+                count += len(objects)
+                packs += 1
+        print(f"{count} LFS objects packed in {packs} packs")
+
+    def list_small_objects(self, packed: PackIndex) -> list[dict]:
+        objs = {}
+        kwargs = {"Bucket": self.bucket, "Prefix": f"{self.prefix}/lfs/"}
+        while True:
+            res = self.s3.list_objects_v2(**kwargs)
+            for o in res.get("Contents", []):
+                # Both the flat and the sharded keys end with the oid
+                oid = o["Key"].rsplit("/", 1)[-1]
+                if (
+                    re.fullmatch(r"[0-9a-f]{64}", oid)
+                    and 0 < o["Size"] <= self.threshold
+                    and oid not in packed
+                ):
+                    objs.setdefault(oid, o | {"oid": oid})
+            if not res.get("NextContinuationToken"):
+                break
+            kwargs["ContinuationToken"] = res["NextContinuationToken"]
+        return sorted(objs.values(), key=lambda o: (o["LastModified"], o["Key"]))
+
+    def groups(self, objs: list[dict]):
+        group, size = [], 0
+        for o in objs:
+            if group and size + o["Size"] > self.pack_size:
+                yield group
+                group, size = [], 0
+            group.append(o)
+            size += o["Size"]
+        if group:
+            yield group
+
+    def read_object(self, obj: dict) -> bytes:
+        oid = obj["oid"]
+        try:
+            with open(os.path.join(self.local, oid[:2], oid[2:4], oid), "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            content = self.s3.get_object(Bucket=self.bucket, Key=obj["Key"])[
+                "Body"
+            ].read()
+        if hashlib.sha256(content).hexdigest() != oid:
+            print(f"{oid} does not match its content, not packed")
+            return None
+        return content
+
+
+def run_command(args, profile, bucket, prefix):
+    if args.command == "doctor":
+        doctor = Doctor(profile, bucket, prefix, args.delete_bundle)
+        doctor.run()
+    if args.command == "migrate-lfs-keys":
+        MigrateLFSKeys(
+            profile, bucket, prefix, args.concurrency, args.delete_flat
+        ).run()
+    if args.command == "pack-lfs":
+        PackLFSObjects(profile, bucket, prefix, args.concurrency).run()
+    if (
+        args.command == "delete-branch"
+        or args.command == "protect"
+        or args.command == "unprotect"
+    ):
+        if args.branch is None:
+            sys.stderr.write("fatal: --branch is required\n")
+            sys.stderr.flush()
+            sys.exit(1)
+        try:
+            manage_branch = ManageBranch(profile, bucket, prefix, args.branch)
+            manage_branch.process_cmd(args.command)
+        except ValueError as e:
+            sys.stderr.write(f"fatal: {e}\n")
+            sys.stderr.flush()
+            sys.exit(1)
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -205,10 +486,24 @@ def main():
         action="store_true",
         help="Delete the bundle instead of creating a new branch",
     )
+    parser.add_argument(
+        "--delete-flat",
+        action="store_true",
+        help="Delete the flat keys of the LFS objects copied by migrate-lfs-keys",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=DEFAULT_MIGRATE_CONCURRENCY,
+        help="Number of LFS objects copied or read in parallel by migrate-lfs-keys "
+        "and pack-lfs",
+    )
     parser.add_argument(
         "branch",
         type=str,
         action="store",
+        nargs="?",
         help="Branch to delete from the remote",
     )
     args = parser.parse_args()
@@ -222,26 +517,7 @@ def main():
 
     uri_scheme, profile, bucket, prefix = parse_git_url(remote_url)
     try:
-        if args.command == "doctor":
-            doctor = Doctor(profile, bucket, prefix, args.delete_bundle)
-            doctor.run()
-        if (
-            args.command == "delete-branch"
-            or args.command == "protect"
-            or args.command == "unprotect"
-        ):
-            if args.branch is None:
-                sys.stderr.write("fatal: --branch is required\n")
-                sys.stderr.flush()
-                sys.exit(1)
-            try:
-                manage_branch = ManageBranch(profile, bucket, prefix, args.branch)
-                manage_branch.process_cmd(args.command)
-            except ValueError as e:
-                sys.stderr.write(f"fatal: {e}\n")
-                sys.stderr.flush()
-                sys.exit(1)
-
+        run_command(args, profile, bucket, prefix)
         sys.exit(0)
 
     except (
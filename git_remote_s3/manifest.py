@@ -0,0 +1,223 @@
+# SPDX-FileCopyrightText: 2023-present Amazon.com, Inc. or its affiliates
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import logging
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_KEY = "manifest.json"
+MANIFEST_VERSION = 1
+BUNDLE_LAYOUT = "bundle"
+PACK_LAYOUT = "pack"
+# A manifest written concurrently is loaded and updated again this many times
+MANIFEST_ATTEMPTS = 5
+
+
+class Manifest:
+    """The refs of a remote, stored as a single object next to HEAD.
+
+    Like packed-refs, the manifest maps each ref to its sha, so that listing the
+    remote costs one GetObject instead of a paginated listing of the prefix.
+    Keys are relative to the prefix of the repo:
+
+        {
+            "version": 1,
+            "refs": {
+                "refs/heads/main": {
+                    "sha": "<sha>",
+                    "bundle": "refs/heads/main/<sha>.bundle",
+                    "size": 1234,
+                    "protected": false,
+                    "chain": [{"key": "refs/heads/main/CHAIN#/...", "size": 1}]
+                }
+            }
+        }
+
+    The manifest is only ever written conditionally, on the ETag it was loaded
+    with, so that the refs updated by concurrent writers are never lost.
+
+    The bundles remain the source of truth: the manifest can always be rebuilt
+    from a listing of the prefix, which is what `git-s3 doctor` does.
+
+    Repos using the pack layout (s3+pack://) have no bundles, their manifest is
+    the source of truth. It lists the packs of the shared object store, oldest
+    first, and each ref records how many of them hold its history:
+
+        {
+            "version": 1,
+            "layout": "pack",
+            "packs": [
+                {"name": "pack-<checksum>", "size": 1234, "tips": ["<sha>"]}
+            ],
+            "refs": {
+                "refs/heads/main": {"sha": "<sha>", "packs": 1, "protected": false}
+            }
+        }
+    """
+
+    def __init__(
+        self, refs: dict = None, packs: list[dict] = None, layout: str = BUNDLE_LAYOUT
+    ):
+        self.refs = refs or {}
+        self.packs = packs or []
+        self.layout = layout
+        # The ETag of the manifest as loaded, None if there was none
+        self.etag = None
+
+    @classmethod
+    def load(cls, s3, bucket: str, prefix: str) -> "Manifest":
+        """Reads the manifest of a repo
+
+        Returns:
+            Manifest: the manifest or None if the repo has none
+        """
+        try:
+            obj = s3.get_object(Bucket=bucket, Key=f"{prefix}/{MANIFEST_KEY}")
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+                return None
+            raise e
+        content = json.loads(obj["Body"].read().decode("utf-8"))
+        if content.get("version") != MANIFEST_VERSION:
+            logger.info(f"ignoring manifest version {content.get('version')}")
+            return None
+        manifest = cls(
+            content["refs"],
+            content.get("packs"),
+            content.get("layout", BUNDLE_LAYOUT),
+        )
+        manifest.etag = obj.get("ETag")
+        return manifest
+
+    @classmethod
+    def from_objects(cls, objects: list[dict], prefix: str) -> "Manifest":
+        """Builds the manifest from a listing of the refs of a repo
+
+        Args:
+            objects (list[dict]): the objects under <prefix>/refs/
+            prefix (str): the prefix of the repo
+
+        Returns:
+            Manifest: the manifest
+        """
+        manifest = cls()
+        chains = {}
+        protected = set()
+        # The newest bundle wins when a ref has multiple bundles
+        for o in sorted(objects, key=lambda x: x["LastModified"]):
+            key = o["Key"].removeprefix(f"{prefix}/")
+            if "/CHAIN#/" in key:
+                ref = key.split("/CHAIN#/")[0]
+                chains.setdefault(ref, []).append({"key": key, "size": o["Size"]})
+            elif key.endswith("/PROTECTED#"):
+                protected.add(key.removesuffix("/PROTECTED#"))
+            elif key.endswith(".bundle"):
+                ref, _, bundle = key.rpartition("/")
+                manifest.set_ref(ref, sha=bundle.split(".")[0], size=o["Size"])
+        for ref in manifest.refs:
+            manifest.refs[ref]["protected"] = ref in protected
+            if ref in chains:
+                manifest.refs[ref]["chain"] = sorted(
+                    chains[ref], key=lambda x: x["key"]
+                )
+        return manifest
+
+    def save(self, s3, bucket: str, prefix: str) -> bool:
+        """Writes the manifest, unless another client wrote it since it was loaded
+
+        The write is conditional on the ETag of the loaded manifest, or on the
+        absence of a manifest if there was none.
+
+        Returns:
+            bool: true if the manifest was written, false if it changed in the
+            meantime, in which case it must be loaded and updated again
+        """
+        content = {"version": MANIFEST_VERSION, "refs": self.refs}
+        if self.layout != BUNDLE_LAYOUT:
+            content |= {"layout": self.layout, "packs": self.packs}
+        condition = {"IfMatch": self.etag} if self.etag else {"IfNoneMatch": "*"}
+        try:
+            res = s3.put_object(
+                Bucket=bucket,
+                Key=f"{prefix}/{MANIFEST_KEY}",
+                Body=json.dumps(content, indent=1).encode("utf-8"),
+                ContentType="application/json",
+                **condition,
+            )
+        except ClientError as e:
+            # Deleted since it was loaded, or written by another client
+            if e.response["Error"]["Code"] in [
+                "PreconditionFailed",
+                "ConditionalRequestConflict",
+                "NoSuchKey",
+            ]:
+                logger.info("the manifest was written concurrently")
+                return False
+            raise e
+        self.etag = res.get("ETag")
+        return True
+
+    def get_sha(self, ref: str) -> str:
+        return self.refs[ref]["sha"] if ref in self.refs else None
+
+    def set_ref(
+        self, ref: str, *, sha: str, size: int, chain: list[dict] = None
+    ) -> None:
+        """Points a ref to a new bundle, keeping its protection flag"""
+        entry = {
+            "sha": sha,
+            "bundle": f"{ref}/{sha}.bundle",
+            "size": size,
+            "protected": self.is_protected(ref),
+        }
+        if chain:
+            entry["chain"] = chain
+        self.refs[ref] = entry
+
+    def set_pack_ref(self, ref: str, *, sha: str, pack: str = None) -> None:
+        """Points a ref to a commit of the shared object store
+
+        Args:
+            ref (str): the ref
+            sha (str): the sha of the commit
+            pack (str): the name of the pack holding the commit, or None if the
+                commit is in the packs already listed
+        """
+        names = [p["name"] for p in self.packs]
+        if pack not in names:
+            # The first pack with the commit as tip holds its whole history
+            pack = next((p["name"] for p in self.packs if sha in p["tips"]), None)
+        self.refs[ref] = {
+            "sha": sha,
+            "packs": names.index(pack) + 1 if pack in names else len(names),
+            "protected": self.is_protected(ref),
+        }
+
+    def add_pack(self, pack: dict) -> None:
+        """Appends a pack to the object store, unless it is already listed"""
+        if pack["name"] not in [p["name"] for p in self.packs]:
+            self.packs.append(pack)
+
+    def get_packs(self, ref: str) -> list[dict]:
+        """Gets the packs holding the history of a ref, oldest first
+
+        The objects of a pack are those its pusher did not find in the packs
+        listed before it, so the history of a ref is held by a prefix of the
+        list of packs.
+        """
+        if ref not in self.refs:
+            return []
+        return self.packs[: self.refs[ref].get("packs", len(self.packs))]
+
+    def remove_ref(self, ref: str) -> None:
+        self.refs.pop(ref, None)
+
+    def is_protected(self, ref: str) -> bool:
+        return ref in self.refs and self.refs[ref].get("protected", False)
+
+    def set_protected(self, ref: str, protected: bool) -> None:
+        if ref in self.refs:
+            self.refs[ref]["protected"] = protected
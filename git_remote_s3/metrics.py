@@ -0,0 +1,172 @@
+# SPDX-FileCopyrightText: 2023-present Amazon.com, Inc. or its affiliates
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics:
+    """Timings, request counts and bytes moved by one invocation of a helper.
+
+    Metrics are disabled until `start` is called with the path of the metrics
+    file; until then every method is a no-op. When the helper exits, `write`
+    appends a single JSON record to the file:
+
+        {
+            "process": "git-remote-s3",
+            "pid": 1234,
+            "start": "2024-01-01T00:00:00+00:00",
+            "seconds": 1.2,
+            "commands": {"push": {"count": 2, "seconds": 0.9, "max_seconds": 0.5}},
+            "s3": {"PutObject": {"count": 2, "seconds": 0.4, "max_seconds": 0.3}},
+            "git": {"bundle": {"count": 2, "seconds": 0.3, "max_seconds": 0.2}},
+            "bytes": {"uploaded": 1234, "downloaded": 0},
+            "counters": {"retries.s3": 0, "retries.upload_part": 1}
+        }
+
+    The records of concurrent processes are appended to the same file, one
+    line each, so that they can be aggregated.
+    """
+
+    def __init__(self):
+        self.path = None
+        self._lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, process: str) -> None:
+        self.process = process
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.timings = {"commands": {}, "s3": {}, "git": {}}
+        self.bytes = {"uploaded": 0, "downloaded": 0}
+        self.counters = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def start(self, process: str, path: str) -> None:
+        """Enables the metrics of this invocation
+
+        Args:
+            process (str): the name of the helper, eg git-remote-s3
+            path (str): the file the record is appended to, or None to keep
+                the metrics disabled
+        """
+        with self._lock:
+            self.path = path
+            self._reset(process)
+
+    def record(self, category: str, name: str, seconds: float) -> None:
+        """Records the duration of an operation
+
+        Args:
+            category (str): commands, s3 or git
+            name (str): the name of the operation, eg GetObject
+            seconds (float): the duration of the operation
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            timing = self.timings[category].setdefault(
+                name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0}
+            )
+            timing["count"] += 1
+            timing["seconds"] += seconds
+            timing["max_seconds"] = max(timing["max_seconds"], seconds)
+
+    @contextmanager
+    def timer(self, category: str, name: str):
+        """Records the duration of the enclosed block"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(category, name, time.monotonic() - start)
+
+    def add_bytes(self, direction: str, size: int) -> None:
+        """Adds to the bytes moved between S3 and the local machine
+
+        Args:
+            direction (str): uploaded or downloaded
+            size (int): the number of bytes
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.bytes[direction] += size
+
+    def count(self, name: str, value: int = 1) -> None:
+        """Increments a counter, eg retries.upload_part"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def attach(self, client) -> None:
+        """Records the latency and retries of every call made by a boto3 client
+
+        Args:
+            client: the boto3 client
+        """
+        if not self.enabled:
+            return
+        # First, so that the time spent in the other handlers is included
+        client.meta.events.register_first("before-call.s3.*", self._before_call)
+        client.meta.events.register("after-call.s3.*", self._after_call)
+        client.meta.events.register("after-call-error.s3.*", self._after_call_error)
+
+    def _before_call(self, model, context, **kwargs):
+        context["metrics_call"] = (model.name, time.monotonic())
+
+    def _after_call(self, context, parsed=None, **kwargs):
+        if "metrics_call" in context:
+            name, start = context["metrics_call"]
+            self.record("s3", name, time.monotonic() - start)
+        retries = (parsed or {}).get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        if retries:
+            self.count("retries.s3", retries)
+
+    def _after_call_error(self, context, **kwargs):
+        # Raised when no response was received, eg after exhausting retries
+        if "metrics_call" in context:
+            name, start = context["metrics_call"]
+            self.record("s3", name, time.monotonic() - start)
+            self.count(f"errors.{name}")
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "process": self.process,
+                "pid": os.getpid(),
+                "start": datetime.datetime.fromtimestamp(
+                    self.started_at, datetime.timezone.utc
+                ).isoformat(),
+                "seconds": time.monotonic() - self.started,
+                **{k: dict(v) for k, v in self.timings.items()},
+                "bytes": dict(self.bytes),
+                "counters": dict(self.counters),
+            }
+
+    def write(self) -> None:
+        """Appends the record of this invocation to the metrics file"""
+        if not self.enabled:
+            return
+        try:
+            # A single write of a single line, so that the records of
+            # concurrent processes are not interleaved
+            with open(self.path, "a") as f:
+                f.write(json.dumps(self.to_dict()) + "\n")
+        except OSError as e:
+            logger.info(f"cannot write metrics to {self.path}: {e}")
+
+
+metrics = Metrics()
@@ -4,8 +4,7 @@
 
 import sys
 import logging
-import boto3
-import boto3.exceptions
+import datetime
 from botocore.exceptions import (
     ClientError,
     ProfileNotFound,
@@ -15,11 +14,22 @@ from botocore.exceptions import (
 )
 import re
 import tempfile
+import threading
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from git_remote_s3 import git
 from .enums import UriScheme
 from .common import parse_git_url
-import botocore
+from .cache import ObjectCache, default_cache_dir, DEFAULT_CACHE_SIZE
+from .manifest import Manifest, BUNDLE_LAYOUT, PACK_LAYOUT, MANIFEST_ATTEMPTS
+from .metrics import metrics
+from .settings import Settings
+from .transfer import (
+    MultipartUploader,
+    RangedDownloader,
+    DEFAULT_PART_SIZE,
+    DEFAULT_CONCURRENCY,
+)
 
 logger = logging.getLogger(__name__)
 if "remote" in __name__:
@@ -32,6 +42,16 @@ class BucketNotFoundError(Exception):
         super().__init__(f"Bucket {bucket} not found.")
 
 
+class LayoutMismatchError(Exception):
+    def __init__(self, layout: str):
+        self.layout = layout
+        super().__init__(f"The remote uses the {layout} layout.")
+
+
+class CopyFailedError(Exception):
+    """A managed multipart copy of an object of the bucket failed"""
+
+
 class NotAuthorizedError(Exception):
     def __init__(self, action: str, bucket: str):
         self.bucket = bucket
@@ -41,6 +61,21 @@ class NotAuthorizedError(Exception):
         )
 
 
+DEFAULT_FETCH_CONCURRENCY = 8
+DEFAULT_PUSH_CONCURRENCY = 4
+# Incremental pushes keep the previous bundles of a ref under this marker, as
+# <ref>/CHAIN#/<seq>-<sha>.bundle, the first link being a full bundle
+CHAIN_MARKER = "CHAIN#"
+DEFAULT_COMPACT_LINKS = 16
+DEFAULT_COMPACT_BYTES = 256 * 1024 * 1024
+DEFAULT_PREFETCH_BYTES = 256 * 1024 * 1024
+# Larger objects cannot be copied with a single CopyObject request
+MAX_COPY_OBJECT_SIZE = 5 * 1024**3
+# The pack layout stores the objects of all refs as <prefix>/packs/<name>.pack
+# and <name>.idx, the refs pointing into them from the manifest
+PACKS_FOLDER = "packs"
+
+
 class Mode:
     FETCH = "fetch"
     PUSH = "push"
@@ -49,29 +84,132 @@ class Mode:
 class S3Remote:
     def __init__(self, uri_scheme, profile, bucket, prefix):
         self.uri_scheme = uri_scheme
+        self.layout = PACK_LAYOUT if uri_scheme == UriScheme.S3_PACK else BUNDLE_LAYOUT
         self.profile = profile
         self.bucket = bucket
         self.prefix = prefix
-        if profile:
-            self.session = boto3.Session(profile_name=profile)
-        else:
-            self.session = boto3.Session()
-        self.s3 = self.session.client("s3")
-        try:
-            self.s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
-        except ClientError as e:
-            if e.response["Error"]["Code"] == "NoSuchBucket":
-                raise BucketNotFoundError(bucket)
-            if e.response["Error"]["Code"] == "AccessDenied":
-                raise NotAuthorizedError("ListObjectsV2", bucket)
-            raise e
+        self.settings = Settings("s3", "GIT_REMOTE_S3_")
+        self.fetch_concurrency = max(
+            1, self.settings.get_int("fetchConcurrency", DEFAULT_FETCH_CONCURRENCY)
+        )
+        self.push_concurrency = max(
+            1, self.settings.get_int("pushConcurrency", DEFAULT_PUSH_CONCURRENCY)
+        )
+        self.multipart_chunk_size = self.settings.get_int(
+            "multipartChunkSize", DEFAULT_PART_SIZE
+        )
+        self.multipart_concurrency = max(
+            1, self.settings.get_int("multipartConcurrency", DEFAULT_CONCURRENCY)
+        )
+        self.download_chunk_size = self.settings.get_int(
+            "downloadChunkSize", DEFAULT_PART_SIZE
+        )
+        self.download_concurrency = max(
+            1, self.settings.get_int("downloadConcurrency", DEFAULT_CONCURRENCY)
+        )
+        self.incremental = self.settings.get_bool("incremental", False)
+        self.compact_links = self.settings.get_int(
+            "compactLinks", DEFAULT_COMPACT_LINKS
+        )
+        self.compact_bytes = self.settings.get_int(
+            "compactBytes", DEFAULT_COMPACT_BYTES
+        )
+        self.prefetch = self.settings.get_bool("prefetch", False)
+        self.prefetch_bytes = self.settings.get_int(
+            "prefetchBytes", DEFAULT_PREFETCH_BYTES
+        )
+        self.cache = None
+        if self.settings.get_bool("cache", False):
+            self.cache = ObjectCache(
+                self.settings.get("cacheDir") or default_cache_dir("bundles"),
+                self.settings.get_int("cacheSize", DEFAULT_CACHE_SIZE),
+            )
+        self._s3 = None
+        self._uploader = None
+        self._downloader = None
+        self._client_lock = threading.Lock()
+        self.closing = threading.Event()
 
         self.bucket = bucket
         self.mode = None
         self.fetched_refs = []
+        self.fetch_cmds = []
         self.push_cmds = []
+        self.head_lock = threading.Lock()
+        self.head_exists = False
+        self.ref_objects = None
+        self.ref_objects_lock = threading.Lock()
+        self.bundle_sources = {}
+        self.bundle_sources_lock = threading.Lock()
+        self.prefetch_executor = None
+        self.prefetch_plan = None
+        self.prefetch_dir = None
+        self.prefetches = {}
+        self.prefetches_lock = threading.Lock()
+        self.manifest = None
+        self.manifest_loaded = False
+        self.manifest_updates = {}
+        # The objects replaced by the batch, deleted once the manifest is written
+        self.superseded = {}
+        self.manifest_lock = threading.Lock()
 
-    def list_refs(self, *, bucket: str, prefix: str) -> list:
+    @property
+    def s3(self):
+        """The S3 client, created on first use
+
+        boto3 is only imported here, so that git gets the answer to the
+        capabilities and option commands without paying for it.
+        """
+        if self._s3 is None:
+            with self._client_lock:
+                if self._s3 is None:
+                    self._s3 = self.create_client()
+        return self._s3
+
+    def create_client(self):
+        import boto3
+        import botocore.config
+
+        if self.profile:
+            session = boto3.Session(profile_name=self.profile)
+        else:
+            session = boto3.Session()
+        # boto3 clients are thread safe, the pool is sized for the workers
+        s3 = session.client(
+            "s3",
+            config=botocore.config.Config(
+                max_pool_connections=max(
+                    10,
+                    self.fetch_concurrency * self.download_concurrency,
+                    self.push_concurrency * self.multipart_concurrency,
+                )
+            ),
+        )
+        metrics.attach(s3)
+        return s3
+
+    @property
+    def uploader(self) -> MultipartUploader:
+        if self._uploader is None:
+            self._uploader = MultipartUploader(
+                self.s3,
+                part_size=self.multipart_chunk_size,
+                concurrency=self.multipart_concurrency,
+            )
+        return self._uploader
+
+    @property
+    def downloader(self) -> RangedDownloader:
+        if self._downloader is None:
+            self._downloader = RangedDownloader(
+                self.s3,
+                part_size=self.download_chunk_size,
+                concurrency=self.download_concurrency,
+                cancelled=self.closing,
+            )
+        return self._downloader
+
+    def list_objects(self, *, bucket: str, prefix: str) -> list[dict]:
         res = self.s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
         contents = res.get("Contents", [])
         next_token = res.get("NextContinuationToken", None)
@@ -82,57 +220,573 @@ class S3Remote:
             )
             contents.extend(res.get("Contents", []))
             next_token = res.get("NextContinuationToken", None)
+        return contents
+
+    def list_refs(self, *, bucket: str, prefix: str) -> list:
+        # Only the refs are listed, not the LFS objects and archives of the repo.
+        # The namespaces under refs/ (heads, tags, ...) are found with a single
+        # delimited request, a repo having only a handful of them, and then
+        # listed in parallel.
+        res = self.s3.list_objects_v2(
+            Bucket=bucket, Prefix=f"{prefix}/refs/", Delimiter="/"
+        )
+        contents = res.get("Contents", [])
+        namespaces = [p["Prefix"] for p in res.get("CommonPrefixes", [])]
+        if namespaces:
+            with ThreadPoolExecutor(
+                max_workers=min(self.fetch_concurrency, len(namespaces))
+            ) as executor:
+                for objs in executor.map(
+                    lambda p: self.list_objects(bucket=bucket, prefix=p), namespaces
+                ):
+                    contents.extend(objs)
 
         contents.sort(key=lambda x: x["LastModified"])
         contents.reverse()
+        # The listing is kept for the session, so that a push following the
+        # list for-push command needs no further listing per ref
+        ref_objects = {}
+        for o in contents:
+            ref_objects.setdefault(ref_of_key(o["Key"], prefix), []).append(o)
+        with self.ref_objects_lock:
+            self.ref_objects = ref_objects
 
         objs = [
             o["Key"].removeprefix(prefix)[1:]
             for o in contents
-            if o["Key"].startswith(prefix + "/refs") and o["Key"].endswith(".bundle")
+            if o["Key"].startswith(prefix + "/refs")
+            and o["Key"].endswith(".bundle")
+            and f"/{CHAIN_MARKER}/" not in o["Key"]
         ]
         return objs
 
-    def cmd_fetch(self, args: str):
-        sha, ref = args.split(" ")[1:]
-        if sha in self.fetched_refs:
+    def prefetch_refs(self) -> None:
+        """Lists the objects of all the refs once, when a push batch starts
+
+        Without a manifest, pushing a ref needs its bundles, chain and
+        protection flag. They are read from this listing instead of listing
+        each ref.
+        """
+        if self.layout == PACK_LAYOUT or self.get_manifest() is not None:
             return
-        logger.info(f"fetch {sha} {ref}")
-        try:
-            temp_dir = tempfile.mkdtemp(prefix="git_remote_s3_fetch_")
-            obj = self.s3.get_object(
-                Bucket=self.bucket, Key=f"{self.prefix}/{ref}/{sha}.bundle"
+        with self.ref_objects_lock:
+            if self.ref_objects is not None:
+                return
+        self.list_refs(bucket=self.bucket, prefix=self.prefix)
+
+    def get_ref_objects(self, remote_ref: str) -> list[dict]:
+        """Lists the objects stored under a ref
+
+        Args:
+            remote_ref (str): the remote ref
+
+        Returns:
+            list[dict]: the objects, from the session listing if the refs were
+            prefetched
+        """
+        with self.ref_objects_lock:
+            if self.ref_objects is not None:
+                return list(self.ref_objects.get(remote_ref, []))
+        # We are not implementing pagination since there can be few objects
+        # under a single ref
+        return self.s3.list_objects_v2(
+            Bucket=self.bucket, Prefix=f"{self.prefix}/{remote_ref}/"
+        ).get("Contents", [])
+
+    def update_ref_objects(self, remote_ref: str, objects: list[dict]) -> None:
+        """Replaces the objects of a ref in the session listing after a push
+
+        Args:
+            remote_ref (str): the remote ref
+            objects (list[dict]): the new objects of the ref, besides its
+                protection flag and archive which are kept
+        """
+        with self.ref_objects_lock:
+            if self.ref_objects is None:
+                return
+            now = datetime.datetime.now(datetime.timezone.utc)
+            kept = [
+                o
+                for o in self.ref_objects.get(remote_ref, [])
+                if o["Key"].endswith(("/PROTECTED#", "/repo.zip"))
+            ]
+            objects = [{"LastModified": now, **o} for o in objects]
+            if objects:
+                self.ref_objects[remote_ref] = objects + kept
+            else:
+                self.ref_objects.pop(remote_ref, None)
+
+    def get_manifest(self) -> Manifest:
+        """Gets the manifest of the remote, read once per session
+
+        Returns:
+            Manifest: the manifest or None if the remote has none, in which case
+            refs are found by listing the prefix
+        """
+        with self.manifest_lock:
+            if not self.manifest_loaded:
+                self.manifest = Manifest.load(self.s3, self.bucket, self.prefix)
+                self.manifest_loaded = True
+                logger.info(f"manifest found: {self.manifest is not None}")
+            if self.manifest is not None and self.manifest.layout != self.layout:
+                raise LayoutMismatchError(self.manifest.layout)
+            return self.manifest
+
+    def record_ref_update(
+        self,
+        ref: str,
+        *,
+        previous_sha: str,
+        sha: str = None,
+        size: int = 0,
+        chain: list[dict] = None,
+        pack: dict = None,
+    ) -> None:
+        """Records a pushed or removed ref, to be written to the manifest
+
+        Args:
+            ref (str): the remote ref
+            previous_sha (str): the sha of the ref before the push, if any
+            sha (str): the new sha of the ref or None if the ref was removed
+            size (int): the size of the new bundle
+            chain (list[dict]): the links of the incremental chain of the ref
+            pack (dict): with the pack layout, the pack uploaded with the ref
+        """
+        with self.manifest_lock:
+            self.manifest_updates[ref] = {
+                "previous_sha": previous_sha,
+                "sha": sha,
+                "size": size,
+                "chain": chain,
+                "pack": pack,
+            }
+
+    def delete_after_manifest(self, ref: str, keys: list[str]) -> None:
+        """Records the objects replaced by a pushed or removed ref
+
+        They are deleted once the manifest no longer points to them, so that
+        clients reading the manifest in the meantime still find them.
+
+        Args:
+            ref (str): the remote ref
+            keys (list[str]): the keys of the objects
+        """
+        with self.manifest_lock:
+            self.superseded.setdefault(ref, []).extend(keys)
+
+    def write_manifest(self, results: list[str]) -> list[str]:
+        """Writes the refs updated by a push batch to the manifest
+
+        The manifest is read again right before being written, and written only
+        if no other client wrote it in the meantime, so that refs pushed by
+        other clients are kept: when it was, it is read and updated again. A ref
+        that another client changed concurrently is reported as an error, and
+        left for `git-s3 doctor` to fix.
+
+        Args:
+            results (list[str]): the result lines of the batch
+
+        Returns:
+            list[str]: the result lines, with conflicting refs turned to errors
+        """
+        with self.manifest_lock:
+            updates, self.manifest_updates = self.manifest_updates, {}
+            superseded, self.superseded = self.superseded, {}
+        if not updates:
+            return results
+
+        for _ in range(MANIFEST_ATTEMPTS):
+            manifest = self.load_manifest_for_update()
+            conflicts = self.apply_manifest_updates(manifest, updates)
+            if manifest.save(self.s3, self.bucket, self.prefix):
+                with self.manifest_lock:
+                    self.manifest = manifest
+                    self.manifest_loaded = True
+                # The objects of conflicting refs are left for git-s3 doctor
+                for ref, keys in superseded.items():
+                    if ref not in conflicts:
+                        for key in keys:
+                            self.s3.delete_object(Bucket=self.bucket, Key=key)
+                break
+        else:
+            logger.info("the manifest keeps being written concurrently")
+            conflicts = list(updates)
+            with self.manifest_lock:
+                self.manifest_loaded = False
+
+        return [
+            (
+                f'error {r.split(" ")[1].strip()} "concurrent push detected. Run git-s3 doctor to fix."?\n'  # noqa: B950
+                if r.split(" ")[1].strip() in conflicts
+                else r
             )
-            data = obj["Body"].read()
+            for r in results
+        ]
+
+    def load_manifest_for_update(self) -> Manifest:
+        """Reads the current manifest of the remote, to update it
+
+        Returns:
+            Manifest: the manifest, or a new one built from the listing of the
+            refs if the remote has none yet
+        """
+        manifest = Manifest.load(self.s3, self.bucket, self.prefix)
+        if manifest is None and self.layout == PACK_LAYOUT:
+            manifest = Manifest(layout=PACK_LAYOUT)
+        elif manifest is None:
+            # First push with a manifest aware client, the listing already
+            # includes the refs of this batch
+            manifest = Manifest.from_objects(
+                self.list_objects(bucket=self.bucket, prefix=f"{self.prefix}/refs/"),
+                self.prefix,
+            )
+        return manifest
+
+    def apply_manifest_updates(self, manifest: Manifest, updates: dict) -> list[str]:
+        """Applies the refs updated by a push batch to a manifest
+
+        Args:
+            manifest (Manifest): the manifest to update
+            updates (dict): the updates recorded for each ref
 
-            with open(f"{temp_dir}/{sha}.bundle", "wb") as f:
-                f.write(data)
-            logger.info(f"fetched {temp_dir}/{sha}.bundle {ref}")
+        Returns:
+            list[str]: the refs changed concurrently, which are not updated
+        """
+        conflicts = []
+        for ref, update in updates.items():
+            if manifest.get_sha(ref) not in [update["previous_sha"], update["sha"]]:
+                logger.info(f"{ref} was changed concurrently")
+                conflicts.append(ref)
+            elif update["sha"] is None:
+                manifest.remove_ref(ref)
+            elif self.layout == PACK_LAYOUT:
+                if update["pack"] is not None:
+                    manifest.add_pack(update["pack"])
+                pack = update["pack"]["name"] if update["pack"] else None
+                manifest.set_pack_ref(ref, sha=update["sha"], pack=pack)
+            else:
+                manifest.set_ref(
+                    ref, sha=update["sha"], size=update["size"], chain=update["chain"]
+                )
+        return conflicts
+
+    def download_object(self, *, key: str, path: str) -> dict:
+        """Downloads an object to a local file
+
+        When the local cache is enabled, the object is copied from the cache if
+        it holds the current version of the object, as identified by its ETag.
 
-            git.unbundle(folder=temp_dir, sha=sha, ref=ref)
-            self.fetched_refs.append(sha)
+        Args:
+            key (str): the key of the object
+            path (str): the path of the file to write
+
+        Returns:
+            dict: the user metadata of the object
+        """
+        try:
+            if self.cache is not None:
+                etag = self.s3.head_object(Bucket=self.bucket, Key=key)["ETag"]
+                metadata = self.cache.get(
+                    bucket=self.bucket, key=key, etag=etag, path=path
+                )
+                if metadata is not None:
+                    metrics.count("cache.hit")
+                    return metadata
+                metrics.count("cache.miss")
+            obj = self.downloader.download(bucket=self.bucket, key=key, path=path)
         except ClientError as e:
-            if e.response["Error"]["Code"] == "AccessDenied":
+            if e.response["Error"]["Code"] in ["AccessDenied", "403"]:
                 raise NotAuthorizedError("GetObject", self.bucket)
             raise e
-        finally:
-            if os.path.exists(f"{temp_dir}/{sha}.bundle"):
-                os.remove(f"{temp_dir}/{sha}.bundle")
+        logger.info(f"fetched {key} to {path}")
+        metadata = obj.get("Metadata", {})
+        if self.cache is not None:
+            self.cache.put(
+                bucket=self.bucket,
+                key=key,
+                etag=obj["ETag"],
+                path=path,
+                metadata=metadata,
+            )
+        return metadata
+
+    def download_bundle(self, *, folder: str, sha: str, ref: str) -> list[str]:
+        """Downloads the bundles needed to fetch a ref to the folder
+
+        If the bundle of the ref is incremental, the links of its chain are
+        downloaded too, from the newest until one whose prerequisite is already
+        present in the local repo.
+
+        Args:
+            folder (str): the folder where the bundles are stored as sha.bundle
+            sha (str): the sha of the ref
+            ref (str): the ref to fetch
+
+        Returns:
+            list[str]: the shas of the downloaded bundles, in the order in which
+            they must be unbundled
+        """
+        metadata = self.download_object(
+            key=f"{self.prefix}/{ref}/{sha}.bundle", path=f"{folder}/{sha}.bundle"
+        )
+        shas = [sha]
+        chain_length = int(metadata.get("chain-length", 0))
+        if chain_length > 0:
+            # Links beyond the chain length are leftovers of an interrupted push
+            for link in reversed(self.get_chain_for_ref(ref)[:chain_length]):
+                link_sha = chain_link_sha(link["Key"])
+                if git.object_exists(link_sha):
+                    break
+                self.download_object(
+                    key=link["Key"], path=f"{folder}/{link_sha}.bundle"
+                )
+                shas.insert(0, link_sha)
+        return shas
+
+    def cmd_fetch(self, args: str):
+        self.fetch_batch([args])
+
+    def fetch_batch(self, cmds: list[str]):
+        """Fetches the refs of a batch of fetch commands
+
+        Bundles are downloaded concurrently and each one is unbundled as soon as
+        its download completes, while the other downloads are still running.
+
+        Args:
+            cmds (list[str]): the fetch commands, as `fetch <sha> <ref>`
+        """
+        to_fetch = {}
+        for cmd in cmds:
+            sha, ref = cmd.split(" ")[1:]
+            if sha not in self.fetched_refs and sha not in to_fetch:
+                to_fetch[sha] = ref
+        if not to_fetch:
+            return
+        logger.info(f"fetch {to_fetch}")
+        if self.layout == PACK_LAYOUT:
+            self.fetch_packs(to_fetch)
+        else:
+            self.fetch_bundles(to_fetch)
+
+    def fetch_bundles(self, to_fetch: dict) -> None:
+        """Fetches refs from their bundles
+
+        Args:
+            to_fetch (dict): the refs to fetch, by sha
+        """
+        with tempfile.TemporaryDirectory(
+            prefix="git_remote_s3_fetch_"
+        ) as temp_dir, ThreadPoolExecutor(
+            max_workers=min(self.fetch_concurrency, len(to_fetch))
+        ) as executor:
+            futures = {}
+            for sha, ref in to_fetch.items():
+                # Each ref gets its own folder since chains may share links
+                os.mkdir(f"{temp_dir}/{sha}")
+                future = executor.submit(
+                    self.fetch_bundle, folder=f"{temp_dir}/{sha}", sha=sha, ref=ref
+                )
+                futures[future] = sha
+            try:
+                for future in as_completed(futures):
+                    sha = futures[future]
+                    folder, shas = future.result()
+                    for bundle_sha in shas:
+                        git.unbundle(folder=folder, sha=bundle_sha, ref=to_fetch[sha])
+                        os.remove(f"{folder}/{bundle_sha}.bundle")
+                    self.fetched_refs.append(sha)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def fetch_packs(self, to_fetch: dict) -> None:
+        """Fetches refs from the shared object store of the pack layout
+
+        Only the packs holding objects missing locally are downloaded: a pack
+        is complete locally once all of its tips are, since git keeps the
+        history of every object it has.
+
+        Args:
+            to_fetch (dict): the refs to fetch, by sha
+        """
+        manifest = self.get_manifest()
+        if manifest is None:
+            raise LayoutMismatchError(BUNDLE_LAYOUT)
+        packs = {}
+        for ref in to_fetch.values():
+            for pack in manifest.get_packs(ref):
+                packs[pack["name"]] = pack
+        missing = set(
+            git.missing_objects([t for p in packs.values() for t in p["tips"]])
+        )
+        needed = [p for p in packs.values() if missing.intersection(p["tips"])]
+        logger.info(f"fetching packs {[p['name'] for p in needed]}")
+        if needed:
+            pack_dir = git.pack_dir()
+            # Downloaded next to the packs of the repo, to be renamed into place
+            with tempfile.TemporaryDirectory(
+                prefix="tmp_git_remote_s3_", dir=pack_dir
+            ) as temp_dir, ThreadPoolExecutor(
+                max_workers=min(self.fetch_concurrency, len(needed))
+            ) as executor:
+                futures = [
+                    executor.submit(self.download_pack, folder=temp_dir, name=p["name"])
+                    for p in needed
+                ]
+                try:
+                    for future in as_completed(futures):
+                        name = future.result()
+                        # git finds packs by their index, which comes last
+                        for ext in ["pack", "idx"]:
+                            os.replace(
+                                f"{temp_dir}/{name}.{ext}", f"{pack_dir}/{name}.{ext}"
+                            )
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        self.fetched_refs.extend(to_fetch)
+
+    def download_pack(self, *, folder: str, name: str) -> str:
+        """Downloads a pack to the folder and indexes it
+
+        The index is built locally rather than downloaded, which checks every
+        object of the pack, as unbundling does for bundles.
+
+        Raises:
+            GitError: if the pack is corrupted or is not the pack of the name
+
+        Returns:
+            str: the name of the pack
+        """
+        path = f"{folder}/{name}.pack"
+        self.download_object(key=f"{self.prefix}/{PACKS_FOLDER}/{name}.pack", path=path)
+        checksum = git.index_pack(path)
+        if name != f"pack-{checksum}":
+            raise git.GitError(f"{name} has the checksum {checksum}")
+        return name
+
+    def fetch_bundle(self, *, folder: str, sha: str, ref: str) -> tuple[str, list]:
+        """Gets the bundles needed to fetch a ref, prefetched or downloaded
+
+        Args:
+            folder (str): the folder to download the bundles to
+            sha (str): the sha of the ref
+            ref (str): the ref to fetch
+
+        Returns:
+            tuple[str, list]: the folder holding the bundles and their shas, in
+            the order in which they must be unbundled
+        """
+        prefetch = self.take_prefetch(sha)
+        if prefetch is not None:
+            try:
+                return prefetch.result()
+            except Exception as e:
+                logger.info(f"prefetch of {sha} failed, downloading again: {e}")
+        return folder, self.download_bundle(folder=folder, sha=sha, ref=ref)
+
+    def start_prefetch(self, refs: list[tuple[str, str]]) -> None:
+        """Starts downloading the bundles of the listed refs in the background
+
+        The downloads overlap with the negotiation of git, which only sends the
+        fetch commands after reading the list.
+
+        Args:
+            refs (list[tuple[str, str]]): the sha and ref of the listed refs,
+                by priority
+        """
+        self.prefetch_dir = tempfile.TemporaryDirectory(
+            prefix="git_remote_s3_prefetch_", ignore_cleanup_errors=True
+        )
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=self.fetch_concurrency)
+        self.prefetch_plan = self.prefetch_executor.submit(self.plan_prefetch, refs)
+
+    def plan_prefetch(self, refs: list[tuple[str, str]]) -> None:
+        """Schedules the download of the refs missing locally, within the budget"""
+        missing = set(git.missing_objects([sha for sha, _ in refs]))
+        budget = self.prefetch_bytes
+        for sha, ref in refs:
+            if self.closing.is_set():
+                return
+            with self.prefetches_lock:
+                if sha not in missing or sha in self.prefetches:
+                    continue
+            # An incremental ref downloads its chain along with its bundle
+            bundles = self.get_bundles_for_ref(ref) + self.get_chain_for_ref(ref)
+            size = sum(b.get("Size", 0) for b in bundles)
+            if size > budget:
+                continue
+            budget -= size
+            folder = f"{self.prefetch_dir.name}/{sha}"
+            os.mkdir(folder)
+            with self.prefetches_lock:
+                self.prefetches[sha] = self.prefetch_executor.submit(
+                    self.prefetch_bundle, folder=folder, sha=sha, ref=ref
+                )
+        with self.prefetches_lock:
+            logger.info(f"prefetching {list(self.prefetches)}")
+
+    def prefetch_bundle(self, *, folder: str, sha: str, ref: str) -> tuple[str, list]:
+        return folder, self.download_bundle(folder=folder, sha=sha, ref=ref)
+
+    def take_prefetch(self, sha: str):
+        """Gets the prefetch of a sha, if one was started
+
+        Returns:
+            Future: the prefetch or None
+        """
+        if self.prefetch_plan is None:
+            return None
+        # The plan must be complete, not to download a bundle twice
+        try:
+            self.prefetch_plan.result()
+        except Exception as e:
+            logger.info(f"prefetch failed: {e}")
+        with self.prefetches_lock:
+            return self.prefetches.pop(sha, None)
+
+    def close(self) -> None:
+        """Stops the prefetches and removes the bundles they downloaded
+
+        Prefetches of refs that git did not fetch are abandoned rather than
+        awaited: the queued ones are cancelled, and the running ones stop at
+        their next chunk, failing to write once their folder is removed.
+        """
+        if self.prefetch_executor is not None:
+            self.closing.set()
+            self.prefetch_executor.shutdown(wait=False, cancel_futures=True)
+            self.prefetch_dir.cleanup()
 
     def remove_remote_ref(self, remote_ref: str) -> str:
         logger.info(f"Removing remote ref {remote_ref}")
         try:
-            objects_to_delete = self.s3.list_objects_v2(
-                Bucket=self.bucket, Prefix=f"{self.prefix}/{remote_ref}"
-            ).get("Contents", [])
+            objects_to_delete = self.get_ref_objects(remote_ref)
+            ref_objects = [
+                o for o in objects_to_delete if f"/{CHAIN_MARKER}/" not in o["Key"]
+            ]
             if (
                 self.uri_scheme == UriScheme.S3
-                and len(objects_to_delete) == 1
+                and len(ref_objects) == 1
                 or self.uri_scheme == UriScheme.S3_ZIP
-                and len(objects_to_delete) == 2
+                and len(ref_objects) == 2
             ):
-                for object in objects_to_delete:
-                    self.s3.delete_object(Bucket=self.bucket, Key=object["Key"])
+                self.delete_after_manifest(
+                    remote_ref, [o["Key"] for o in objects_to_delete]
+                )
+                with self.ref_objects_lock:
+                    if self.ref_objects is not None:
+                        self.ref_objects.pop(remote_ref, None)
+                bundles = [o for o in ref_objects if o["Key"].endswith(".bundle")]
+                self.record_ref_update(
+                    remote_ref,
+                    previous_sha=(
+                        bundles[0]["Key"].split("/")[-1].split(".")[0]
+                        if bundles
+                        else None
+                    ),
+                )
                 return f"ok {remote_ref}\n"
             else:
                 return f"error {remote_ref} not found\n"
@@ -154,64 +808,527 @@ class S3Remote:
             local_ref = local_ref[1:]
 
         logger.info(f"push !{local_ref}! !{remote_ref}!")
-        temp_dir = tempfile.mkdtemp(prefix="git_remote_s3_push_")
 
         contents = self.get_bundles_for_ref(remote_ref)
         if len(contents) > 1:
             return f'error {remote_ref} "multiple bundles exists on server. Run git-s3 doctor to fix."?\n'  # noqa: B950
 
-        remote_to_remove = contents[0]["Key"] if len(contents) == 1 else None
+        tip = contents[0] if contents else None
 
         try:
             sha = git.rev_parse(local_ref)
-            if remote_to_remove:
-                remote_sha = remote_to_remove.split("/")[-1].split(".")[0]
-                if not force_push and not git.is_ancestor(remote_sha, sha):
+            fast_forward = False
+            if tip:
+                remote_sha = tip["Key"].split("/")[-1].split(".")[0]
+                if remote_sha == sha:
+                    logger.info(f"{remote_ref} is up to date")
+                    return f"ok {remote_ref}\n"
+                fast_forward = git.is_ancestor(remote_sha, sha)
+                if not force_push and not fast_forward:
                     return f'error {remote_ref} "remote ref is not ancestor of {local_ref}."?\n'
-
-            temp_file = git.bundle(folder=temp_dir, sha=sha, ref=local_ref)
-
-            with open(temp_file, "rb") as f:
-                self.s3.put_object(
-                    Bucket=self.bucket,
-                    Key=f"{self.prefix}/{remote_ref}/{sha}.bundle",
-                    Body=f,
-                )
-            self.init_remote_head(remote_ref)
-            logger.info(f"pushed {temp_file} to {remote_ref}")
-            if remote_to_remove:
-                self.s3.delete_object(Bucket=self.bucket, Key=remote_to_remove)
-
-            if self.uri_scheme == UriScheme.S3_ZIP:
-                # Create and push a zip archive next to the bundle file
-                # Example use-case: Repo on S3 as Source for AWS CodePipeline
-                commit_msg = git.get_last_commit_message()
-                temp_file_archive = git.archive(folder=temp_dir, ref=local_ref)
-                with open(temp_file_archive, "rb") as f:
-                    self.s3.put_object(
-                        Bucket=self.bucket,
-                        Key=f"{self.prefix}/{remote_ref}/repo.zip",
-                        Body=f,
-                        Metadata={"codepipeline-artifact-revision-summary": commit_msg},
-                        ContentDisposition=f"attachment; filename=repo-{sha[:8]}.zip",
-                    )
-                logger.info(
-                    f"pushed {temp_file_archive} to {self.prefix}/{remote_ref}/repo.zip with message {commit_msg}"
-                )
-
-            return f"ok {remote_ref}\n"
+            return self.push_ref(
+                local_ref=local_ref,
+                remote_ref=remote_ref,
+                sha=sha,
+                tip=tip,
+                fast_forward=fast_forward,
+            )
         except git.GitError:
             logger.info(f"fatal: {local_ref} not found\n")
             return f'error {remote_ref} "{local_ref} not found"?\n'
-        except boto3.exceptions.S3UploadFailedError as e:
+        except (ClientError, CopyFailedError) as e:
             logger.info(f"fatal: {e}\n")
             return f'error {remote_ref} "{e}"?\n'
-        except botocore.exceptions.ClientError as e:
+
+    def push_ref(
+        self,
+        *,
+        local_ref: str,
+        remote_ref: str,
+        sha: str,
+        tip: dict,
+        fast_forward: bool,
+    ) -> str:
+        """Pushes a ref that the remote does not have yet at this sha
+
+        The new bundle is incremental, a copy of a bundle of the same commit,
+        or a new full bundle. It replaces the current bundle of the ref.
+
+        Args:
+            local_ref (str): the local ref to push
+            remote_ref (str): the remote ref
+            sha (str): the sha of the local ref
+            tip (dict): the current bundle of the remote ref, if any
+            fast_forward (bool): true if the current bundle is an ancestor
+
+        Returns:
+            str: the result line of the push
+        """
+        chain = self.get_chain_for_ref(remote_ref) if tip else []
+        incremental = (
+            tip is not None
+            and self.incremental
+            and fast_forward
+            and not self.needs_compaction(tip, chain)
+        )
+        key = f"{self.prefix}/{remote_ref}/{sha}.bundle"
+        source = None
+        new_chain = []
+        if incremental:
+            size, new_chain = self.push_incremental_bundle(
+                local_ref=local_ref, remote_ref=remote_ref, key=key, tip=tip, chain=chain
+            )
+        else:
+            # A full bundle of the same commit is copied instead of bundled
+            source = self.get_bundle_source(sha)
+            size = self.push_full_bundle(local_ref=local_ref, key=key, source=source)
+        logger.info(f"pushed {sha}.bundle to {remote_ref}")
+        if tip:
+            self.delete_after_manifest(remote_ref, [tip["Key"]])
+        if not incremental:
+            # A full bundle replaces the whole chain
+            self.delete_after_manifest(remote_ref, [link["Key"] for link in chain])
+        self.record_ref_update(
+            remote_ref,
+            previous_sha=tip["Key"].split("/")[-1].split(".")[0] if tip else None,
+            sha=sha,
+            size=size,
+            chain=new_chain,
+        )
+        self.update_ref_objects(
+            remote_ref,
+            [{"Key": key, "Size": size}]
+            + [
+                {"Key": f"{self.prefix}/{link['key']}", "Size": link["size"]}
+                for link in new_chain
+            ],
+        )
+
+        archive = {}
+        if self.uri_scheme == UriScheme.S3_ZIP:
+            archive = self.push_archive(
+                local_ref=local_ref, remote_ref=remote_ref, sha=sha, source=source
+            )
+        if not incremental and not source:
+            self.add_bundle_source(sha, {"Key": key, "Size": size} | archive)
+        return f"ok {remote_ref}\n"
+
+    def push_incremental_bundle(
+        self, *, local_ref: str, remote_ref: str, key: str, tip: dict, chain: list
+    ) -> tuple[int, list[dict]]:
+        """Pushes a bundle of the commits since the current bundle of a ref
+
+        The current bundle becomes the newest link of the chain of the ref.
+
+        Args:
+            local_ref (str): the local ref to push
+            remote_ref (str): the remote ref
+            key (str): the key of the new bundle
+            tip (dict): the current bundle of the ref
+            chain (list): the links of the chain of the ref, oldest first
+
+        Returns:
+            tuple[int, list[dict]]: the size of the bundle and the links of the
+            new chain, as recorded in the manifest
+        """
+        remote_sha = tip["Key"].split("/")[-1].split(".")[0]
+        link_key = (
+            f"{self.prefix}/{remote_ref}/{CHAIN_MARKER}/"
+            f"{len(chain):06d}-{remote_sha}.bundle"
+        )
+        self.copy_object(
+            source=tip["Key"], key=link_key, size=tip["Size"], etag=tip.get("ETag")
+        )
+        with git.bundle_stream(ref=local_ref, exclude=[remote_sha]) as f:
+            size = self.uploader.upload(
+                f,
+                bucket=self.bucket,
+                key=key,
+                Metadata={"chain-length": str(len(chain) + 1)},
+            )
+        new_chain = [
+            {"key": c["Key"].removeprefix(f"{self.prefix}/"), "size": c["Size"]}
+            for c in chain + [{"Key": link_key, "Size": tip["Size"]}]
+        ]
+        return size, new_chain
+
+    def push_full_bundle(self, *, local_ref: str, key: str, source: dict) -> int:
+        """Pushes a full bundle of a ref
+
+        Args:
+            local_ref (str): the local ref to push
+            key (str): the key of the bundle
+            source (dict): a full bundle of the same commit on the remote, to
+                copy server side, or None
+
+        Returns:
+            int: the size of the bundle
+        """
+        if source:
+            self.copy_object(
+                source=source["Key"],
+                key=key,
+                size=source["Size"],
+                etag=source.get("ETag"),
+            )
+            return source["Size"]
+        # The bundle is streamed from git to S3 without touching the disk
+        with git.bundle_stream(ref=local_ref, exclude=[]) as f:
+            return self.uploader.upload(f, bucket=self.bucket, key=key)
+
+    def push_archive(
+        self, *, local_ref: str, remote_ref: str, sha: str, source: dict
+    ) -> dict:
+        """Pushes the zip archive of a ref next to its bundle
+
+        Example use-case: Repo on S3 as Source for AWS CodePipeline
+
+        Args:
+            local_ref (str): the local ref to push
+            remote_ref (str): the remote ref
+            sha (str): the sha of the ref
+            source (dict): the bundle copied for the ref, with its archive if
+                it has one, or None
+
+        Returns:
+            dict: the key and size of the archive, for other refs to copy
+        """
+        zip_key = f"{self.prefix}/{remote_ref}/repo.zip"
+        if source and source.get("Zip"):
+            self.copy_object(source=source["Zip"], key=zip_key, size=source["ZipSize"])
+            return {"Zip": zip_key, "ZipSize": source["ZipSize"]}
+        commit_msg = git.get_last_commit_message()
+        with git.archive_stream(ref=local_ref) as f:
+            zip_size = self.uploader.upload(
+                f,
+                bucket=self.bucket,
+                key=zip_key,
+                Metadata={"codepipeline-artifact-revision-summary": commit_msg},
+                ContentDisposition=f"attachment; filename=repo-{sha[:8]}.zip",
+            )
+        logger.info(f"pushed repo.zip to {zip_key} with message {commit_msg}")
+        return {"Zip": zip_key, "ZipSize": zip_size}
+
+    def push_batch(self, cmds: list[str]) -> list[str]:
+        """Pushes the refs of a batch of push commands
+
+        The refs are pushed concurrently, so that the git work and the uploads of
+        different refs overlap.
+
+        Args:
+            cmds (list[str]): the push commands, as `push <src>:<dst>`
+
+        Returns:
+            list[str]: the result lines, in the order of the commands
+        """
+        head_candidates = self.head_candidates(cmds)
+        if self.layout == PACK_LAYOUT:
+            results = self.push_packs(cmds)
+        else:
+            self.prefetch_refs()
+            first, then = self.plan_push(cmds)
+            results = {}
+            with ThreadPoolExecutor(
+                max_workers=min(self.push_concurrency, len(cmds))
+            ) as executor:
+                # The refs that can copy a bundle wait for the bundles to be pushed
+                for step in [first, then]:
+                    results.update(zip(step, executor.map(self.cmd_push, step)))
+        pushed = [cmd for cmd in head_candidates if results[cmd].startswith("ok")]
+        if pushed:
+            try:
+                self.init_remote_head(pushed[0].split(":")[-1])
+            except ClientError as e:
+                # The refs are pushed, a remote without HEAD can still be cloned
+                # with --branch
+                logger.error(f"cannot set the remote HEAD: {e}")
+        return self.write_manifest([results[cmd] for cmd in cmds])
+
+    def head_candidates(self, cmds: list[str]) -> list[str]:
+        """Orders the commands of a batch by preference for the remote HEAD
+
+        The refs are pushed concurrently, so the HEAD of a new remote is not
+        left to the first upload to complete: it points to the first branch
+        of the batch, or to its first ref if it has no branch.
+
+        Returns:
+            list[str]: the commands that push a ref, branches first
+        """
+        pushes = [cmd for cmd in cmds if not cmd.split(" ")[1].startswith(":")]
+        return sorted(
+            pushes, key=lambda cmd: not cmd.split(":")[-1].startswith("refs/heads/")
+        )
+
+    def push_packs(self, cmds: list[str]) -> list[str]:
+        """Pushes a batch of refs to the shared object store of the pack layout
+
+        The objects of all the refs of the batch that the remote does not have
+        yet are uploaded as a single pack, along with its index.
+
+        Args:
+            cmds (list[str]): the push commands, as `push <src>:<dst>`
+
+        Returns:
+            dict: the result line of each command
+        """
+        manifest = self.get_manifest() or Manifest(layout=PACK_LAYOUT)
+        results = {}
+        tips = {}
+        for cmd in cmds:
+            result, sha = self.plan_pack_push(manifest, cmd)
+            if result is None:
+                tips[cmd] = sha
+            else:
+                results[cmd] = result
+        if tips:
+            results.update(self.push_pack_tips(manifest, tips))
+        return results
+
+    def plan_pack_push(self, manifest: Manifest, cmd: str) -> tuple[str, str]:
+        """Checks a push command of the pack layout against the manifest
+
+        Args:
+            manifest (Manifest): the manifest of the remote
+            cmd (str): the push command, as `push <src>:<dst>`
+
+        Returns:
+            tuple[str, str]: the result line of the command if it is complete,
+            or None and the sha whose objects must be pushed
+        """
+        local_ref, remote_ref = cmd.split(" ")[1].split(":")
+        if not local_ref:
+            return self.remove_pack_ref(manifest, remote_ref), None
+        remote_sha = manifest.get_sha(remote_ref)
+        force_push = local_ref.startswith("+") and not manifest.is_protected(
+            remote_ref
+        )
+        local_ref = local_ref.removeprefix("+")
+        try:
+            sha = git.rev_parse(local_ref)
+        except git.GitError:
+            logger.info(f"fatal: {local_ref} not found\n")
+            return f'error {remote_ref} "{local_ref} not found"?\n', None
+        if remote_sha == sha:
+            logger.info(f"{remote_ref} is up to date")
+            return f"ok {remote_ref}\n", None
+        if remote_sha and not force_push and not git.is_ancestor(remote_sha, sha):
+            return (
+                f'error {remote_ref} "remote ref is not ancestor of {local_ref}."?\n',
+                None,
+            )
+        return None, sha
+
+    def remove_pack_ref(self, manifest: Manifest, remote_ref: str) -> str:
+        """Removes a ref of the pack layout, whose objects stay in the packs
+
+        Returns:
+            str: the result line of the removal
+        """
+        remote_sha = manifest.get_sha(remote_ref)
+        if remote_sha is None:
+            return f"error {remote_ref} not found\n"
+        if manifest.is_protected(remote_ref):
+            # As with the bundle layout, a protected ref is never removed
+            return f'error {remote_ref} "{remote_ref} is protected"?\n'
+        self.record_ref_update(remote_ref, previous_sha=remote_sha)
+        return f"ok {remote_ref}\n"
+
+    def push_pack_tips(self, manifest: Manifest, tips: dict) -> dict:
+        """Pushes the objects of the refs of a batch as a single pack
+
+        Args:
+            manifest (Manifest): the manifest of the remote
+            tips (dict): the sha to push, by push command
+
+        Returns:
+            dict: the result line of each command
+        """
+        results = {}
+        try:
+            pack = self.push_pack(manifest, list(dict.fromkeys(tips.values())))
+        except (git.GitError, ClientError) as e:
             logger.info(f"fatal: {e}\n")
-            return f'error {remote_ref} "{e}"?\n'
-        finally:
-            if os.path.exists(f"{temp_dir}/{sha}.bundle"):
-                os.remove(f"{temp_dir}/{sha}.bundle")
+            return {cmd: f'error {cmd.split(":")[-1]} "{e}"?\n' for cmd in tips}
+        for cmd, sha in tips.items():
+            remote_ref = cmd.split(":")[-1]
+            self.record_ref_update(
+                remote_ref,
+                previous_sha=manifest.get_sha(remote_ref),
+                sha=sha,
+                pack=pack if pack and sha in pack["tips"] else None,
+            )
+            results[cmd] = f"ok {remote_ref}\n"
+        return results
+
+    def push_pack(self, manifest: Manifest, tips: list[str]) -> dict:
+        """Uploads the objects of the tips that the remote does not have
+
+        Args:
+            manifest (Manifest): the manifest of the remote
+            tips (list[str]): the shas to push
+
+        Returns:
+            dict: the uploaded pack or None if the remote has all the objects
+        """
+        # Objects reachable from the refs and packs of the remote are left out,
+        # as far as they are known locally
+        known = list(
+            dict.fromkeys(
+                [t for p in manifest.packs for t in p["tips"]]
+                + [e["sha"] for e in manifest.refs.values()]
+            )
+        )
+        missing = set(git.missing_objects(known))
+        exclude = [sha for sha in known if sha not in missing]
+        tips = [sha for sha in tips if sha not in known]
+        if not tips:
+            return None
+        with tempfile.TemporaryDirectory(prefix="git_remote_s3_push_") as temp_dir:
+            name = git.pack_objects(folder=temp_dir, tips=tips, exclude=exclude)
+            if git.pack_object_count(f"{temp_dir}/{name}.pack") == 0:
+                logger.info("the remote has all the objects")
+                return None
+            sizes = {}
+            for ext in ["pack", "idx"]:
+                with open(f"{temp_dir}/{name}.{ext}", "rb") as f:
+                    sizes[ext] = self.uploader.upload(
+                        f,
+                        bucket=self.bucket,
+                        key=f"{self.prefix}/{PACKS_FOLDER}/{name}.{ext}",
+                    )
+        logger.info(f"pushed {name} with {tips}")
+        return {"name": name, "size": sizes["pack"], "tips": tips}
+
+    def plan_push(self, cmds: list[str]) -> tuple[list[str], list[str]]:
+        """Plans a push batch so that each commit is bundled at most once
+
+        A ref whose commit already has a full bundle on the remote, under any
+        ref, or is pushed by an earlier command of the batch, gets a server
+        side copy of that bundle instead of a new one.
+
+        Args:
+            cmds (list[str]): the push commands, as `push <src>:<dst>`
+
+        Returns:
+            tuple[list[str], list[str]]: the commands to run first, and those
+            to run once the first ones have completed
+        """
+        first, then = [], []
+        shas = {}
+        for cmd in cmds:
+            local_ref = cmd.split(" ")[1].split(":")[0]
+            try:
+                sha = git.rev_parse(local_ref.removeprefix("+")) if local_ref else None
+            except git.GitError:
+                sha = None
+            shas[cmd] = sha
+        self.add_remote_bundle_sources(
+            {cmd.split(":")[-1]: sha for cmd, sha in shas.items()}
+        )
+
+        leaders = set()
+        for cmd in cmds:
+            sha = shas[cmd]
+            if sha is None or (
+                sha not in leaders and self.get_bundle_source(sha) is None
+            ):
+                leaders.add(sha)
+                first.append(cmd)
+            else:
+                then.append(cmd)
+        logger.info(f"push plan: {len(first)} then {len(then)} refs")
+        return first, then
+
+    def add_remote_bundle_sources(self, targets: dict) -> None:
+        """Records the full bundles of the remote that a push batch can copy
+
+        Any ref of the remote whose bundle is a full bundle of one of the
+        pushed commits is a source, unless the batch moves or deletes it.
+        Their zip archives, if any, are not reused: they may be missing.
+
+        Args:
+            targets (dict): the sha pushed to each remote ref of the batch, or
+                None for a deletion
+        """
+        wanted = {sha for sha in targets.values() if sha}
+        for ref, bundle in self.list_full_bundles():
+            sha = bundle["Key"].split("/")[-1].split(".")[0]
+            if sha in wanted and targets.get(ref, sha) == sha:
+                self.add_bundle_source(sha, bundle)
+
+    def list_full_bundles(self) -> list[tuple[str, dict]]:
+        """Lists the refs of the remote whose bundle is not incremental
+
+        Returns:
+            list[tuple[str, dict]]: the refs and their bundle, from the
+            manifest or the session listing
+        """
+        manifest = self.get_manifest()
+        if manifest is not None:
+            return [
+                (ref, {"Key": f"{self.prefix}/{e['bundle']}", "Size": e["size"]})
+                for ref, e in manifest.refs.items()
+                if e.get("bundle") and not e.get("chain")
+            ]
+        with self.ref_objects_lock:
+            ref_objects = dict(self.ref_objects or {})
+        bundles = []
+        for ref, objs in ref_objects.items():
+            keys = [o for o in objs if o["Key"].endswith(".bundle")]
+            # A chain link is a bundle too, the bundle of the ref is a delta
+            if len(keys) == 1 and f"/{CHAIN_MARKER}/" not in keys[0]["Key"]:
+                bundles.append((ref, keys[0]))
+        return bundles
+
+    def get_bundle_source(self, sha: str) -> dict:
+        """Gets a full bundle of a commit pushed to the remote, if any"""
+        with self.bundle_sources_lock:
+            return self.bundle_sources.get(sha)
+
+    def add_bundle_source(self, sha: str, source: dict) -> None:
+        """Records a full bundle of a commit that other refs can copy"""
+        with self.bundle_sources_lock:
+            self.bundle_sources.setdefault(sha, source)
+
+    def copy_object(
+        self, *, source: str, key: str, size: int, etag: str = None
+    ) -> None:
+        """Copies an object of the bucket server side, with its metadata
+
+        Args:
+            source (str): the key of the object to copy
+            key (str): the destination key
+            size (int): the size of the object
+            etag (str): the ETag the source must still have, if known, so that
+                a bundle replaced concurrently is not copied
+
+        Raises:
+            CopyFailedError: if a multipart copy fails
+        """
+        copy_source = {"Bucket": self.bucket, "Key": source}
+        extra_args = {"MetadataDirective": "COPY"}
+        if etag:
+            extra_args["CopySourceIfMatch"] = etag
+        if size < MAX_COPY_OBJECT_SIZE:
+            self.s3.copy_object(
+                CopySource=copy_source, Bucket=self.bucket, Key=key, **extra_args
+            )
+        else:
+            # boto3 is imported by now, the client is created
+            from boto3.exceptions import S3UploadFailedError
+
+            try:
+                self.s3.copy(
+                    CopySource=copy_source,
+                    Bucket=self.bucket,
+                    Key=key,
+                    ExtraArgs=extra_args,
+                )
+            except S3UploadFailedError as e:
+                # Reported as the error of the ref rather than killing the helper
+                raise CopyFailedError(f"cannot copy {source} to {key}: {e}") from e
+        metrics.count("copies")
+        logger.info(f"copied {source} to {key}")
 
     def init_remote_head(self, ref: str) -> None:
         """Initialise the remote HEAD reference if it does not exist
@@ -220,14 +1337,21 @@ class S3Remote:
             ref (str): The ref to which the remote HEAD should point to
         """
 
-        try:
-            self.s3.head_object(Bucket=self.bucket, Key=f"{self.prefix}/HEAD")
-        except ClientError:
-            self.s3.put_object(
-                Bucket=self.bucket,
-                Key=f"{self.prefix}/HEAD",
-                Body=ref,
-            )
+        if self.head_exists:
+            return
+        # Refs are pushed concurrently, only one of them may create the HEAD
+        with self.head_lock:
+            if self.head_exists:
+                return
+            try:
+                self.s3.head_object(Bucket=self.bucket, Key=f"{self.prefix}/HEAD")
+            except ClientError:
+                self.s3.put_object(
+                    Bucket=self.bucket,
+                    Key=f"{self.prefix}/HEAD",
+                    Body=ref,
+                )
+            self.head_exists = True
 
     def get_bundles_for_ref(self, remote_ref: str) -> list[str]:
         """Lists all the bundles for a given ref on the remote
@@ -238,21 +1362,69 @@ class S3Remote:
         Returns:
             list[str]: the list of bundle keys
         """
+        manifest = self.get_manifest()
+        if manifest is not None:
+            if remote_ref not in manifest.refs:
+                return []
+            entry = manifest.refs[remote_ref]
+            return [{"Key": f"{self.prefix}/{entry['bundle']}", "Size": entry["size"]}]
 
-        # We are not implementing pagination since there can be few objects (bundles)
-        # under a single Prefix
         return [
             c
-            for c in self.s3.list_objects_v2(
-                Bucket=self.bucket, Prefix=f"{self.prefix}/{remote_ref}/"
-            ).get("Contents", [])
-            if "PROTECTED#" not in c["Key"] and ".zip" not in c["Key"]
+            for c in self.get_ref_objects(remote_ref)
+            if "PROTECTED#" not in c["Key"]
+            and ".zip" not in c["Key"]
+            and f"/{CHAIN_MARKER}/" not in c["Key"]
+        ]
+
+    def get_chain_for_ref(self, remote_ref: str) -> list[dict]:
+        """Lists the links of the incremental bundle chain of a ref
+
+        Args:
+            remote_ref (str): the remote ref
+
+        Returns:
+            list[dict]: the links, oldest first
+        """
+        manifest = self.get_manifest()
+        if manifest is not None:
+            return [
+                {"Key": f"{self.prefix}/{link['key']}", "Size": link["size"]}
+                for link in manifest.refs.get(remote_ref, {}).get("chain", [])
+            ]
+        links = [
+            o
+            for o in self.get_ref_objects(remote_ref)
+            if f"/{CHAIN_MARKER}/" in o["Key"]
         ]
+        return sorted(links, key=lambda x: x["Key"])
+
+    def needs_compaction(self, tip: dict, chain: list[dict]) -> bool:
+        """Checks if the chain of a ref must be folded into a full bundle
+
+        Args:
+            tip (dict): the current bundle of the ref
+            chain (list[dict]): the links of the chain, oldest first
+
+        Returns:
+            bool: true if adding a link would exceed the configured limits
+        """
+        if not chain:
+            return False
+        # The first link is the full bundle, the others and the tip are deltas
+        delta_bytes = sum(link.get("Size", 0) for link in chain[1:])
+        delta_bytes += tip.get("Size", 0)
+        return len(chain) + 2 > self.compact_links or delta_bytes >= self.compact_bytes
 
     def is_protected(self, remote_ref):
-        protected = self.s3.list_objects_v2(
-            Bucket=self.bucket, Prefix=f"{self.prefix}/{remote_ref}/PROTECTED#"
-        ).get("Contents", [])
+        manifest = self.get_manifest()
+        if manifest is not None:
+            return manifest.is_protected(remote_ref)
+        protected = [
+            o
+            for o in self.get_ref_objects(remote_ref)
+            if o["Key"].endswith("/PROTECTED#")
+        ]
         return protected
 
     def cmd_option(self, arg: str):
@@ -265,30 +1437,66 @@ class S3Remote:
         sys.stdout.flush()
 
     def cmd_list(self, *, for_push: bool = False):
-        objs = self.list_refs(bucket=self.bucket, prefix=self.prefix)
+        manifest = self.get_manifest()
+        if manifest is not None:
+            # Keys in the <ref>/<sha>.bundle form, whatever the layout
+            objs = [
+                f"{ref}/{manifest.refs[ref]['sha']}.bundle"
+                for ref in sorted(manifest.refs)
+            ]
+        else:
+            objs = self.list_refs(bucket=self.bucket, prefix=self.prefix)
+            if objs and self.layout == PACK_LAYOUT:
+                # Refs without a manifest are bundles, the pack layout always
+                # has one: only an empty remote can be added as s3+pack
+                raise LayoutMismatchError(BUNDLE_LAYOUT)
         logger.info(objs)
 
-        if not for_push:
-            try:
-                head = self.get_remote_head()
-                logger.info(f"HEAD=[{head}]")
-                for o in objs:
-                    ref = "/".join(o.split("/")[:-1])
-                    if ref == head:
-                        logger.info(f"@{ref} HEAD\n")
-                        sys.stdout.write(f"@{ref} HEAD\n")
-            except ClientError as e:
-                if e.response["Error"]["Code"] == "NoSuchKey":
-                    pass  # ignoring missing HEAD on remote
+        head = None if for_push else self.list_head(objs)
 
+        refs = []
         for o in [x for x in objs if re.match(".+/.+/.+/[a-f0-9]{40}.bundle", x)]:
             elements = o.split("/")
             sha = elements[-1].split(".")[0]
+            refs.append((sha, "/".join(elements[:-1])))
             sys.stdout.write(f"{sha} {'/'.join(elements[:-1])}\n")
 
         sys.stdout.write("\n")
         sys.stdout.flush()
 
+        if (
+            self.prefetch
+            and not for_push
+            and self.prefetch_plan is None
+            and self.layout == BUNDLE_LAYOUT
+        ):
+            # The ref of HEAD is the most likely to be fetched, eg by a clone
+            refs.sort(key=lambda r: r[1] != head)
+            self.start_prefetch(refs)
+
+    def list_head(self, objs: list[str]) -> str:
+        """Writes the symref of the remote HEAD, if it points to a listed ref
+
+        Args:
+            objs (list[str]): the listed refs, as <ref>/<sha>.bundle
+
+        Returns:
+            str: the ref of the remote HEAD, or None if it has none
+        """
+        head = None
+        try:
+            head = self.get_remote_head()
+            logger.info(f"HEAD=[{head}]")
+            for o in objs:
+                ref = "/".join(o.split("/")[:-1])
+                if ref == head:
+                    logger.info(f"@{ref} HEAD\n")
+                    sys.stdout.write(f"@{ref} HEAD\n")
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                pass  # ignoring missing HEAD on remote
+        return head
+
     def get_remote_head(self) -> str:
         """Gets the remote head ref
 
@@ -302,7 +1510,7 @@ class S3Remote:
             .decode("utf-8")
             .strip()
         )
-
+        self.head_exists = True
         return head
 
     def cmd_capabilities(self):
@@ -314,7 +1522,10 @@ class S3Remote:
 
     def process_cmd(self, cmd: str):  # noqa: C901
         if cmd.startswith("fetch"):
-            self.cmd_fetch(cmd.strip())
+            if self.mode != Mode.FETCH:
+                self.mode = Mode.FETCH
+                self.fetch_cmds = []
+            self.fetch_cmds.append(cmd.strip())
         elif cmd.startswith("push"):
             if self.mode != Mode.PUSH:
                 self.mode = Mode.PUSH
@@ -331,10 +1542,12 @@ class S3Remote:
             self.cmd_capabilities()
         elif cmd == "\n":
             logger.info("empty line")
+            if self.mode == Mode.FETCH and self.fetch_cmds:
+                self.fetch_batch(self.fetch_cmds)
+                self.fetch_cmds = []
             if self.mode == Mode.PUSH and self.push_cmds:
                 logger.info(f"pushing {self.push_cmds}")
-                push_res = [self.cmd_push(c) for c in self.push_cmds]
-                for res in push_res:
+                for res in self.push_batch(self.push_cmds):
                     sys.stdout.write(res)
                 self.push_cmds = []
             sys.stdout.write("\n")
@@ -345,6 +1558,48 @@ class S3Remote:
             sys.exit(1)
 
 
+def ref_of_key(key: str, prefix: str) -> str:
+    """Gets the ref an object stored under <prefix>/<ref>/ belongs to"""
+    key = key.removeprefix(f"{prefix}/")
+    if f"/{CHAIN_MARKER}/" in key:
+        return key.split(f"/{CHAIN_MARKER}/")[0]
+    return key.rpartition("/")[0]
+
+
+def chain_link_sha(key: str) -> str:
+    """Extracts the sha from the key of a chain link (<seq>-<sha>.bundle)"""
+    return key.split("/")[-1].split(".")[0].split("-")[-1]
+
+
+def process_commands(s3remote: S3Remote) -> None:
+    """Processes the commands git writes to stdin, until it closes it
+
+    Args:
+        s3remote (S3Remote): the remote
+
+    Raises:
+        BucketNotFoundError: if the bucket does not exist
+        NotAuthorizedError: if the user is not allowed to access the bucket
+    """
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        logger.info(f"cmd: {line}")
+        # The blank line ending a batch runs the fetches or pushes
+        command = line.split(" ")[0].strip() or f"{s3remote.mode or 'end'}-batch"
+        try:
+            with metrics.timer("commands", command):
+                s3remote.process_cmd(line)
+        except ClientError as e:
+            # The bucket is not probed upfront, errors surface on first use
+            if e.response["Error"]["Code"] == "NoSuchBucket":
+                raise BucketNotFoundError(s3remote.bucket)
+            if e.response["Error"]["Code"] == "AccessDenied":
+                raise NotAuthorizedError(e.operation_name, s3remote.bucket)
+            raise e
+
+
 def main():
     logger.info(sys.argv)
     remote = sys.argv[2]
@@ -354,16 +1609,13 @@ def main():
             f"fatal: invalid remote '{remote}'. You need to have a bucket and a prefix.\n"
         )
         sys.exit(1)
+    s3remote = None
     try:
         s3remote = S3Remote(
             uri_scheme=uri_scheme, profile=profile, bucket=bucket, prefix=prefix
         )
-        while True:
-            line = sys.stdin.readline()
-            if not line:
-                break
-            logger.info(f"cmd: {line}")
-            s3remote.process_cmd(line)
+        metrics.start("git-remote-s3", s3remote.settings.get("metricsFile"))
+        process_commands(s3remote)
 
     except BrokenPipeError:
         logger.info("BrokenPipeError")
@@ -394,6 +1646,13 @@ def main():
         sys.stderr.write(f"fatal: bucket not found {e.bucket}\n")
         sys.stderr.flush()
         sys.exit(1)
+    except LayoutMismatchError as e:
+        scheme = "s3+pack://" if e.layout == PACK_LAYOUT else "s3://"
+        sys.stderr.write(
+            f"fatal: the remote uses the {e.layout} layout, add it as {scheme}\n"
+        )
+        sys.stderr.flush()
+        sys.exit(1)
     except NotAuthorizedError as e:
         sys.stderr.write(
             f"fatal: user not authorized to perform {e.action} on {e.bucket}\n"
@@ -407,3 +1666,7 @@ def main():
         )
         sys.stderr.flush()
         sys.exit(1)
+    finally:
+        if s3remote is not None:
+            s3remote.close()
+        metrics.write()
@@ -0,0 +1,77 @@
+# SPDX-FileCopyrightText: 2023-present Amazon.com, Inc. or its affiliates
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import re
+import subprocess
+
+SIZE_SUFFIXES = {"k": 1024, "m": 1024**2, "g": 1024**3}
+
+
+def parse_size(value: str) -> int:
+    """Parses an integer with an optional k, m or g suffix, as git config does
+
+    Args:
+        value (str): the value to parse, eg 8m
+
+    Returns:
+        int: the parsed value
+    """
+    value = value.strip().lower()
+    if value and value[-1] in SIZE_SUFFIXES:
+        return int(value[:-1]) * SIZE_SUFFIXES[value[-1]]
+    return int(value)
+
+
+class Settings:
+    """Typed access to the git config values of a section.
+
+    Values are looked up in the environment first, then in git config. A key
+    `fetchConcurrency` in the section `s3` maps to the git config key
+    `s3.fetchConcurrency` and to the environment variable
+    `<env_prefix>FETCH_CONCURRENCY`. Git config is read once, on first access.
+    """
+
+    def __init__(self, section: str, env_prefix: str):
+        self.section = section
+        self.env_prefix = env_prefix
+        self._values = None
+
+    def _load(self) -> dict:
+        if self._values is None:
+            result = subprocess.run(
+                ["git", "config", "--get-regexp", f"^{re.escape(self.section)}\\."],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+            self._values = {}
+            if result.returncode == 0:
+                for line in result.stdout.decode("utf8").splitlines():
+                    key, _, value = line.partition(" ")
+                    self._values[key[len(self.section) + 1 :]] = value
+        return self._values
+
+    def env_name(self, key: str) -> str:
+        return self.env_prefix + re.sub(r"(?<!^)(?=[A-Z])", "_", key).upper()
+
+    def get(self, key: str, default: str = None) -> str:
+        value = os.environ.get(self.env_name(key))
+        if value is None:
+            value = self._load().get(key.lower())
+        return default if value is None else value
+
+    def get_int(self, key: str, default: int) -> int:
+        value = self.get(key)
+        if value is None:
+            return default
+        try:
+            return parse_size(value)
+        except ValueError:
+            return default
+
+    def get_bool(self, key: str, default: bool) -> bool:
+        value = self.get(key)
+        if value is None:
+            return default
+        return value.strip().lower() in ("true", "yes", "on", "1", "")
@@ -0,0 +1,260 @@
+# SPDX-FileCopyrightText: 2023-present Amazon.com, Inc. or its affiliates
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.exceptions import BotoCoreError, ClientError, IncompleteReadError
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# S3 rejects parts smaller than 5 MiB, except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_CONCURRENCY = 4
+PART_ATTEMPTS = 3
+RETRY_DELAY = 0.5
+# Downloaded parts are streamed to disk in chunks of this size, so that memory
+# usage does not depend on the part size
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadCancelledError(Exception):
+    def __init__(self, key: str):
+        super().__init__(f"download of {key} cancelled")
+
+
+class MultipartUploader:
+    """Uploads a stream to S3, as a multipart upload when it exceeds one part.
+
+    Parts are read sequentially from the stream and uploaded concurrently. At
+    most `concurrency` parts are held in memory at any time, so the stream
+    does not need to be seekable nor its size to be known in advance.
+    """
+
+    def __init__(
+        self,
+        s3,
+        *,
+        part_size: int = DEFAULT_PART_SIZE,
+        concurrency: int = DEFAULT_CONCURRENCY,
+    ):
+        self.s3 = s3
+        self.part_size = max(MIN_PART_SIZE, part_size)
+        self.concurrency = max(1, concurrency)
+
+    def upload(self, fileobj, *, bucket: str, key: str, **extra_args) -> int:
+        """Uploads the content of a file object
+
+        Args:
+            fileobj: the file object to read from
+            bucket (str): the destination bucket
+            key (str): the destination key
+            extra_args: additional arguments for PutObject/CreateMultipartUpload
+                such as Metadata
+
+        Returns:
+            int: the number of bytes uploaded
+        """
+        data = fileobj.read(self.part_size)
+        if len(data) < self.part_size:
+            self.s3.put_object(Bucket=bucket, Key=key, Body=data, **extra_args)
+            metrics.add_bytes("uploaded", len(data))
+            return len(data)
+
+        upload_id = self.s3.create_multipart_upload(
+            Bucket=bucket, Key=key, **extra_args
+        )["UploadId"]
+        try:
+            parts = self._upload_parts(data, fileobj, bucket, key, upload_id)
+            self.s3.complete_multipart_upload(
+                Bucket=bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": [p for p, _ in parts]},
+            )
+            uploaded = sum(size for _, size in parts)
+            metrics.add_bytes("uploaded", uploaded)
+            return uploaded
+        except BaseException:
+            # Do not leave orphaned parts behind, they are billed until aborted
+            logger.info(f"aborting multipart upload of {key}")
+            self.s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
+
+    def _upload_parts(self, data, fileobj, bucket, key, upload_id) -> list[tuple]:
+        slots = threading.Semaphore(self.concurrency)
+        failed = threading.Event()
+        futures = []
+
+        def part_done(future):
+            if not future.cancelled() and future.exception() is not None:
+                failed.set()
+            slots.release()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            try:
+                part_number = 1
+                while data:
+                    future = executor.submit(
+                        self._upload_part, data, bucket, key, upload_id, part_number
+                    )
+                    future.add_done_callback(part_done)
+                    futures.append(future)
+                    # Wait for a free slot before reading the next part in memory
+                    slots.acquire()
+                    if failed.is_set():
+                        break
+                    part_number += 1
+                    data = fileobj.read(self.part_size)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        return [future.result() for future in futures]
+
+    def _upload_part(self, data, bucket, key, upload_id, part_number) -> dict:
+        for attempt in range(1, PART_ATTEMPTS + 1):
+            try:
+                res = self.s3.upload_part(
+                    Bucket=bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=part_number,
+                    Body=data,
+                )
+                return {"ETag": res["ETag"], "PartNumber": part_number}, len(data)
+            except (ClientError, BotoCoreError) as e:
+                if attempt == PART_ATTEMPTS:
+                    raise e
+                logger.info(f"retrying part {part_number} of {key}: {e}")
+                metrics.count("retries.upload_part")
+                time.sleep(RETRY_DELAY * attempt)
+
+
+class RangedDownloader:
+    """Downloads an S3 object to a file, as concurrent ranged GETs when large.
+
+    The first part is requested on its own, its response giving the size of
+    the object: objects that fit in one part are complete after this single
+    request. For larger objects, the file is preallocated and the remaining
+    parts are downloaded concurrently, each written at its offset and retried
+    on its own. They are requested with the ETag of the first part, so that
+    an object overwritten during the download fails instead of mixing two
+    versions. Once the `cancelled` event is set, downloads stop at their next
+    chunk.
+    """
+
+    def __init__(
+        self,
+        s3,
+        *,
+        part_size: int = DEFAULT_PART_SIZE,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        cancelled: threading.Event = None,
+    ):
+        self.s3 = s3
+        self.part_size = max(1, part_size)
+        self.concurrency = max(1, concurrency)
+        self.cancelled = cancelled or threading.Event()
+
+    def download(self, *, bucket: str, key: str, path: str) -> dict:
+        """Downloads an object to a file
+
+        Args:
+            bucket (str): the bucket of the object
+            key (str): the key of the object
+            path (str): the file to write
+
+        Returns:
+            dict: the response to the first GetObject, with the ETag and
+            Metadata of the object
+        """
+        try:
+            obj = self.s3.get_object(
+                Bucket=bucket, Key=key, Range=f"bytes=0-{self.part_size - 1}"
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "InvalidRange":
+                raise e
+            # An empty object has no byte to request
+            obj = self.s3.get_object(Bucket=bucket, Key=key)
+        size = object_size(obj)
+        with open(path, "wb") as f:
+            self._copy(obj["Body"], f, key)
+            first = f.tell()
+            if size is not None and size > first:
+                f.truncate(size)
+        metrics.add_bytes("downloaded", first)
+        if size is not None and size > first:
+            self._download_parts(bucket, key, path, obj["ETag"], first, size)
+        return obj
+
+    def _download_parts(self, bucket, key, path, etag, start, size) -> None:
+        ranges = [
+            (offset, min(offset + self.part_size, size) - 1)
+            for offset in range(start, size, self.part_size)
+        ]
+        with ThreadPoolExecutor(
+            max_workers=min(self.concurrency, len(ranges))
+        ) as executor:
+            futures = [
+                executor.submit(
+                    self._download_part, bucket, key, path, etag, first, last
+                )
+                for first, last in ranges
+            ]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def _download_part(self, bucket, key, path, etag, first, last) -> None:
+        for attempt in range(1, PART_ATTEMPTS + 1):
+            try:
+                obj = self.s3.get_object(
+                    Bucket=bucket, Key=key, Range=f"bytes={first}-{last}", IfMatch=etag
+                )
+                with open(path, "r+b") as f:
+                    f.seek(first)
+                    self._copy(obj["Body"], f, key)
+                    written = f.tell() - first
+                metrics.add_bytes("downloaded", written)
+                if written != last - first + 1:
+                    raise IncompleteReadError(
+                        actual_bytes=written, expected_bytes=last - first + 1
+                    )
+                return
+            except (ClientError, BotoCoreError) as e:
+                if (
+                    attempt == PART_ATTEMPTS
+                    or isinstance(e, ClientError)
+                    and e.response["Error"]["Code"] == "PreconditionFailed"
+                ):
+                    raise e
+                logger.info(f"retrying bytes {first}-{last} of {key}: {e}")
+                metrics.count("retries.download_part")
+                time.sleep(RETRY_DELAY * attempt)
+
+    def _copy(self, body, f, key: str) -> None:
+        for chunk in iter(lambda: body.read(DOWNLOAD_CHUNK_SIZE), b""):
+            if self.cancelled.is_set():
+                raise DownloadCancelledError(key)
+            f.write(chunk)
+
+
+def object_size(obj: dict) -> int:
+    """Gets the size of an object from the response to a ranged GetObject
+
+    Returns:
+        int: the size or None if the response holds the whole object
+    """
+    m = re.match(r"bytes \d+-\d+/(\d+)", obj.get("ContentRange") or "")
+    return int(m.group(1)) if m else None
@@ -0,0 +1,30 @@
+from benchmarks.fake_s3 import FakeS3
+from benchmarks.run import SCENARIOS, compare, run_benchmarks
+
+
+def test_fake_s3_pagination():
+    s3 = FakeS3()
+    for key in ["p/a/1", "p/a/2", "p/b/1", "p/c"]:
+        s3.put_object(Bucket="bucket", Key=key, Body=b"x")
+    res = s3.list_objects_v2(Bucket="bucket", Prefix="p/", Delimiter="/", MaxKeys=2)
+    assert res["CommonPrefixes"] == [{"Prefix": "p/a/"}, {"Prefix": "p/b/"}]
+    res = s3.list_objects_v2(
+        Bucket="bucket",
+        Prefix="p/",
+        Delimiter="/",
+        ContinuationToken=res["NextContinuationToken"],
+    )
+    assert [c["Key"] for c in res["Contents"]] == ["p/c"]
+    assert not res["IsTruncated"]
+
+
+def test_run_benchmarks():
+    results = run_benchmarks(
+        refs=3, depth=4, commit_size=1024, lfs_objects=2, lfs_size=1024, repeat=1
+    )
+    assert set(results["results"]) == set(SCENARIOS)
+    # Every ref is pushed as a bundle and fetched back
+    assert results["results"]["push"]["requests"]["PutObject"] >= 3
+    assert results["results"]["fetch"]["requests"]["GetObject"] >= 3
+    assert results["results"]["lfs_download"]["bytes"] == {"downloaded": 2048}
+    assert compare(results, results) == {s: 1.0 for s in SCENARIOS}
@@ -0,0 +1,117 @@
+import hashlib
+import os
+import tempfile
+from git_remote_s3.cache import LFSCache, ObjectCache
+
+
+def create_file(folder, name, content):
+    path = os.path.join(folder, name)
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+def test_cache_hit_and_miss():
+    cache = ObjectCache(tempfile.mkdtemp("test_cache"))
+    temp_dir = tempfile.mkdtemp("test_temp")
+    src = create_file(temp_dir, "src", b"content")
+    dst = os.path.join(temp_dir, "dst")
+    assert cache.get(bucket="b", key="k", etag="e1", path=dst) is None
+
+    cache.put(bucket="b", key="k", etag="e1", path=src, metadata={"a": "b"})
+    assert cache.get(bucket="b", key="k", etag="e1", path=dst) == {"a": "b"}
+    with open(dst, "rb") as f:
+        assert f.read() == b"content"
+
+    # Another version of the object is a miss
+    assert cache.get(bucket="b", key="k", etag="e2", path=dst + "2") is None
+    assert cache.get(bucket="other", key="k", etag="e1", path=dst + "3") is None
+
+
+def test_cache_evicts_least_recently_used():
+    # Eviction goes down to 90% of the limit, which leaves room for two entries
+    cache = ObjectCache(tempfile.mkdtemp("test_cache"), max_size=12)
+    temp_dir = tempfile.mkdtemp("test_temp")
+    for i, key in enumerate(["k1", "k2"]):
+        src = create_file(temp_dir, key, b"12345")
+        cache.put(bucket="b", key=key, etag="e", path=src, metadata={})
+        # Make the order of the entries deterministic
+        entry = cache._path("b", key, "e")
+        os.utime(entry, (i, i))
+    # Reading k1 makes k2 the least recently used entry
+    assert cache.get(bucket="b", key="k1", etag="e", path=f"{temp_dir}/out") == {}
+
+    src = create_file(temp_dir, "k3", b"12345")
+    cache.put(bucket="b", key="k3", etag="e", path=src, metadata={})
+    assert cache.get(bucket="b", key="k2", etag="e", path=f"{temp_dir}/o2") is None
+    assert cache.get(bucket="b", key="k1", etag="e", path=f"{temp_dir}/o1") == {}
+    assert cache.get(bucket="b", key="k3", etag="e", path=f"{temp_dir}/o3") == {}
+
+
+def test_cache_walked_only_over_the_limit(monkeypatch):
+    cache = ObjectCache(tempfile.mkdtemp("test_cache"), max_size=100)
+    temp_dir = tempfile.mkdtemp("test_temp")
+    walks = []
+    original_walk = os.walk
+    monkeypatch.setattr(
+        "git_remote_s3.cache.os.walk", lambda f: walks.append(f) or original_walk(f)
+    )
+    for i in range(30):
+        src = create_file(temp_dir, f"k{i}", b"1234567890")
+        cache.put(bucket="b", key=f"k{i}", etag="e", path=src, metadata={})
+        os.utime(cache._path("b", f"k{i}", "e"), (i, i))
+    # On the first entry, then every time the cache goes over the limit, from
+    # the 11th entry on: eviction leaves room for one more entry
+    assert len(walks) == 1 + 10
+    assert sum(size for _, size, _ in cache.entries()) <= 100
+    assert cache.get(bucket="b", key="k29", etag="e", path=f"{temp_dir}/o") == {}
+    assert cache.get(bucket="b", key="k0", etag="e", path=f"{temp_dir}/o0") is None
+
+
+def test_cache_ignores_truncated_entry():
+    cache = ObjectCache(tempfile.mkdtemp("test_cache"))
+    temp_dir = tempfile.mkdtemp("test_temp")
+    src = create_file(temp_dir, "src", b"content")
+    cache.put(bucket="b", key="k", etag="e", path=src, metadata={})
+    with open(cache._path("b", "k", "e"), "wb") as f:
+        f.write(b"con")
+    assert cache.get(bucket="b", key="k", etag="e", path=f"{temp_dir}/dst") is None
+
+
+def test_lfs_cache_verifies_oid():
+    cache = LFSCache(tempfile.mkdtemp("test_cache"))
+    temp_dir = tempfile.mkdtemp("test_temp")
+    src = create_file(temp_dir, "src", b"content")
+    oid = hashlib.sha256(b"content").hexdigest()
+    dst = os.path.join(temp_dir, "dst")
+
+    # A corrupted object never enters the cache
+    cache.put_object(oid="0" * 64, path=src)
+    assert not cache.get_object(oid="0" * 64, path=dst)
+
+    cache.put_object(oid=oid, path=src)
+    assert cache.get_object(oid=oid, path=dst)
+    with open(dst, "rb") as f:
+        assert f.read() == b"content"
+
+
+def test_lfs_cache_walked_only_over_the_limit(monkeypatch):
+    cache = LFSCache(tempfile.mkdtemp("test_cache"), max_size=100)
+    temp_dir = tempfile.mkdtemp("test_temp")
+    walks = []
+    original_walk = os.walk
+    monkeypatch.setattr(
+        "git_remote_s3.cache.os.walk", lambda f: walks.append(f) or original_walk(f)
+    )
+    oids = []
+    for i in range(30):
+        content = f"object{i:04}".encode("utf8")
+        oid = hashlib.sha256(content).hexdigest()
+        cache.put_object(oid=oid, path=create_file(temp_dir, oid, content))
+        os.utime(cache._oid_path(oid), (i, i))
+        oids.append(oid)
+    # As for bundles, on the first object and then once per eviction
+    assert len(walks) == 1 + 10
+    assert sum(size for _, size, _ in cache.entries()) <= 100
+    assert cache.get_object(oid=oids[-1], path=f"{temp_dir}/o")
+    assert not cache.get_object(oid=oids[0], path=f"{temp_dir}/o0")
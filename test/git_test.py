@@ -0,0 +1,84 @@
+import os
+import subprocess
+import tempfile
+import pytest
+from git_remote_s3 import git
+
+
+@pytest.fixture
+def repo(monkeypatch):
+    folder = tempfile.mkdtemp("test_repo")
+    monkeypatch.chdir(folder)
+    for env in ["GIT_DIR", "GIT_WORK_TREE", "GIT_INDEX_FILE"]:
+        monkeypatch.delenv(env, raising=False)
+    subprocess.run(["git", "init", "-q", "-b", "main"], check=True)
+    with open("file.txt", "w") as f:
+        f.write("content")
+    subprocess.run(["git", "add", "file.txt"], check=True)
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com"]
+        + ["commit", "-q", "-m", "first"],
+        check=True,
+    )
+    return folder
+
+
+def test_bundle_stream(repo):
+    with git.bundle_stream(ref="main") as f:
+        content = f.read()
+    assert content.startswith(b"# v2 git bundle\n")
+
+    # The streamed bundle is a valid bundle
+    with open(os.path.join(repo, "main.bundle"), "wb") as f:
+        f.write(content)
+    result = subprocess.run(["git", "bundle", "verify", "main.bundle"])
+    assert result.returncode == 0
+
+
+def test_bundle_stream_invalid_ref(repo):
+    with pytest.raises(git.GitError):
+        with git.bundle_stream(ref="does-not-exist") as f:
+            while f.read(1024):
+                pass
+
+
+def test_archive_stream(repo):
+    with git.archive_stream(ref="main") as f:
+        content = f.read()
+    assert content.startswith(b"PK")
+
+
+def test_missing_objects(repo):
+    sha = git.rev_parse("main")
+    unknown = "0" * 40
+    assert git.missing_objects([sha, unknown]) == [unknown]
+
+
+def test_pack_objects(repo):
+    sha = git.rev_parse("main")
+    name = git.pack_objects(folder=repo, tips=[sha])
+    assert name.startswith("pack-")
+    assert os.path.exists(os.path.join(repo, f"{name}.idx"))
+    # The commit, its tree and the file
+    assert git.pack_object_count(os.path.join(repo, f"{name}.pack")) == 3
+
+    # Nothing is left once the history of the tip is excluded
+    name = git.pack_objects(folder=repo, tips=[sha], exclude=[sha])
+    assert git.pack_object_count(os.path.join(repo, f"{name}.pack")) == 0
+
+
+def test_index_pack(repo):
+    sha = git.rev_parse("main")
+    folder = tempfile.mkdtemp("test_pack")
+    name = git.pack_objects(folder=folder, tips=[sha])
+    os.remove(os.path.join(folder, f"{name}.idx"))
+    assert f"pack-{git.index_pack(os.path.join(folder, f'{name}.pack'))}" == name
+    assert os.path.exists(os.path.join(folder, f"{name}.idx"))
+
+    # A truncated download is rejected
+    with open(os.path.join(folder, f"{name}.pack"), "rb") as f:
+        content = f.read()
+    with open(os.path.join(folder, "pack-truncated.pack"), "wb") as f:
+        f.write(content[:-10])
+    with pytest.raises(git.GitError):
+        git.index_pack(os.path.join(folder, "pack-truncated.pack"))
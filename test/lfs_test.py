@@ -0,0 +1,375 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from io import StringIO
+from mock import MagicMock, patch
+from botocore.exceptions import ClientError
+from benchmarks.fake_s3 import FakeBucket, FakeS3
+from git_remote_s3.common import lfs_key
+from git_remote_s3.lfs import (
+    EventWriter,
+    LFSProcess,
+    ProgressPercentage,
+    handle_event,
+    READAHEAD_DIR,
+    READAHEAD_MAX_AGE,
+)
+from git_remote_s3.lfspack import write_pack
+
+
+def test_event_writer_writes_whole_lines():
+    stream = StringIO()
+    writer = EventWriter(stream)
+
+    def write_events(n):
+        for i in range(100):
+            writer.write({"event": "progress", "oid": f"{n}", "bytesSoFar": i})
+
+    threads = [threading.Thread(target=write_events, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    writer.close()
+    events = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert len(events) == 400
+    # The events of each transfer keep their order
+    for n in range(4):
+        assert [e["bytesSoFar"] for e in events if e["oid"] == f"{n}"] == list(
+            range(100)
+        )
+
+
+@patch("sys.stdout", new_callable=StringIO)
+def test_transfer_completes_before_next_event(stdout_mock):
+    folder = tempfile.mkdtemp()
+    bucket = MagicMock()
+    bucket.meta.client.list_objects_v2.return_value = {"KeyCount": 0}
+
+    def upload_file(path, key, Callback, **kwargs):
+        Callback(os.path.getsize(path))
+
+    bucket.upload_file.side_effect = upload_file
+    lfs_process = LFSProcess("s3://bucket/repo")
+    lfs_process.s3_bucket = bucket
+    for oid in ["a", "b"]:
+        with open(os.path.join(folder, oid), "w") as f:
+            f.write(oid)
+        handle_event(
+            lfs_process,
+            {"event": "upload", "oid": oid, "path": os.path.join(folder, oid)},
+        )
+        # git-lfs only sends the next event once this one is complete
+        assert bucket.upload_file.call_count == 1 + ["a", "b"].index(oid)
+    lfs_process.close()
+
+    events = [json.loads(line) for line in stdout_mock.getvalue().splitlines()]
+    assert events[0] == {}
+    assert [e["oid"] for e in events if e.get("event") == "complete"] == ["a", "b"]
+    assert not any("error" in e for e in events)
+
+
+@patch("git_remote_s3.lfs.boto3.Session")
+def test_connection_pool_matches_transfer_concurrency(session_mock, monkeypatch):
+    monkeypatch.setenv("GIT_LFS_S3_MAX_CONCURRENCY", "32")
+    with patch("sys.stdout", new_callable=StringIO):
+        lfs_process = LFSProcess("s3://bucket/repo")
+    lfs_process.init_s3_bucket()
+    lfs_process.close()
+
+    config = session_mock.return_value.resource.call_args.kwargs["config"]
+    assert config.max_pool_connections == 32
+
+
+def create_lfs_process(folder, objects, truncated=False):
+    with patch("sys.stdout", new_callable=StringIO):
+        lfs_process = LFSProcess("s3://bucket/repo")
+    lfs_process.s3_bucket = MagicMock()
+    client = lfs_process.s3_bucket.meta.client
+    client.list_objects_v2.return_value = {
+        "Contents": [{"Key": f"repo/lfs/{oid}", "Size": size} for oid, size in objects],
+        "IsTruncated": truncated,
+        "NextContinuationToken": "token",
+    }
+    for oid in ["a", "ab", "c"]:
+        with open(os.path.join(folder, oid), "w") as f:
+            f.write(oid)
+    return lfs_process
+
+
+def upload(lfs_process, folder, oid):
+    lfs_process.upload(
+        {"event": "upload", "oid": oid, "size": len(oid), "path": f"{folder}/{oid}"}
+    )
+
+
+def test_upload_checks_existence_in_index():
+    folder = tempfile.mkdtemp()
+    # ab is stored, a would have matched it as a prefix; c is truncated
+    lfs_process = create_lfs_process(folder, [("ab", 2), ("c", 0)])
+    for oid in ["a", "ab", "c", "a"]:
+        upload(lfs_process, folder, oid)
+    lfs_process.close()
+
+    client = lfs_process.s3_bucket.meta.client
+    client.list_objects_v2.assert_called_once_with(Bucket="bucket", Prefix="repo/lfs/")
+    client.head_object.assert_not_called()
+    uploaded = [c.args[1] for c in lfs_process.s3_bucket.upload_file.call_args_list]
+    assert uploaded == ["repo/lfs/a", "repo/lfs/c"]
+
+
+@patch("git_remote_s3.lfs.MAX_INDEX_PAGES", 2)
+def test_upload_checks_existence_with_head_beyond_index_limit():
+    folder = tempfile.mkdtemp()
+    lfs_process = create_lfs_process(folder, [("ab", 2)], truncated=True)
+    client = lfs_process.s3_bucket.meta.client
+    client.head_object.side_effect = lambda Key, **_: {
+        "ContentLength": 1 if Key == "repo/lfs/a" else 0
+    }
+    upload(lfs_process, folder, "a")
+    upload(lfs_process, folder, "c")
+    lfs_process.close()
+
+    assert client.list_objects_v2.call_count == 2
+    uploaded = [c.args[1] for c in lfs_process.s3_bucket.upload_file.call_args_list]
+    assert uploaded == ["repo/lfs/c"]
+
+
+def test_sharded_upload_finds_flat_objects(monkeypatch):
+    monkeypatch.setenv("GIT_LFS_S3_SHARDED_KEYS", "true")
+    folder = tempfile.mkdtemp()
+    lfs_process = create_lfs_process(folder, [("ab", 2)])
+    client = lfs_process.s3_bucket.meta.client
+    client.list_objects_v2.return_value["Contents"].append(
+        {"Key": lfs_key("repo", "c", sharded=True), "Size": 1}
+    )
+    for oid in ["a", "ab", "c"]:
+        upload(lfs_process, folder, oid)
+    lfs_process.close()
+
+    uploaded = [c.args[1] for c in lfs_process.s3_bucket.upload_file.call_args_list]
+    assert uploaded == [lfs_key("repo", "a", sharded=True)]
+
+
+@patch("sys.stdout", new_callable=StringIO)
+def test_sharded_download_falls_back_to_flat_key(stdout_mock, monkeypatch):
+    monkeypatch.setenv("GIT_LFS_S3_SHARDED_KEYS", "true")
+    monkeypatch.chdir(tempfile.mkdtemp("test_clone"))
+    os.makedirs(".git/lfs/tmp")
+    content = b"texture"
+    oid = hashlib.sha256(content).hexdigest()
+    requested = []
+
+    def download_fileobj(Key, Fileobj, Callback, **kwargs):
+        requested.append(Key)
+        if Key != f"repo/lfs/{oid}":
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        Fileobj.write(content)
+        Callback(len(content))
+
+    lfs_process = LFSProcess("s3://bucket/repo")
+    lfs_process.s3_bucket = MagicMock()
+    lfs_process.s3_bucket.download_fileobj.side_effect = download_fileobj
+    lfs_process.download({"event": "download", "oid": oid, "size": len(content)})
+    lfs_process.close()
+
+    assert requested == [f"repo/lfs/{oid[:2]}/{oid[2:4]}/{oid}", f"repo/lfs/{oid}"]
+    with open(f".git/lfs/tmp/{oid}", "rb") as f:
+        assert f.read() == content
+
+
+def test_progress_is_coalesced_and_exact():
+    stream = StringIO()
+    writer = EventWriter(stream)
+    progress = ProgressPercentage(
+        "oid", writer, size=10_000, interval=3600, threshold=4096
+    )
+    for _ in range(10):
+        progress(1000)
+    progress.flush()
+    writer.close()
+    events = [json.loads(line) for line in stream.getvalue().splitlines()]
+    # Every 4096 bytes, then at the size of the object
+    assert [(e["bytesSoFar"], e["bytesSinceLast"]) for e in events] == [
+        (5000, 5000),
+        (10000, 5000),
+    ]
+
+
+def test_progress_flush_reports_remaining_bytes():
+    stream = StringIO()
+    writer = EventWriter(stream)
+    progress = ProgressPercentage("oid", writer, interval=3600, threshold=4096)
+    progress(100)
+    progress(200)
+    progress.flush()
+    progress.flush()
+    writer.close()
+    events = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert events == [
+        {"event": "progress", "oid": "oid", "bytesSoFar": 300, "bytesSinceLast": 300}
+    ]
+
+
+def test_progress_restart_does_not_go_back():
+    stream = StringIO()
+    writer = EventWriter(stream)
+    progress = ProgressPercentage("oid", writer, size=300, interval=0, threshold=1)
+    progress(200)
+    progress.restart()
+    progress(100)
+    progress(100)
+    progress(100)
+    progress.flush()
+    writer.close()
+    events = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [(e["bytesSoFar"], e["bytesSinceLast"]) for e in events] == [
+        (200, 200),
+        (300, 100),
+    ]
+
+
+def test_download_from_shared_cache(monkeypatch):
+    monkeypatch.setenv("GIT_LFS_S3_CACHE", "true")
+    monkeypatch.setenv("GIT_LFS_S3_CACHE_DIR", tempfile.mkdtemp("test_cache"))
+    content = b"texture"
+    oid = hashlib.sha256(content).hexdigest()
+
+    def download_fileobj(Key, Fileobj, Callback, **kwargs):
+        Fileobj.write(content)
+        Callback(len(content))
+
+    # The first clone downloads the object, the second one gets it from the cache
+    for _ in range(2):
+        clone = tempfile.mkdtemp("test_clone")
+        monkeypatch.chdir(clone)
+        os.makedirs(".git/lfs/tmp")
+        with patch("sys.stdout", new_callable=StringIO):
+            lfs_process = LFSProcess("s3://bucket/repo")
+        lfs_process.s3_bucket = MagicMock()
+        lfs_process.s3_bucket.download_fileobj.side_effect = download_fileobj
+        lfs_process.download({"event": "download", "oid": oid, "size": len(content)})
+        lfs_process.close()
+        with open(f".git/lfs/tmp/{oid}", "rb") as f:
+            assert f.read() == content
+    lfs_process.s3_bucket.download_fileobj.assert_not_called()
+
+
+def test_transfer_config_from_settings(monkeypatch):
+    monkeypatch.setenv("GIT_LFS_S3_MULTIPART_THRESHOLD", "64m")
+    monkeypatch.setenv("GIT_LFS_S3_MULTIPART_CHUNK_SIZE", "32m")
+    monkeypatch.setenv("GIT_LFS_S3_MAX_CONCURRENCY", "4")
+    monkeypatch.setenv("GIT_LFS_S3_MAX_MEMORY", "128m")
+    with patch("sys.stdout", new_callable=StringIO):
+        lfs_process = LFSProcess("s3://bucket/repo")
+    lfs_process.close()
+    config = lfs_process.transfer_config
+    assert config.multipart_threshold == 64 * 1024**2
+    assert config.multipart_chunksize == 32 * 1024**2
+    assert config.max_concurrency == 4
+    assert config.max_in_memory_upload_chunks == 4
+    assert config.max_in_memory_download_chunks == 128 * 1024**2 // config.io_chunksize
+
+
+@patch("sys.stdout", new_callable=StringIO)
+def test_download_verifies_sha256(stdout_mock, monkeypatch):
+    monkeypatch.chdir(tempfile.mkdtemp("test_clone"))
+    os.makedirs(".git/lfs/tmp")
+    content = b"texture"
+    oid = hashlib.sha256(content).hexdigest()
+    bodies = [b"texturf", content, b"texturf", b"texturf"]
+
+    def download_fileobj(Key, Fileobj, Callback, **kwargs):
+        body = bodies.pop(0)
+        # Ranges arrive in order, boto3 buffers those received early
+        for i in range(0, len(body), 3):
+            Fileobj.write(body[i : i + 3])
+            Callback(len(body[i : i + 3]))
+
+    lfs_process = LFSProcess("s3://bucket/repo")
+    lfs_process.s3_bucket = MagicMock()
+    lfs_process.s3_bucket.download_fileobj.side_effect = download_fileobj
+    # Corrupted once, then downloaded again
+    lfs_process.download({"event": "download", "oid": oid, "size": len(content)})
+    # Corrupted every time
+    lfs_process.download({"event": "download", "oid": oid, "size": len(content)})
+    lfs_process.close()
+
+    events = [json.loads(line) for line in stdout_mock.getvalue().splitlines()]
+    complete = [e for e in events if e.get("event") == "complete"]
+    assert complete[0] == {
+        "event": "complete",
+        "oid": oid,
+        "path": os.path.abspath(f".git/lfs/tmp/{oid}"),
+    }
+    assert "error" in complete[1]
+    # The progress of the first download ends at the size of the object
+    progress = [e for e in events[: events.index(complete[0])] if "bytesSoFar" in e]
+    assert progress[-1]["bytesSoFar"] == len(content)
+    # The progress never goes back, the retries are reported from the bytes
+    # already reported on
+    assert all(e["bytesSinceLast"] > 0 for e in events if "bytesSinceLast" in e)
+    assert sum(e["bytesSinceLast"] for e in progress) == len(content)
+
+
+@patch("sys.stdout", new_callable=StringIO)
+def test_download_packed_objects_with_readahead(stdout_mock, monkeypatch):
+    monkeypatch.setenv("GIT_LFS_S3_PACKS", "true")
+    monkeypatch.setenv("GIT_LFS_S3_PACK_READAHEAD", "20")
+    monkeypatch.chdir(tempfile.mkdtemp("test_clone"))
+    os.makedirs(".git/lfs/tmp")
+    s3 = FakeS3()
+    contents = [b"sprite-0", b"sprite-1", b"sprite-2", b"large-texture"]
+    oids = [hashlib.sha256(c).hexdigest() for c in contents]
+    write_pack(s3, "bucket", "repo", list(zip(oids[:3], contents[:3])))
+    s3.put_object(Bucket="bucket", Key=f"repo/lfs/{oids[3]}", Body=contents[3])
+
+    lfs_process = LFSProcess("s3://bucket/repo")
+    lfs_process.s3_bucket = FakeBucket(s3, "bucket")
+    for oid, content in zip(oids, contents):
+        lfs_process.download({"event": "download", "oid": oid, "size": len(content)})
+    lfs_process.close()
+
+    for oid, content in zip(oids, contents):
+        with open(f".git/lfs/tmp/{oid}", "rb") as f:
+            assert f.read() == content
+    # The index, the first two sprites in one range, the third one and the
+    # object that is not packed
+    assert s3.calls["GetObject"] == 4
+    assert os.listdir(READAHEAD_DIR) == []
+    events = [json.loads(line) for line in stdout_mock.getvalue().splitlines()]
+    assert not any("error" in e for e in events)
+
+
+@patch("sys.stdout", new_callable=StringIO)
+def test_readahead_skips_claimed_objects_and_is_removed(stdout_mock, monkeypatch):
+    monkeypatch.setenv("GIT_LFS_S3_PACKS", "true")
+    monkeypatch.setenv("GIT_LFS_S3_PACK_READAHEAD", "100")
+    monkeypatch.chdir(tempfile.mkdtemp("test_clone"))
+    os.makedirs(".git/lfs/tmp")
+    s3 = FakeS3()
+    contents = [b"sprite-0", b"sprite-1", b"sprite-2"]
+    oids = [hashlib.sha256(c).hexdigest() for c in contents]
+    write_pack(s3, "bucket", "repo", list(zip(oids, contents)))
+    # The second sprite is checked out already, a file left by a process that
+    # was killed is stale
+    local = f".git/lfs/objects/{oids[1][0:2]}/{oids[1][2:4]}"
+    os.makedirs(local)
+    with open(f"{local}/{oids[1]}", "wb") as f:
+        f.write(contents[1])
+    os.makedirs(READAHEAD_DIR)
+    stale = os.path.join(READAHEAD_DIR, "stale")
+    open(stale, "w").close()
+    old = os.path.getmtime(stale) - READAHEAD_MAX_AGE - 1
+    os.utime(stale, (old, old))
+
+    lfs_process = LFSProcess("s3://bucket/repo")
+    lfs_process.s3_bucket = FakeBucket(s3, "bucket")
+    lfs_process.download({"event": "download", "oid": oids[0], "size": 8})
+    assert sorted(os.listdir(READAHEAD_DIR)) == sorted([oids[2], "stale"])
+    # git-lfs terminates the process without asking for the third sprite
+    lfs_process.close()
+
+    assert os.listdir(READAHEAD_DIR) == []
@@ -0,0 +1,77 @@
+import hashlib
+import os
+import tempfile
+from mock import patch
+from benchmarks.fake_s3 import FakeS3
+from git_remote_s3.lfspack import PackIndex, pack_key
+from git_remote_s3.manage import MigrateLFSKeys, PackLFSObjects
+
+
+@patch("git_remote_s3.manage.boto3")
+def test_migrate_lfs_keys(boto3_mock):
+    s3 = FakeS3()
+    boto3_mock.Session.return_value.client.return_value = s3
+    oids = [hashlib.sha256(f"{i}".encode()).hexdigest() for i in range(5)]
+    for oid in oids[:3]:
+        s3.put_object(Bucket="bucket", Key=f"repo/lfs/{oid}", Body=oid)
+    sharded = f"repo/lfs/{oids[3][:2]}/{oids[3][2:4]}/{oids[3]}"
+    s3.put_object(Bucket="bucket", Key=sharded, Body=oids[3])
+    s3.put_object(Bucket="bucket", Key="repo/lfs/not-an-oid", Body="x")
+    s3.put_object(Bucket="bucket", Key=f"other/lfs/{oids[4]}", Body=oids[4])
+
+    MigrateLFSKeys(None, "bucket", "repo", 2).run()
+
+    # The flat keys are kept for the clients that only read those
+    sharded_keys = [f"repo/lfs/{oid[:2]}/{oid[2:4]}/{oid}" for oid in oids[:4]]
+    flat_keys = [f"repo/lfs/{oid}" for oid in oids[:3]]
+    others = ["repo/lfs/not-an-oid", f"other/lfs/{oids[4]}"]
+    keys = sorted(k for _, k in s3.objects)
+    assert keys == sorted(sharded_keys + flat_keys + others)
+    assert s3.calls["CopyObject"] == 3
+    assert s3.objects[("bucket", sharded)]["Body"] == oids[3].encode()
+
+    # An object pushed with a flat key since is not deleted until copied
+    late = hashlib.sha256(b"late").hexdigest()
+    s3.put_object(Bucket="bucket", Key=f"repo/lfs/{late}", Body=late)
+    MigrateLFSKeys(None, "bucket", "repo", 2, delete_flat=True).run()
+
+    keys = sorted(k for _, k in s3.objects)
+    assert keys == sorted(sharded_keys + [f"repo/lfs/{late}"] + others)
+    assert s3.calls["CopyObject"] == 3
+
+
+@patch("git_remote_s3.manage.lfs_objects_dir")
+@patch("git_remote_s3.manage.boto3")
+def test_pack_lfs(boto3_mock, lfs_objects_dir_mock, monkeypatch):
+    monkeypatch.setenv("GIT_LFS_S3_PACK_THRESHOLD", "10")
+    monkeypatch.setenv("GIT_LFS_S3_PACK_SIZE", "32")
+    s3 = FakeS3()
+    boto3_mock.Session.return_value.client.return_value = s3
+    local = tempfile.mkdtemp()
+    lfs_objects_dir_mock.return_value = local
+    contents = [b"sprite-0", b"sprite-1", b"sprite-2", b"large-texture", b""]
+    oids = [hashlib.sha256(c).hexdigest() for c in contents]
+    for oid, content in zip(oids, contents):
+        s3.put_object(Bucket="bucket", Key=f"repo/lfs/{oid}", Body=content)
+    # Read from the local LFS store rather than downloaded
+    os.makedirs(os.path.join(local, oids[0][:2], oids[0][2:4]))
+    with open(os.path.join(local, oids[0][:2], oids[0][2:4], oids[0]), "wb") as f:
+        f.write(contents[0])
+
+    PackLFSObjects(None, "bucket", "repo", 2).run()
+
+    assert s3.calls["GetObject"] == 2
+    index = PackIndex.load(s3, "bucket", "repo")
+    # The large and the empty objects are not packed
+    assert len(index.packs) == 1
+    assert sorted(index.objects) == sorted(oids[:3])
+    pack = list(index.packs)[0]
+    body = s3.objects[("bucket", pack_key("repo", pack, "pack"))]["Body"]
+    for oid, offset, size in index.packs[pack]:
+        assert hashlib.sha256(body[offset : offset + size]).hexdigest() == oid
+    # The objects keep their own S3 object
+    assert ("bucket", f"repo/lfs/{oids[0]}") in s3.objects
+
+    # Already packed objects are not packed again
+    PackLFSObjects(None, "bucket", "repo", 2).run()
+    assert len(PackIndex.load(s3, "bucket", "repo").packs) == 1
@@ -0,0 +1,144 @@
+import datetime
+import json
+from io import BytesIO
+from mock import MagicMock
+from botocore.exceptions import ClientError
+from benchmarks.fake_s3 import FakeS3
+from git_remote_s3.manifest import Manifest
+
+SHA1 = "c105d19ba64965d2c9d3d3246e7269059ef8bb8a"
+SHA2 = "c105d19ba64965d2c9d3d3246e7269059ef8bb8b"
+
+
+def obj(key, size=10, minutes=0):
+    return {
+        "Key": key,
+        "Size": size,
+        "LastModified": datetime.datetime(2024, 1, 1)
+        + datetime.timedelta(minutes=minutes),
+    }
+
+
+def test_from_objects():
+    manifest = Manifest.from_objects(
+        [
+            obj(f"repo/refs/heads/main/{SHA1}.bundle", size=100, minutes=1),
+            obj("repo/refs/heads/main/PROTECTED#", size=0),
+            obj(f"repo/refs/heads/main/CHAIN#/000000-{SHA2}.bundle", size=50),
+            obj("repo/refs/heads/main/repo.zip"),
+            obj(f"repo/refs/tags/v1/{SHA2}.bundle"),
+        ],
+        "repo",
+    )
+    assert manifest.refs == {
+        "refs/heads/main": {
+            "sha": SHA1,
+            "bundle": f"refs/heads/main/{SHA1}.bundle",
+            "size": 100,
+            "protected": True,
+            "chain": [
+                {"key": f"refs/heads/main/CHAIN#/000000-{SHA2}.bundle", "size": 50}
+            ],
+        },
+        "refs/tags/v1": {
+            "sha": SHA2,
+            "bundle": f"refs/tags/v1/{SHA2}.bundle",
+            "size": 10,
+            "protected": False,
+        },
+    }
+
+
+def test_from_objects_multiple_bundles_keeps_newest():
+    manifest = Manifest.from_objects(
+        [
+            obj(f"repo/refs/heads/main/{SHA1}.bundle", minutes=2),
+            obj(f"repo/refs/heads/main/{SHA2}.bundle", minutes=1),
+        ],
+        "repo",
+    )
+    assert manifest.get_sha("refs/heads/main") == SHA1
+
+
+def test_load_and_save():
+    s3 = MagicMock()
+    manifest = Manifest()
+    manifest.set_ref("refs/heads/main", sha=SHA1, size=10)
+    manifest.set_protected("refs/heads/main", True)
+    manifest.save(s3, "bucket", "repo")
+    body = s3.put_object.call_args.kwargs["Body"]
+    assert s3.put_object.call_args.kwargs["Key"] == "repo/manifest.json"
+
+    s3.get_object.return_value = {"Body": BytesIO(body)}
+    loaded = Manifest.load(s3, "bucket", "repo")
+    assert loaded.refs == manifest.refs
+    assert loaded.is_protected("refs/heads/main")
+
+    # A new bundle keeps the protection flag of the ref
+    loaded.set_ref("refs/heads/main", sha=SHA2, size=20)
+    assert loaded.is_protected("refs/heads/main")
+
+
+def test_save_is_conditional():
+    s3 = FakeS3()
+    first = Manifest()
+    first.set_ref("refs/heads/main", sha=SHA1, size=10)
+    assert first.save(s3, "bucket", "repo")
+    # Another client loaded the manifest and writes it first
+    second = Manifest.load(s3, "bucket", "repo")
+    second.set_ref("refs/heads/other", sha=SHA2, size=10)
+    assert second.save(s3, "bucket", "repo")
+
+    first.set_ref("refs/heads/main", sha=SHA2, size=10)
+    assert not first.save(s3, "bucket", "repo")
+    # A new manifest is not written over an existing one
+    assert not Manifest().save(s3, "bucket", "repo")
+    assert Manifest.load(s3, "bucket", "repo").refs == second.refs
+
+
+def test_load_missing_or_unknown_version():
+    s3 = MagicMock()
+    s3.get_object.side_effect = ClientError(
+        {"Error": {"Code": "NoSuchKey"}}, "get_object"
+    )
+    assert Manifest.load(s3, "bucket", "repo") is None
+
+    s3.get_object.side_effect = None
+    s3.get_object.return_value = {
+        "Body": BytesIO(json.dumps({"version": 99, "refs": {}}).encode())
+    }
+    assert Manifest.load(s3, "bucket", "repo") is None
+
+
+def test_pack_layout():
+    s3 = MagicMock()
+    manifest = Manifest(layout="pack")
+    manifest.add_pack({"name": "pack-1", "size": 100, "tips": [SHA1]})
+    manifest.set_pack_ref("refs/heads/main", sha=SHA1, pack="pack-1")
+    manifest.add_pack({"name": "pack-2", "size": 10, "tips": [SHA2]})
+    manifest.add_pack({"name": "pack-1", "size": 100, "tips": [SHA1]})
+    manifest.set_pack_ref("refs/heads/feature", sha=SHA2, pack="pack-2")
+    # A ref to a commit already pushed only needs the packs up to its own
+    manifest.set_pack_ref("refs/tags/v1", sha=SHA1)
+    manifest.save(s3, "bucket", "repo")
+
+    s3.get_object.return_value = {
+        "Body": BytesIO(s3.put_object.call_args.kwargs["Body"])
+    }
+    loaded = Manifest.load(s3, "bucket", "repo")
+    assert loaded.layout == "pack"
+    assert [p["name"] for p in loaded.packs] == ["pack-1", "pack-2"]
+    assert [p["name"] for p in loaded.get_packs("refs/heads/main")] == ["pack-1"]
+    assert [p["name"] for p in loaded.get_packs("refs/tags/v1")] == ["pack-1"]
+    assert [p["name"] for p in loaded.get_packs("refs/heads/feature")] == [
+        "pack-1",
+        "pack-2",
+    ]
+    assert loaded.get_packs("refs/heads/unknown") == []
+
+
+def test_bundle_layout_saved_without_packs():
+    s3 = MagicMock()
+    Manifest().save(s3, "bucket", "repo")
+    content = json.loads(s3.put_object.call_args.kwargs["Body"])
+    assert content == {"version": 1, "refs": {}}
@@ -0,0 +1,74 @@
+import json
+import os
+import tempfile
+import boto3
+from git_remote_s3.metrics import Metrics
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics()
+    metrics.record("git", "bundle", 1.0)
+    metrics.add_bytes("uploaded", 10)
+    metrics.count("retries.upload_part")
+    metrics.write()
+    assert metrics.timings["git"] == {}
+    assert metrics.bytes["uploaded"] == 0
+    assert metrics.counters == {}
+
+
+def test_metrics_written_as_json_line():
+    path = os.path.join(tempfile.mkdtemp("test_metrics"), "metrics.jsonl")
+    metrics = Metrics()
+    metrics.start("git-remote-s3", path)
+    metrics.record("git", "bundle", 1.0)
+    metrics.record("git", "bundle", 3.0)
+    with metrics.timer("commands", "push"):
+        pass
+    metrics.add_bytes("uploaded", 10)
+    metrics.add_bytes("downloaded", 5)
+    metrics.count("retries.upload_part")
+    metrics.write()
+    metrics.write()
+
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 2
+    record = json.loads(lines[0])
+    assert record["process"] == "git-remote-s3"
+    assert record["git"] == {"bundle": {"count": 2, "seconds": 4.0, "max_seconds": 3.0}}
+    assert record["commands"]["push"]["count"] == 1
+    assert record["bytes"] == {"uploaded": 10, "downloaded": 5}
+    assert record["counters"] == {"retries.upload_part": 1}
+
+
+def test_metrics_record_s3_calls():
+    metrics = Metrics()
+    metrics.start("git-remote-s3", os.devnull)
+    s3 = boto3.client(
+        "s3",
+        region_name="us-east-1",
+        aws_access_key_id="test",
+        aws_secret_access_key="test",
+    )
+    metrics.attach(s3)
+    # The events emitted by the client around a call
+    model = s3.meta.service_model.operation_model("HeadObject")
+    context = {}
+    s3.meta.events.emit(
+        "before-call.s3.HeadObject", model=model, params={}, context=context
+    )
+    s3.meta.events.emit(
+        "after-call.s3.HeadObject",
+        http_response=None,
+        parsed={"ResponseMetadata": {"RetryAttempts": 2}},
+        model=model,
+        context=context,
+    )
+    s3.meta.events.emit(
+        "before-call.s3.HeadObject", model=model, params={}, context=context
+    )
+    s3.meta.events.emit(
+        "after-call-error.s3.HeadObject", exception=Exception(), context=context
+    )
+    assert metrics.timings["s3"]["HeadObject"]["count"] == 2
+    assert metrics.counters == {"retries.s3": 2, "errors.HeadObject": 1}
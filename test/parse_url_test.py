@@ -136,6 +136,15 @@ def test_parse_url_uri_scheme_s3_zip():
     assert prefix == "path/to"
 
 
+def test_parse_url_uri_scheme_s3_pack():
+    url = "s3+pack://profile-test@bucket-name/path/to"
+    uri_scheme, profile, bucket, prefix = parse_git_url(url)
+    assert uri_scheme == UriScheme.S3_PACK
+    assert bucket == "bucket-name"
+    assert profile == "profile-test"
+    assert prefix == "path/to"
+
+
 def test_parse_url_uri_scheme_not_valid():
     url = "s3+foo://bucket-name/path/to"
     uri_scheme, profile, bucket, prefix = parse_git_url(url)
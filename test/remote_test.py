@@ -1,22 +1,44 @@
+import boto3.exceptions
 import botocore.client
-from mock import patch
+from mock import patch, ANY
 from io import StringIO, BytesIO
 from git_remote_s3 import S3Remote, UriScheme
+from git_remote_s3.git import GitError
+from git_remote_s3.remote import NotAuthorizedError, LayoutMismatchError
+from git_remote_s3.manifest import Manifest
 from botocore.exceptions import ClientError
 import tempfile
+import pytest
+from contextlib import nullcontext
+import threading
+import time
 import datetime
+import json
+import os
 import botocore
 
 SHA1 = "c105d19ba64965d2c9d3d3246e7269059ef8bb8a"
 SHA2 = "c105d19ba64965d2c9d3d3246e7269059ef8bb8b"
 INVALID_SHA = "z45"
-BUNDLE_SUFFIX = ".bundle"
 MOCK_BUNDLE_CONTENT = b"MOCK_BUNDLE_CONTENT"
-ARCHIVE_SUFFIX = ".zip"
 MOCK_ARCHIVE_CONTENT = b"MOCK_ARCHIVE_CONTENT"
 BRANCH = "pytest"
 
 
+@pytest.fixture(autouse=True)
+def no_manifest():
+    # Unless a test provides one, remotes have no manifest and refs are listed
+    with patch("git_remote_s3.manifest.Manifest.load", return_value=None) as m:
+        yield m
+
+
+def create_stream_mock(content):
+    def stream_mock(**kwargs):
+        return nullcontext(BytesIO(content))
+
+    return stream_mock
+
+
 def create_list_objects_v2_mock(
     *,
     protected=False,
@@ -31,6 +53,7 @@ def create_list_objects_v2_mock(
                 {
                     "Key": f"test_prefix/refs/heads/{branch}/{s}.bundle",
                     "LastModified": datetime.datetime.now(),
+                    "Size": len(MOCK_BUNDLE_CONTENT),
                 }
             )
         if protected:
@@ -63,7 +86,7 @@ def test_cmd_list(session_client_mock, stdout_mock):
     session_client_mock.return_value.list_objects_v2.side_effect = (
         create_list_objects_v2_mock(shas=[SHA1])
     )
-    session_client_mock.assert_called_once_with("s3")
+    session_client_mock.assert_not_called()
     assert s3_remote.bucket == "test_bucket"
     assert s3_remote.prefix == "test_prefix"
     assert s3_remote.s3 == session_client_mock.return_value
@@ -95,7 +118,7 @@ def test_list_refs(session_client_mock, stdout_mock):
         ]
     }
 
-    session_client_mock.assert_called_once_with("s3")
+    session_client_mock.assert_not_called()
     assert s3_remote.bucket == "test_bucket"
     assert s3_remote.prefix == "nested/test_prefix"
     assert s3_remote.s3 == session_client_mock.return_value
@@ -122,7 +145,7 @@ def test_cmd_list_nested_prefix(session_client_mock, stdout_mock):
             },
         ]
     }
-    session_client_mock.assert_called_once_with("s3")
+    session_client_mock.assert_not_called()
     assert s3_remote.bucket == "test_bucket"
     assert s3_remote.prefix == "nested/test_prefix"
     assert s3_remote.s3 == session_client_mock.return_value
@@ -151,7 +174,7 @@ def test_cmd_list_no_head(session_client_mock, stdout_mock):
         )
 
     session_client_mock.return_value.get_object.side_effect = error
-    session_client_mock.assert_called_once_with("s3")
+    session_client_mock.assert_not_called()
     assert s3_remote.bucket == "test_bucket"
     assert s3_remote.prefix == "test_prefix"
     assert s3_remote.s3 == session_client_mock.return_value
@@ -170,7 +193,7 @@ def test_cmd_list_with_head_not_exsting_ref(session_client_mock, stdout_mock):
     session_client_mock.return_value.get_object.return_value = {
         "Body": BytesIO(b"refs/heads/master")
     }
-    session_client_mock.assert_called_once_with("s3")
+    session_client_mock.assert_not_called()
     assert s3_remote.bucket == "test_bucket"
     assert s3_remote.prefix == "test_prefix"
     assert s3_remote.s3 == session_client_mock.return_value
@@ -190,7 +213,7 @@ def test_cmd_list_protected_branch(session_client_mock, stdout_mock):
     session_client_mock.return_value.get_object.return_value = {
         "Body": BytesIO(b"refs/heads/%b" % str.encode(BRANCH))
     }
-    session_client_mock.assert_called_once_with("s3")
+    session_client_mock.assert_not_called()
     assert s3_remote.bucket == "test_bucket"
     assert s3_remote.prefix == "test_prefix"
     assert s3_remote.s3 == session_client_mock.return_value
@@ -203,33 +226,32 @@ def test_cmd_list_protected_branch(session_client_mock, stdout_mock):
 
 @patch("git_remote_s3.git.is_ancestor")
 @patch("git_remote_s3.git.rev_parse")
-@patch("git_remote_s3.git.bundle")
+@patch("git_remote_s3.git.bundle_stream")
 @patch("boto3.Session.client")
 def test_cmd_push_no_force_unprotected_ancestor(
     session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock
 ):
     s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
     rev_parse_mock.return_value = SHA1
-    temp_dir = tempfile.mkdtemp("test_temp")
-    temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=BUNDLE_SUFFIX)
-    with open(temp_file.name, "wb") as f:
-        f.write(MOCK_BUNDLE_CONTENT)
-    bundle_mock.return_value = temp_file.name
+    bundle_mock.side_effect = create_stream_mock(MOCK_BUNDLE_CONTENT)
     session_client_mock.return_value.list_objects_v2.side_effect = (
-        create_list_objects_v2_mock(protected=True, shas=[SHA1])
+        create_list_objects_v2_mock(protected=True, shas=[SHA2])
     )
     is_ancestor_mock.return_value = True
     assert s3_remote.s3 == session_client_mock.return_value
     res = s3_remote.cmd_push(f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}")
     assert session_client_mock.return_value.put_object.call_count == 1
+    # Deleted once the manifest no longer points to them
+    session_client_mock.return_value.delete_object.assert_not_called()
+    s3_remote.write_manifest([res])
     assert session_client_mock.return_value.delete_object.call_count == 1
     assert res == (f"ok refs/heads/{BRANCH}\n")
 
 
-@patch("git_remote_s3.git.archive")
+@patch("git_remote_s3.git.archive_stream")
 @patch("git_remote_s3.git.is_ancestor")
 @patch("git_remote_s3.git.rev_parse")
-@patch("git_remote_s3.git.bundle")
+@patch("git_remote_s3.git.bundle_stream")
 @patch("boto3.Session.client")
 def test_cmd_push_no_force_unprotected_ancestor_s3_zip(
     session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock, archive_mock
@@ -237,19 +259,12 @@ def test_cmd_push_no_force_unprotected_ancestor_s3_zip(
     s3_remote = S3Remote(UriScheme.S3_ZIP, None, "test_bucket", "test_prefix")
     rev_parse_mock.return_value = SHA1
 
-    temp_dir = tempfile.mkdtemp("test_temp")
-    temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=BUNDLE_SUFFIX)
-    with open(temp_file.name, "wb") as f:
-        f.write(MOCK_BUNDLE_CONTENT)
-    bundle_mock.return_value = temp_file.name
+    bundle_mock.side_effect = create_stream_mock(MOCK_BUNDLE_CONTENT)
 
-    temp_file_archive = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=ARCHIVE_SUFFIX)
-    with open(temp_file_archive.name, "wb") as f:
-        f.write(MOCK_ARCHIVE_CONTENT)
-    archive_mock.return_value = temp_file_archive.name
+    archive_mock.side_effect = create_stream_mock(MOCK_ARCHIVE_CONTENT)
 
     session_client_mock.return_value.list_objects_v2.side_effect = (
-        create_list_objects_v2_mock(protected=True, shas=[SHA1])
+        create_list_objects_v2_mock(protected=True, shas=[SHA2])
     )
 
     is_ancestor_mock.return_value = True
@@ -258,24 +273,39 @@ def test_cmd_push_no_force_unprotected_ancestor_s3_zip(
 
     res = s3_remote.cmd_push(f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}")
     assert session_client_mock.return_value.put_object.call_count == 2
+    # Deleted once the manifest no longer points to them
+    session_client_mock.return_value.delete_object.assert_not_called()
+    s3_remote.write_manifest([res])
     assert session_client_mock.return_value.delete_object.call_count == 1
     assert res == (f"ok refs/heads/{BRANCH}\n")
 
 
+@patch("git_remote_s3.git.rev_parse")
+@patch("git_remote_s3.git.bundle_stream")
+@patch("boto3.Session.client")
+def test_cmd_push_up_to_date(session_client_mock, bundle_mock, rev_parse_mock):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    rev_parse_mock.return_value = SHA1
+    session_client_mock.return_value.list_objects_v2.side_effect = (
+        create_list_objects_v2_mock(shas=[SHA1])
+    )
+    res = s3_remote.cmd_push(f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}")
+    assert res == f"ok refs/heads/{BRANCH}\n"
+    bundle_mock.assert_not_called()
+    session_client_mock.return_value.put_object.assert_not_called()
+    session_client_mock.return_value.delete_object.assert_not_called()
+
+
 @patch("git_remote_s3.git.is_ancestor")
 @patch("git_remote_s3.git.rev_parse")
-@patch("git_remote_s3.git.bundle")
+@patch("git_remote_s3.git.bundle_stream")
 @patch("boto3.Session.client")
 def test_cmd_push_no_force_unprotected_no_ancestor(
     session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock
 ):
     s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
     rev_parse_mock.return_value = SHA1
-    temp_dir = tempfile.mkdtemp("test_temp")
-    temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=BUNDLE_SUFFIX)
-    with open(temp_file.name, "wb") as f:
-        f.write(MOCK_BUNDLE_CONTENT)
-    bundle_mock.return_value = temp_file.name
+    bundle_mock.side_effect = create_stream_mock(MOCK_BUNDLE_CONTENT)
     session_client_mock.return_value.list_objects_v2.side_effect = (
         create_list_objects_v2_mock(shas=[SHA2])
     )
@@ -290,18 +320,14 @@ def test_cmd_push_no_force_unprotected_no_ancestor(
 
 @patch("git_remote_s3.git.is_ancestor")
 @patch("git_remote_s3.git.rev_parse")
-@patch("git_remote_s3.git.bundle")
+@patch("git_remote_s3.git.bundle_stream")
 @patch("boto3.Session.client")
 def test_cmd_push_force_no_ancestor(
     session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock
 ):
     s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
     rev_parse_mock.return_value = SHA1
-    temp_dir = tempfile.mkdtemp("test_temp")
-    temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=BUNDLE_SUFFIX)
-    with open(temp_file.name, "wb") as f:
-        f.write(MOCK_BUNDLE_CONTENT)
-    bundle_mock.return_value = temp_file.name
+    bundle_mock.side_effect = create_stream_mock(MOCK_BUNDLE_CONTENT)
     session_client_mock.return_value.list_objects_v2.side_effect = (
         create_list_objects_v2_mock(shas=[SHA2])
     )
@@ -309,14 +335,17 @@ def test_cmd_push_force_no_ancestor(
     assert s3_remote.s3 == session_client_mock.return_value
     res = s3_remote.cmd_push(f"push +refs/heads/{BRANCH}:refs/heads/{BRANCH}")
     assert session_client_mock.return_value.put_object.call_count == 1
+    # Deleted once the manifest no longer points to them
+    session_client_mock.return_value.delete_object.assert_not_called()
+    s3_remote.write_manifest([res])
     assert session_client_mock.return_value.delete_object.call_count == 1
     assert res.startswith("ok")
 
 
-@patch("git_remote_s3.git.archive")
+@patch("git_remote_s3.git.archive_stream")
 @patch("git_remote_s3.git.is_ancestor")
 @patch("git_remote_s3.git.rev_parse")
-@patch("git_remote_s3.git.bundle")
+@patch("git_remote_s3.git.bundle_stream")
 @patch("boto3.Session.client")
 def test_cmd_push_force_no_ancestor_s3_zip(
     session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock, archive_mock
@@ -325,16 +354,9 @@ def test_cmd_push_force_no_ancestor_s3_zip(
 
     rev_parse_mock.return_value = SHA1
 
-    temp_dir = tempfile.mkdtemp("test_temp")
-    temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=BUNDLE_SUFFIX)
-    with open(temp_file.name, "wb") as f:
-        f.write(MOCK_BUNDLE_CONTENT)
-    bundle_mock.return_value = temp_file.name
+    bundle_mock.side_effect = create_stream_mock(MOCK_BUNDLE_CONTENT)
 
-    temp_file_archive = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=ARCHIVE_SUFFIX)
-    with open(temp_file_archive.name, "wb") as f:
-        f.write(MOCK_ARCHIVE_CONTENT)
-    archive_mock.return_value = temp_file_archive.name
+    archive_mock.side_effect = create_stream_mock(MOCK_ARCHIVE_CONTENT)
 
     session_client_mock.return_value.list_objects_v2.side_effect = (
         create_list_objects_v2_mock(shas=[SHA2])
@@ -346,24 +368,23 @@ def test_cmd_push_force_no_ancestor_s3_zip(
 
     res = s3_remote.cmd_push(f"push +refs/heads/{BRANCH}:refs/heads/{BRANCH}")
     assert session_client_mock.return_value.put_object.call_count == 2
+    # Deleted once the manifest no longer points to them
+    session_client_mock.return_value.delete_object.assert_not_called()
+    s3_remote.write_manifest([res])
     assert session_client_mock.return_value.delete_object.call_count == 1
     assert res.startswith("ok")
 
 
 @patch("git_remote_s3.git.is_ancestor")
 @patch("git_remote_s3.git.rev_parse")
-@patch("git_remote_s3.git.bundle")
+@patch("git_remote_s3.git.bundle_stream")
 @patch("boto3.Session.client")
 def test_cmd_push_force_no_ancestor_protected(
     session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock
 ):
     s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
     rev_parse_mock.return_value = SHA1
-    temp_dir = tempfile.mkdtemp("test_temp")
-    temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=BUNDLE_SUFFIX)
-    with open(temp_file.name, "wb") as f:
-        f.write(MOCK_BUNDLE_CONTENT)
-    bundle_mock.return_value = temp_file.name
+    bundle_mock.side_effect = create_stream_mock(MOCK_BUNDLE_CONTENT)
     session_client_mock.return_value.list_objects_v2.side_effect = (
         create_list_objects_v2_mock(protected=True, shas=[SHA2])
     )
@@ -377,35 +398,40 @@ def test_cmd_push_force_no_ancestor_protected(
 
 @patch("git_remote_s3.git.is_ancestor")
 @patch("git_remote_s3.git.rev_parse")
-@patch("git_remote_s3.git.bundle")
+@patch("git_remote_s3.git.bundle_stream")
 @patch("boto3.Session.client")
 def test_cmd_push_empty_bucket(
     session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock
 ):
     s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
     rev_parse_mock.return_value = SHA1
-    temp_dir = tempfile.mkdtemp("test_temp")
-    temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=BUNDLE_SUFFIX)
-    with open(temp_file.name, "wb") as f:
-        f.write(MOCK_BUNDLE_CONTENT)
-    bundle_mock.return_value = temp_file.name
+    bundle_mock.side_effect = create_stream_mock(MOCK_BUNDLE_CONTENT)
 
     session_client_mock.return_value.head_object.side_effect = ClientError(
         {"Error": {"Code": "NoSuchKey"}}, "head_object"
     )
 
+    session_client_mock.return_value.list_objects_v2.side_effect = (
+        create_list_objects_v2_mock(shas=[], no_head=True)
+    )
     is_ancestor_mock.return_value = False
     assert s3_remote.s3 == session_client_mock.return_value
-    res = s3_remote.cmd_push(f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}")
-    assert session_client_mock.return_value.put_object.call_count == 2
+    res = s3_remote.push_batch([f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}"])
+    # The bundle, the HEAD and the manifest
+    put_calls = session_client_mock.return_value.put_object.call_args_list
+    assert [c.kwargs["Key"] for c in put_calls] == [
+        f"test_prefix/refs/heads/{BRANCH}/{SHA1}.bundle",
+        "test_prefix/HEAD",
+        "test_prefix/manifest.json",
+    ]
     assert session_client_mock.return_value.delete_object.call_count == 0
-    assert res.startswith("ok")
+    assert res[0].startswith("ok")
 
 
-@patch("git_remote_s3.git.archive")
+@patch("git_remote_s3.git.archive_stream")
 @patch("git_remote_s3.git.is_ancestor")
 @patch("git_remote_s3.git.rev_parse")
-@patch("git_remote_s3.git.bundle")
+@patch("git_remote_s3.git.bundle_stream")
 @patch("boto3.Session.client")
 def test_cmd_push_empty_bucket_s3_zip(
     session_client_mock,
@@ -418,35 +444,32 @@ def test_cmd_push_empty_bucket_s3_zip(
 
     rev_parse_mock.return_value = SHA1
 
-    temp_dir = tempfile.mkdtemp("test_temp")
-    temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=BUNDLE_SUFFIX)
-    with open(temp_file.name, "wb") as f:
-        f.write(MOCK_BUNDLE_CONTENT)
-    bundle_mock.return_value = temp_file.name
+    bundle_mock.side_effect = create_stream_mock(MOCK_BUNDLE_CONTENT)
 
-    temp_file_archive = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=ARCHIVE_SUFFIX)
-    with open(temp_file_archive.name, "wb") as f:
-        f.write(MOCK_ARCHIVE_CONTENT)
-    archive_mock.return_value = temp_file_archive.name
+    archive_mock.side_effect = create_stream_mock(MOCK_ARCHIVE_CONTENT)
 
     session_client_mock.return_value.head_object.side_effect = ClientError(
         {"Error": {"Code": "NoSuchKey"}}, "head_object"
     )
 
+    session_client_mock.return_value.list_objects_v2.side_effect = (
+        create_list_objects_v2_mock(shas=[], no_head=True)
+    )
     is_ancestor_mock.return_value = False
 
     assert s3_remote.s3 == session_client_mock.return_value
 
-    res = s3_remote.cmd_push(f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}")
-    assert session_client_mock.return_value.put_object.call_count == 3
+    res = s3_remote.push_batch([f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}"])
+    # The bundle, the archive, the HEAD and the manifest
+    assert session_client_mock.return_value.put_object.call_count == 4
     assert session_client_mock.return_value.delete_object.call_count == 0
-    assert res.startswith("ok")
+    assert res[0].startswith("ok")
 
 
-@patch("git_remote_s3.git.archive")
+@patch("git_remote_s3.git.archive_stream")
 @patch("git_remote_s3.git.is_ancestor")
 @patch("git_remote_s3.git.rev_parse")
-@patch("git_remote_s3.git.bundle")
+@patch("git_remote_s3.git.bundle_stream")
 @patch("git_remote_s3.git.get_last_commit_message")
 @patch("boto3.Session.client")
 def test_cmd_push_s3_zip_put_object_params(
@@ -461,16 +484,9 @@ def test_cmd_push_s3_zip_put_object_params(
     rev_parse_mock.return_value = SHA1
     get_last_commit_message_mock.return_value = "test commit message"
 
-    temp_dir = tempfile.mkdtemp("test_temp")
-    temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=BUNDLE_SUFFIX)
-    with open(temp_file.name, "wb") as f:
-        f.write(MOCK_BUNDLE_CONTENT)
-    bundle_mock.return_value = temp_file.name
+    bundle_mock.side_effect = create_stream_mock(MOCK_BUNDLE_CONTENT)
 
-    temp_file_archive = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=ARCHIVE_SUFFIX)
-    with open(temp_file_archive.name, "wb") as f:
-        f.write(MOCK_ARCHIVE_CONTENT)
-    archive_mock.return_value = temp_file_archive.name
+    archive_mock.side_effect = create_stream_mock(MOCK_ARCHIVE_CONTENT)
 
     session_client_mock.return_value.list_objects_v2.side_effect = (
         create_list_objects_v2_mock(shas=[SHA2])
@@ -500,18 +516,14 @@ def test_cmd_push_s3_zip_put_object_params(
 
 @patch("git_remote_s3.git.is_ancestor")
 @patch("git_remote_s3.git.rev_parse")
-@patch("git_remote_s3.git.bundle")
+@patch("git_remote_s3.git.bundle_stream")
 @patch("boto3.Session.client")
 def test_cmd_push_multiple_heads(
     session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock
 ):
     s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
     rev_parse_mock.return_value = SHA1
-    temp_dir = tempfile.mkdtemp("test_temp")
-    temp_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix=BUNDLE_SUFFIX)
-    with open(temp_file.name, "wb") as f:
-        f.write(MOCK_BUNDLE_CONTENT)
-    bundle_mock.return_value = temp_file.name
+    bundle_mock.side_effect = create_stream_mock(MOCK_BUNDLE_CONTENT)
     session_client_mock.return_value.list_objects_v2.side_effect = (
         create_list_objects_v2_mock(shas=[SHA1, SHA2])
     )
@@ -578,11 +590,15 @@ def test_cmd_push_delete(session_client_mock):
             {
                 "Key": f"test_prefix/refs/heads/{BRANCH}/{SHA1}.bundle",
                 "LastModified": datetime.datetime.now(),
+                "Size": 10,
             }
         ]
     }
     assert s3_remote.s3 == session_client_mock.return_value
     res = s3_remote.cmd_push(f"push :refs/heads/{BRANCH}")
+    # Deleted once the manifest no longer points to them
+    session_client_mock.return_value.delete_object.assert_not_called()
+    s3_remote.write_manifest([res])
     assert session_client_mock.return_value.delete_object.call_count == 1
     assert res == (f"ok refs/heads/{BRANCH}\n")
 
@@ -596,15 +612,20 @@ def test_cmd_push_delete_s3_zip(session_client_mock):
             {
                 "Key": f"test_prefix/refs/heads/{BRANCH}/{SHA1}.bundle",
                 "LastModified": datetime.datetime.now(),
+                "Size": 10,
             },
             {
                 "Key": f"test_prefix/refs/heads/{BRANCH}/repo.zip",
                 "LastModified": datetime.datetime.now(),
+                "Size": 10,
             },
         ]
     }
     assert s3_remote.s3 == session_client_mock.return_value
     res = s3_remote.cmd_push(f"push :refs/heads/{BRANCH}")
+    # Deleted once the manifest no longer points to them
+    session_client_mock.return_value.delete_object.assert_not_called()
+    s3_remote.write_manifest([res])
     assert session_client_mock.return_value.delete_object.call_count == 2
     assert res == (f"ok refs/heads/{BRANCH}\n")
 
@@ -655,3 +676,987 @@ def test_cmd_push_delete_fails_with_multiple_heads_s3_zip(session_client_mock):
     res = s3_remote.cmd_push(f"push :refs/heads/{BRANCH}")
     assert session_client_mock.return_value.delete_object.call_count == 0
     assert res.startswith("error")
+
+
+@patch("sys.stdout", new_callable=StringIO)
+@patch("git_remote_s3.git.unbundle")
+@patch("boto3.Session.client")
+def test_process_cmd_fetch_batch(session_client_mock, unbundle_mock, stdout_mock):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    session_client_mock.return_value.get_object.side_effect = lambda **kwargs: {
+        "Body": BytesIO(MOCK_BUNDLE_CONTENT)
+    }
+    s3_remote.process_cmd(f"fetch {SHA1} refs/heads/{BRANCH}\n")
+    s3_remote.process_cmd(f"fetch {SHA2} refs/heads/other\n")
+    s3_remote.process_cmd(f"fetch {SHA1} refs/tags/v1\n")
+    assert session_client_mock.return_value.get_object.call_count == 0
+    assert stdout_mock.getvalue() == ""
+
+    s3_remote.process_cmd("\n")
+    assert session_client_mock.return_value.get_object.call_count == 2
+    assert unbundle_mock.call_count == 2
+    assert sorted(s3_remote.fetched_refs) == [SHA1, SHA2]
+    assert stdout_mock.getvalue() == "\n"
+
+
+@patch("sys.stdout", new_callable=StringIO)
+@patch("git_remote_s3.git.missing_objects")
+@patch("git_remote_s3.git.unbundle")
+@patch("boto3.Session.client")
+def test_fetch_uses_prefetched_bundles(
+    session_client_mock,
+    unbundle_mock,
+    missing_objects_mock,
+    stdout_mock,
+    no_manifest,
+    monkeypatch,
+):
+    monkeypatch.setenv("GIT_REMOTE_S3_PREFETCH", "true")
+    monkeypatch.setenv("GIT_REMOTE_S3_PREFETCH_BYTES", "1k")
+    SHA3 = "c105d19ba64965d2c9d3d3246e7269059ef8bb83"
+    manifest = create_manifest(
+        {"refs/heads/a": SHA1, f"refs/heads/{BRANCH}": SHA2, "refs/heads/big": SHA3}
+    )
+    manifest.refs["refs/heads/big"]["size"] = 2048
+    no_manifest.return_value = manifest
+    # SHA2 is already present locally
+    missing_objects_mock.return_value = [SHA1, SHA3]
+    keys = []
+
+    def get_object(Key, **kwargs):
+        keys.append(Key)
+        if Key.endswith("HEAD"):
+            return {"Body": BytesIO(f"refs/heads/{BRANCH}".encode("utf8"))}
+        return {"Body": BytesIO(MOCK_BUNDLE_CONTENT)}
+
+    session_client_mock.return_value.get_object.side_effect = get_object
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    s3_remote.process_cmd("list\n")
+    # The ref of HEAD is checked first
+    missing_objects_mock.assert_called_once_with([SHA2, SHA1, SHA3])
+    s3_remote.prefetch_plan.result()
+    # Only the missing bundle within the budget is prefetched
+    assert list(s3_remote.prefetches) == [SHA1]
+    prefetched_folder = f"{s3_remote.prefetch_dir.name}/{SHA1}"
+
+    s3_remote.process_cmd(f"fetch {SHA1} refs/heads/a\n")
+    s3_remote.process_cmd(f"fetch {SHA3} refs/heads/big\n")
+    s3_remote.process_cmd("\n")
+    assert sorted(keys) == sorted(
+        [
+            "test_prefix/HEAD",
+            f"test_prefix/refs/heads/a/{SHA1}.bundle",
+            f"test_prefix/refs/heads/big/{SHA3}.bundle",
+        ]
+    )
+    assert unbundle_mock.call_count == 2
+    assert any(
+        c.kwargs["folder"] == prefetched_folder for c in unbundle_mock.call_args_list
+    )
+    s3_remote.close()
+    assert not os.path.exists(prefetched_folder)
+
+
+@patch("git_remote_s3.git.unbundle")
+@patch("boto3.Session.client")
+def test_fetch_batch_access_denied(session_client_mock, unbundle_mock):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    session_client_mock.return_value.get_object.side_effect = ClientError(
+        {"Error": {"Code": "AccessDenied"}}, "get_object"
+    )
+    with pytest.raises(NotAuthorizedError) as e:
+        s3_remote.fetch_batch([f"fetch {SHA1} refs/heads/{BRANCH}"])
+    assert e.value.action == "GetObject"
+    unbundle_mock.assert_not_called()
+    assert s3_remote.fetched_refs == []
+
+
+@patch("git_remote_s3.transfer.DOWNLOAD_CHUNK_SIZE", 4)
+@patch("boto3.Session.client")
+def test_download_bundle_streams_body(session_client_mock):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    body = BytesIO(MOCK_BUNDLE_CONTENT)
+    reads = []
+    original_read = body.read
+
+    def read(size=-1):
+        reads.append(size)
+        return original_read(size)
+
+    body.read = read
+    session_client_mock.return_value.get_object.return_value = {"Body": body}
+    temp_dir = tempfile.mkdtemp("test_temp")
+    shas = s3_remote.download_bundle(
+        folder=temp_dir, sha=SHA1, ref=f"refs/heads/{BRANCH}"
+    )
+    assert shas == [SHA1]
+    with open(f"{temp_dir}/{SHA1}.bundle", "rb") as f:
+        assert f.read() == MOCK_BUNDLE_CONTENT
+    assert all(size == 4 for size in reads)
+
+
+@patch("boto3.Session.client")
+def test_download_bundle_from_cache(session_client_mock, monkeypatch):
+    cache_dir = tempfile.mkdtemp("test_cache")
+    monkeypatch.setenv("GIT_REMOTE_S3_CACHE", "true")
+    monkeypatch.setenv("GIT_REMOTE_S3_CACHE_DIR", cache_dir)
+    client = session_client_mock.return_value
+    client.head_object.return_value = {"ETag": '"etag"'}
+    client.get_object.return_value = {
+        "Body": BytesIO(MOCK_BUNDLE_CONTENT),
+        "ETag": '"etag"',
+        "Metadata": {"chain-length": "0"},
+    }
+
+    # The first clone downloads the bundle, the second one reads it from the cache
+    for _ in range(2):
+        s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+        temp_dir = tempfile.mkdtemp("test_temp")
+        shas = s3_remote.download_bundle(
+            folder=temp_dir, sha=SHA1, ref=f"refs/heads/{BRANCH}"
+        )
+        assert shas == [SHA1]
+        with open(f"{temp_dir}/{SHA1}.bundle", "rb") as f:
+            assert f.read() == MOCK_BUNDLE_CONTENT
+    assert client.head_object.call_count == 2
+    client.get_object.assert_called_once()
+
+    # A bundle rewritten in place is downloaded again
+    client.head_object.return_value = {"ETag": '"other"'}
+    client.get_object.return_value["Body"] = BytesIO(MOCK_BUNDLE_CONTENT)
+    s3_remote.download_bundle(folder=temp_dir, sha="x", ref=f"refs/heads/{BRANCH}")
+    assert client.get_object.call_count == 2
+
+
+@patch("git_remote_s3.git.object_exists")
+@patch("boto3.Session.client")
+def test_download_bundle_chain(session_client_mock, object_exists_mock):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    SHA0 = "c105d19ba64965d2c9d3d3246e7269059ef8bb80"
+    SHA3 = "c105d19ba64965d2c9d3d3246e7269059ef8bb83"
+    chain_prefix = f"test_prefix/refs/heads/{BRANCH}/CHAIN#"
+    session_client_mock.return_value.list_objects_v2.return_value = {
+        "Contents": [
+            {"Key": f"{chain_prefix}/000001-{SHA1}.bundle"},
+            {"Key": f"{chain_prefix}/000000-{SHA0}.bundle"},
+            {"Key": f"{chain_prefix}/000002-{SHA2}.bundle"},
+        ]
+    }
+    session_client_mock.return_value.get_object.side_effect = lambda **kwargs: {
+        "Body": BytesIO(MOCK_BUNDLE_CONTENT),
+        "Metadata": {"chain-length": "3"},
+    }
+    # SHA1 is already present locally, only the links after it are needed
+    object_exists_mock.side_effect = lambda sha: sha in [SHA0, SHA1]
+    temp_dir = tempfile.mkdtemp("test_temp")
+    shas = s3_remote.download_bundle(
+        folder=temp_dir, sha=SHA3, ref=f"refs/heads/{BRANCH}"
+    )
+    assert shas == [SHA2, SHA3]
+    assert session_client_mock.return_value.get_object.call_count == 2
+
+
+@patch("git_remote_s3.git.missing_objects")
+@patch("boto3.Session.client")
+def test_close_abandons_prefetches(session_client_mock, missing_objects_mock):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    client = session_client_mock.return_value
+    client.list_objects_v2.side_effect = create_list_objects_v2_mock(shas=[SHA1])
+    missing_objects_mock.return_value = [SHA1]
+    started = threading.Event()
+
+    class EndlessBody:
+        def read(self, size):
+            started.set()
+            time.sleep(0.01)
+            return b"x" * size
+
+    client.get_object.return_value = {"Body": EndlessBody(), "ETag": '"etag"'}
+    s3_remote.start_prefetch([(SHA1, f"refs/heads/{BRANCH}")])
+    assert started.wait(5)
+
+    start = time.monotonic()
+    s3_remote.close()
+    assert time.monotonic() - start < 1
+    assert not os.path.exists(s3_remote.prefetch_dir.name)
+
+
+@patch("sys.stdout", new_callable=StringIO)
+@patch("git_remote_s3.git.missing_objects")
+@patch("boto3.Session.client")
+def test_prefetch_budget_counts_chain_links(
+    session_client_mock, missing_objects_mock, stdout_mock, no_manifest, monkeypatch
+):
+    monkeypatch.setenv("GIT_REMOTE_S3_PREFETCH", "true")
+    monkeypatch.setenv("GIT_REMOTE_S3_PREFETCH_BYTES", "1k")
+    manifest = create_manifest({"refs/heads/a": SHA1, f"refs/heads/{BRANCH}": SHA2})
+    # A small incremental bundle on top of a chain beyond the budget
+    manifest.refs[f"refs/heads/{BRANCH}"]["chain"] = [
+        {"key": f"refs/heads/{BRANCH}/CHAIN#/00000{i}-{SHA1}.bundle", "size": 600}
+        for i in range(2)
+    ]
+    no_manifest.return_value = manifest
+    missing_objects_mock.return_value = [SHA1, SHA2]
+    session_client_mock.return_value.get_object.side_effect = lambda **kwargs: {
+        "Body": BytesIO(MOCK_BUNDLE_CONTENT)
+    }
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    s3_remote.process_cmd("list\n")
+    s3_remote.prefetch_plan.result()
+    assert list(s3_remote.prefetches) == [SHA1]
+    s3_remote.close()
+
+
+@patch("git_remote_s3.git.is_ancestor")
+@patch("git_remote_s3.git.rev_parse")
+@patch("git_remote_s3.git.bundle_stream")
+@patch("boto3.Session.client")
+def test_cmd_push_incremental(
+    session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock
+):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    s3_remote.incremental = True
+    rev_parse_mock.return_value = SHA1
+    bundle_mock.side_effect = create_stream_mock(MOCK_BUNDLE_CONTENT)
+    session_client_mock.return_value.list_objects_v2.side_effect = (
+        create_list_objects_v2_mock(shas=[SHA2])
+    )
+    is_ancestor_mock.return_value = True
+    res = s3_remote.cmd_push(f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}")
+    assert res == f"ok refs/heads/{BRANCH}\n"
+    assert bundle_mock.call_args.kwargs["exclude"] == [SHA2]
+    copy_call = session_client_mock.return_value.copy_object.call_args
+    assert copy_call.kwargs["Key"] == (
+        f"test_prefix/refs/heads/{BRANCH}/CHAIN#/000000-{SHA2}.bundle"
+    )
+    put_call = session_client_mock.return_value.put_object.call_args
+    assert put_call.kwargs["Metadata"] == {"chain-length": "1"}
+    # Deleted once the manifest no longer points to them
+    session_client_mock.return_value.delete_object.assert_not_called()
+    s3_remote.write_manifest([res])
+    assert session_client_mock.return_value.delete_object.call_count == 1
+
+
+@patch("git_remote_s3.git.is_ancestor")
+@patch("git_remote_s3.git.rev_parse")
+@patch("git_remote_s3.git.bundle_stream")
+@patch("boto3.Session.client")
+def test_cmd_push_incremental_compaction(
+    session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock
+):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    s3_remote.incremental = True
+    s3_remote.compact_links = 2
+    rev_parse_mock.return_value = SHA1
+    bundle_mock.side_effect = create_stream_mock(MOCK_BUNDLE_CONTENT)
+    link = f"test_prefix/refs/heads/{BRANCH}/CHAIN#/000000-{SHA1}.bundle"
+    list_mock = create_list_objects_v2_mock(shas=[SHA2])
+
+    def list_objects_v2(Prefix, **kwargs):
+        res = list_mock(Prefix=Prefix, **kwargs)
+        if link.startswith(Prefix):
+            res["Contents"].append(
+                {"Key": link, "Size": 10, "LastModified": datetime.datetime.now()}
+            )
+        return res
+
+    session_client_mock.return_value.list_objects_v2.side_effect = list_objects_v2
+    is_ancestor_mock.return_value = True
+    res = s3_remote.cmd_push(f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}")
+    assert res == f"ok refs/heads/{BRANCH}\n"
+    assert bundle_mock.call_args.kwargs["exclude"] == []
+    assert session_client_mock.return_value.copy_object.call_count == 0
+    # Deleted once the manifest no longer points to them
+    session_client_mock.return_value.delete_object.assert_not_called()
+    s3_remote.write_manifest([res])
+    deleted = [
+        c.kwargs["Key"]
+        for c in session_client_mock.return_value.delete_object.call_args_list
+    ]
+    assert deleted == [f"test_prefix/refs/heads/{BRANCH}/{SHA2}.bundle", link]
+
+
+@patch("sys.stdout", new_callable=StringIO)
+@patch("boto3.Session.client")
+def test_process_cmd_push_batch_keeps_order(session_client_mock, stdout_mock):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    s3_remote.push_concurrency = 3
+    branches = [f"branch{i}" for i in range(6)]
+    started = threading.Barrier(3, timeout=5)
+
+    def cmd_push(cmd):
+        ref = cmd.split(":")[1]
+        # the first three pushes must be running at the same time
+        if ref in branches[:3]:
+            started.wait()
+        return f"ok {ref}\n"
+
+    s3_remote.cmd_push = cmd_push
+    for b in branches:
+        s3_remote.process_cmd(f"push {b}:{b}\n")
+    s3_remote.process_cmd("\n")
+    assert stdout_mock.getvalue() == "".join(f"ok {b}\n" for b in branches) + "\n"
+
+
+@patch("git_remote_s3.git.is_ancestor")
+@patch("git_remote_s3.git.rev_parse")
+@patch("git_remote_s3.git.bundle_stream")
+@patch("boto3.Session.client")
+def test_push_batch_prefetches_refs(
+    session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock
+):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    client = session_client_mock.return_value
+    rev_parse_mock.return_value = SHA1
+    is_ancestor_mock.return_value = True
+    bundle_mock.side_effect = create_stream_mock(MOCK_BUNDLE_CONTENT)
+    tags = [f"refs/tags/v{i}" for i in range(5)]
+    existing = {
+        "Key": f"test_prefix/{tags[0]}/{SHA2}.bundle",
+        "LastModified": datetime.datetime.now(),
+        "Size": len(MOCK_BUNDLE_CONTENT),
+    }
+
+    def list_objects_v2(Prefix, Delimiter=None, **kwargs):
+        if Delimiter:
+            return {"CommonPrefixes": [{"Prefix": "test_prefix/refs/tags/"}]}
+        return {"Contents": [existing] if existing["Key"].startswith(Prefix) else []}
+
+    client.list_objects_v2.side_effect = list_objects_v2
+    results = s3_remote.push_batch([f"push {t}:{t}" for t in tags])
+    assert results == [f"ok {t}\n" for t in tags]
+
+    # One listing of the refs for the batch and one to build the manifest,
+    # no listing per ref
+    prefixes = [c.kwargs["Prefix"] for c in client.list_objects_v2.call_args_list]
+    assert prefixes == ["test_prefix/refs/", "test_prefix/refs/tags/"] + [
+        "test_prefix/refs/"
+    ]
+    client.head_object.assert_called_once()
+    client.delete_object.assert_called_once_with(
+        Bucket="test_bucket", Key=existing["Key"]
+    )
+
+    # The session listing reflects the pushes
+    assert s3_remote.get_bundles_for_ref(tags[0])[0]["Key"] == (
+        f"test_prefix/{tags[0]}/{SHA1}.bundle"
+    )
+
+
+@patch("git_remote_s3.git.is_ancestor")
+@patch("git_remote_s3.git.rev_parse")
+@patch("git_remote_s3.git.bundle_stream")
+@patch("boto3.Session.client")
+def test_push_batch_copies_bundle_of_same_commit(
+    session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock
+):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    client = session_client_mock.return_value
+    rev_parse_mock.return_value = SHA1
+    bundle_mock.side_effect = create_stream_mock(MOCK_BUNDLE_CONTENT)
+    client.list_objects_v2.side_effect = create_list_objects_v2_mock(shas=[])
+    refs = ["refs/heads/a", "refs/heads/b", "refs/tags/c"]
+
+    results = s3_remote.push_batch([f"push {ref}:{ref}" for ref in refs])
+    assert results == [f"ok {ref}\n" for ref in refs]
+    bundle_mock.assert_called_once()
+    bundle_key = f"test_prefix/refs/heads/a/{SHA1}.bundle"
+    assert [c.kwargs for c in client.copy_object.call_args_list] == [
+        {
+            "CopySource": {"Bucket": "test_bucket", "Key": bundle_key},
+            "Bucket": "test_bucket",
+            "Key": f"test_prefix/{ref}/{SHA1}.bundle",
+            "MetadataDirective": "COPY",
+        }
+        for ref in refs[1:]
+    ]
+
+
+@patch("git_remote_s3.git.is_ancestor")
+@patch("git_remote_s3.git.rev_parse")
+@patch("git_remote_s3.git.bundle_stream")
+@patch("boto3.Session.client")
+def test_push_batch_new_tag_on_pushed_commit(
+    session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock, no_manifest
+):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    client = session_client_mock.return_value
+    no_manifest.return_value = create_manifest({f"refs/heads/{BRANCH}": SHA1})
+    rev_parse_mock.return_value = SHA1
+
+    results = s3_remote.push_batch(
+        [f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}", "push v1:refs/tags/v1"]
+    )
+    assert results == [f"ok refs/heads/{BRANCH}\n", "ok refs/tags/v1\n"]
+    bundle_mock.assert_not_called()
+    client.copy_object.assert_called_once_with(
+        CopySource={
+            "Bucket": "test_bucket",
+            "Key": f"test_prefix/refs/heads/{BRANCH}/{SHA1}.bundle",
+        },
+        Bucket="test_bucket",
+        Key=f"test_prefix/refs/tags/v1/{SHA1}.bundle",
+        MetadataDirective="COPY",
+    )
+    client.delete_object.assert_not_called()
+
+
+@patch("git_remote_s3.git.rev_parse")
+@patch("git_remote_s3.git.bundle_stream")
+@patch("boto3.Session.client")
+def test_push_batch_tag_alone_copies_bundle_of_other_ref(
+    session_client_mock, bundle_mock, rev_parse_mock
+):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    client = session_client_mock.return_value
+    client.list_objects_v2.side_effect = create_list_objects_v2_mock(shas=[SHA1])
+    rev_parse_mock.return_value = SHA1
+
+    results = s3_remote.push_batch(["push v2:refs/tags/v2"])
+    assert results == ["ok refs/tags/v2\n"]
+    bundle_mock.assert_not_called()
+    client.copy_object.assert_called_once_with(
+        CopySource={
+            "Bucket": "test_bucket",
+            "Key": f"test_prefix/refs/heads/{BRANCH}/{SHA1}.bundle",
+        },
+        Bucket="test_bucket",
+        Key=f"test_prefix/refs/tags/v2/{SHA1}.bundle",
+        MetadataDirective="COPY",
+    )
+    bundle_puts = [
+        c
+        for c in client.put_object.call_args_list
+        if c.kwargs["Key"].endswith(".bundle")
+    ]
+    assert bundle_puts == []
+
+
+@patch("git_remote_s3.git.is_ancestor")
+@patch("git_remote_s3.git.rev_parse")
+@patch("git_remote_s3.git.bundle_stream")
+@patch("boto3.Session.client")
+def test_push_batch_does_not_copy_bundle_of_moved_ref(
+    session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock, no_manifest
+):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    client = session_client_mock.return_value
+    no_manifest.return_value = create_manifest({f"refs/heads/{BRANCH}": SHA1})
+    rev_parse_mock.side_effect = lambda ref: SHA1 if ref == "v2" else SHA2
+    is_ancestor_mock.return_value = True
+    bundle_mock.side_effect = create_stream_mock(MOCK_BUNDLE_CONTENT)
+
+    # The bundle of the branch is deleted when the branch moves to SHA2
+    results = s3_remote.push_batch(
+        [f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}", "push v2:refs/tags/v2"]
+    )
+    assert results == [f"ok refs/heads/{BRANCH}\n", "ok refs/tags/v2\n"]
+    client.copy_object.assert_not_called()
+    assert bundle_mock.call_count == 2
+
+
+@patch("git_remote_s3.git.rev_parse")
+@patch("git_remote_s3.git.bundle_stream")
+@patch("boto3.Session.client")
+def test_push_batch_head_points_to_first_branch(
+    session_client_mock, bundle_mock, rev_parse_mock
+):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    client = session_client_mock.return_value
+    client.list_objects_v2.side_effect = create_list_objects_v2_mock(
+        shas=[], no_head=True
+    )
+    client.head_object.side_effect = ClientError(
+        {"Error": {"Code": "404"}}, "HeadObject"
+    )
+    rev_parse_mock.side_effect = lambda ref: SHA1 if "tags" in ref else SHA2
+    branch_started = threading.Event()
+
+    def bundle_stream(ref, **kwargs):
+        # The tag is uploaded before the branch
+        if "tags" in ref:
+            assert branch_started.wait(5)
+        else:
+            branch_started.set()
+            time.sleep(0.1)
+        return nullcontext(BytesIO(MOCK_BUNDLE_CONTENT))
+
+    bundle_mock.side_effect = bundle_stream
+    cmds = ["push refs/tags/v1:refs/tags/v1", "push refs/heads/a:refs/heads/a"]
+    assert s3_remote.push_batch(cmds) == ["ok refs/tags/v1\n", "ok refs/heads/a\n"]
+    head_calls = [
+        c for c in client.put_object.call_args_list if c.kwargs["Key"].endswith("HEAD")
+    ]
+    assert [c.kwargs["Body"] for c in head_calls] == ["refs/heads/a"]
+
+
+@patch("git_remote_s3.git.rev_parse")
+@patch("git_remote_s3.git.bundle_stream")
+@patch("boto3.Session.client")
+def test_push_batch_reports_refs_when_head_fails(
+    session_client_mock, bundle_mock, rev_parse_mock
+):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    client = session_client_mock.return_value
+    client.list_objects_v2.side_effect = create_list_objects_v2_mock(
+        shas=[], no_head=True
+    )
+    client.head_object.side_effect = ClientError(
+        {"Error": {"Code": "404"}}, "HeadObject"
+    )
+
+    def put_object(Key, **kwargs):
+        if Key.endswith("HEAD"):
+            raise ClientError({"Error": {"Code": "AccessDenied"}}, "PutObject")
+        return {"ETag": '"etag"'}
+
+    client.put_object.side_effect = put_object
+    rev_parse_mock.return_value = SHA1
+    bundle_mock.return_value = nullcontext(BytesIO(MOCK_BUNDLE_CONTENT))
+    cmds = ["push refs/heads/a:refs/heads/a"]
+    assert s3_remote.push_batch(cmds) == ["ok refs/heads/a\n"]
+
+
+@patch("git_remote_s3.remote.MAX_COPY_OBJECT_SIZE", 0)
+@patch("git_remote_s3.git.is_ancestor")
+@patch("git_remote_s3.git.rev_parse")
+@patch("boto3.Session.client")
+def test_cmd_push_reports_failed_multipart_copy(
+    session_client_mock, rev_parse_mock, is_ancestor_mock
+):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    s3_remote.incremental = True
+    rev_parse_mock.return_value = SHA1
+    is_ancestor_mock.return_value = True
+    client = session_client_mock.return_value
+    client.list_objects_v2.side_effect = create_list_objects_v2_mock(shas=[SHA2])
+    client.copy.side_effect = boto3.exceptions.S3UploadFailedError("copy failed")
+    res = s3_remote.cmd_push(f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}")
+    assert res.startswith(f"error refs/heads/{BRANCH} ")
+    assert "copy failed" in res
+    client.delete_object.assert_not_called()
+
+
+@patch("git_remote_s3.remote.MAX_COPY_OBJECT_SIZE", 10)
+@patch("boto3.Session.client")
+def test_copy_object_checks_source_etag(session_client_mock):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    client = session_client_mock.return_value
+    s3_remote.copy_object(source="a", key="b", size=5, etag='"1"')
+    client.copy_object.assert_called_once_with(
+        CopySource={"Bucket": "test_bucket", "Key": "a"},
+        Bucket="test_bucket",
+        Key="b",
+        MetadataDirective="COPY",
+        CopySourceIfMatch='"1"',
+    )
+    # Beyond the limit of CopyObject, as a managed multipart copy
+    s3_remote.copy_object(source="a", key="c", size=20, etag='"1"')
+    client.copy.assert_called_once_with(
+        CopySource={"Bucket": "test_bucket", "Key": "a"},
+        Bucket="test_bucket",
+        Key="c",
+        ExtraArgs={"MetadataDirective": "COPY", "CopySourceIfMatch": '"1"'},
+    )
+
+
+def create_manifest(refs):
+    manifest = Manifest()
+    for ref, sha in refs.items():
+        manifest.set_ref(ref, sha=sha, size=len(MOCK_BUNDLE_CONTENT))
+    return manifest
+
+
+@patch("sys.stdout", new_callable=StringIO)
+@patch("boto3.Session.client")
+def test_cmd_list_from_manifest(session_client_mock, stdout_mock, no_manifest):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    no_manifest.return_value = create_manifest(
+        {f"refs/heads/{BRANCH}": SHA1, "refs/tags/v1": SHA2}
+    )
+    session_client_mock.return_value.list_objects_v2.reset_mock()
+    session_client_mock.return_value.get_object.return_value = {
+        "Body": BytesIO(b"refs/heads/%b" % str.encode(BRANCH))
+    }
+    s3_remote.cmd_list()
+    assert session_client_mock.return_value.list_objects_v2.call_count == 0
+    assert stdout_mock.getvalue() == (
+        f"@refs/heads/{BRANCH} HEAD\n{SHA1} refs/heads/{BRANCH}\n"
+        f"{SHA2} refs/tags/v1\n\n"
+    )
+
+
+@patch("git_remote_s3.git.is_ancestor")
+@patch("git_remote_s3.git.rev_parse")
+@patch("git_remote_s3.git.bundle_stream")
+@patch("boto3.Session.client")
+def test_push_batch_updates_manifest(
+    session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock, no_manifest
+):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    no_manifest.side_effect = lambda *args: create_manifest(
+        {f"refs/heads/{BRANCH}": SHA2, "refs/tags/v1": SHA2}
+    )
+    rev_parse_mock.return_value = SHA1
+    is_ancestor_mock.return_value = True
+    bundle_mock.side_effect = create_stream_mock(MOCK_BUNDLE_CONTENT)
+    session_client_mock.return_value.list_objects_v2.reset_mock()
+    res = s3_remote.push_batch([f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}"])
+    assert res == [f"ok refs/heads/{BRANCH}\n"]
+    # the bundle of the ref is found in the manifest, no listing needed
+    assert session_client_mock.return_value.list_objects_v2.call_count == 0
+
+    put_calls = session_client_mock.return_value.put_object.call_args_list
+    manifest_call = [c for c in put_calls if c.kwargs["Key"].endswith("manifest.json")]
+    assert len(manifest_call) == 1
+    refs = json.loads(manifest_call[0].kwargs["Body"])["refs"]
+    assert refs[f"refs/heads/{BRANCH}"]["sha"] == SHA1
+    assert refs[f"refs/heads/{BRANCH}"]["size"] == len(MOCK_BUNDLE_CONTENT)
+    assert refs["refs/tags/v1"]["sha"] == SHA2
+
+
+@patch("git_remote_s3.git.is_ancestor")
+@patch("git_remote_s3.git.rev_parse")
+@patch("git_remote_s3.git.bundle_stream")
+@patch("boto3.Session.client")
+def test_push_batch_concurrent_push_detected(
+    session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock, no_manifest
+):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    manifests = [
+        create_manifest({f"refs/heads/{BRANCH}": SHA2}),
+        # another client pushed the branch while this push was running
+        create_manifest({f"refs/heads/{BRANCH}": "f" * 40}),
+    ]
+    no_manifest.side_effect = lambda *args: manifests.pop(0)
+    rev_parse_mock.return_value = SHA1
+    is_ancestor_mock.return_value = True
+    bundle_mock.side_effect = create_stream_mock(MOCK_BUNDLE_CONTENT)
+    res = s3_remote.push_batch([f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}"])
+    assert res[0].startswith(f"error refs/heads/{BRANCH}")
+    assert s3_remote.manifest.get_sha(f"refs/heads/{BRANCH}") == "f" * 40
+
+
+@patch("git_remote_s3.git.is_ancestor")
+@patch("git_remote_s3.git.rev_parse")
+@patch("git_remote_s3.git.bundle_stream")
+@patch("boto3.Session.client")
+def test_push_batch_manifest_written_concurrently(
+    session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock, no_manifest
+):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    manifests = [
+        create_manifest({f"refs/heads/{BRANCH}": SHA2}),
+        create_manifest({f"refs/heads/{BRANCH}": SHA2}),
+        # another client pushed a tag between the read and the write
+        create_manifest({f"refs/heads/{BRANCH}": SHA2, "refs/tags/v1": SHA2}),
+    ]
+    for i, manifest in enumerate(manifests):
+        manifest.etag = f'"{i}"'
+    no_manifest.side_effect = lambda *args: manifests.pop(0)
+    client = session_client_mock.return_value
+
+    def put_object(Key, **kwargs):
+        if kwargs.get("IfMatch") == '"1"':
+            raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+        return {"ETag": '"3"'}
+
+    client.put_object.side_effect = put_object
+    rev_parse_mock.return_value = SHA1
+    is_ancestor_mock.return_value = True
+    bundle_mock.side_effect = create_stream_mock(MOCK_BUNDLE_CONTENT)
+    res = s3_remote.push_batch([f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}"])
+    assert res == [f"ok refs/heads/{BRANCH}\n"]
+    manifest_calls = [
+        c for c in client.put_object.call_args_list
+        if c.kwargs["Key"].endswith("manifest.json")
+    ]
+    assert [c.kwargs["IfMatch"] for c in manifest_calls] == ['"1"', '"2"']
+    refs = json.loads(manifest_calls[-1].kwargs["Body"])["refs"]
+    assert refs[f"refs/heads/{BRANCH}"]["sha"] == SHA1
+    assert refs["refs/tags/v1"]["sha"] == SHA2
+
+
+@patch("git_remote_s3.git.is_ancestor")
+@patch("git_remote_s3.git.rev_parse")
+@patch("git_remote_s3.git.bundle_stream")
+@patch("boto3.Session.client")
+def test_push_batch_keeps_replaced_bundle_until_manifest_written(
+    session_client_mock, bundle_mock, rev_parse_mock, is_ancestor_mock, no_manifest
+):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    no_manifest.side_effect = lambda *args: create_manifest(
+        {f"refs/heads/{BRANCH}": SHA2}
+    )
+    client = session_client_mock.return_value
+
+    def put_object(Key, **kwargs):
+        if Key.endswith("manifest.json"):
+            raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+        return {"ETag": '"etag"'}
+
+    client.put_object.side_effect = put_object
+    rev_parse_mock.return_value = SHA1
+    is_ancestor_mock.return_value = True
+    bundle_mock.side_effect = create_stream_mock(MOCK_BUNDLE_CONTENT)
+    res = s3_remote.push_batch([f"push refs/heads/{BRANCH}:refs/heads/{BRANCH}"])
+    assert res[0].startswith(f"error refs/heads/{BRANCH}")
+    # The manifest still points to the previous bundle
+    client.delete_object.assert_not_called()
+
+
+@patch("boto3.Session.client")
+def test_list_refs_lists_namespaces(session_client_mock):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    session_client_mock.return_value.list_objects_v2.reset_mock()
+
+    def list_objects_v2(Prefix, Delimiter=None, **kwargs):
+        if Delimiter:
+            assert Prefix == "test_prefix/refs/"
+            return {
+                "CommonPrefixes": [
+                    {"Prefix": "test_prefix/refs/heads/"},
+                    {"Prefix": "test_prefix/refs/tags/"},
+                ]
+            }
+        namespace = Prefix.split("/")[-2]
+        sha = SHA1 if namespace == "heads" else SHA2
+        return {
+            "Contents": [
+                {
+                    "Key": f"{Prefix}{BRANCH}/{sha}.bundle",
+                    "LastModified": datetime.datetime.now(),
+                }
+            ]
+        }
+
+    session_client_mock.return_value.list_objects_v2.side_effect = list_objects_v2
+    refs = s3_remote.list_refs(bucket=s3_remote.bucket, prefix=s3_remote.prefix)
+    assert sorted(refs) == [
+        f"refs/heads/{BRANCH}/{SHA1}.bundle",
+        f"refs/tags/{BRANCH}/{SHA2}.bundle",
+    ]
+    prefixes = [
+        c.kwargs["Prefix"]
+        for c in session_client_mock.return_value.list_objects_v2.call_args_list
+    ]
+    # the lfs/ prefix of the repo is never listed
+    assert all(p.startswith("test_prefix/refs/") for p in prefixes)
+
+
+@patch("boto3.Session.client")
+def test_client_created_on_first_use(session_client_mock):
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    session_client_mock.assert_not_called()
+    assert s3_remote.s3 == session_client_mock.return_value
+    assert s3_remote.uploader.s3 == session_client_mock.return_value
+    session_client_mock.assert_called_once_with("s3", config=ANY)
+    # the bucket is not probed, the first request is the one of the command
+    session_client_mock.return_value.list_objects_v2.assert_not_called()
+
+
+def create_pack_manifest():
+    manifest = Manifest(layout="pack")
+    manifest.add_pack({"name": "pack-1", "size": 10, "tips": [SHA1]})
+    manifest.set_pack_ref("refs/heads/main", sha=SHA1, pack="pack-1")
+    manifest.set_pack_ref("refs/heads/old", sha=SHA1)
+    return manifest
+
+
+def write_pack(folder, **kwargs):
+    for ext in ["pack", "idx"]:
+        with open(f"{folder}/pack-2.{ext}", "wb") as f:
+            f.write(ext.encode("utf8"))
+    return "pack-2"
+
+
+@patch("git_remote_s3.git.pack_object_count", return_value=3)
+@patch("git_remote_s3.git.pack_objects", side_effect=write_pack)
+@patch("git_remote_s3.git.missing_objects", return_value=[])
+@patch("git_remote_s3.git.is_ancestor", return_value=True)
+@patch("git_remote_s3.git.rev_parse", return_value=SHA2)
+@patch("boto3.Session.client")
+def test_push_packs(
+    session_client_mock,
+    rev_parse_mock,
+    is_ancestor_mock,
+    missing_objects_mock,
+    pack_objects_mock,
+    pack_object_count_mock,
+    no_manifest,
+):
+    no_manifest.return_value = create_pack_manifest()
+    s3_remote = S3Remote(UriScheme.S3_PACK, None, "test_bucket", "test_prefix")
+    res = s3_remote.push_batch(
+        [
+            "push refs/heads/main:refs/heads/main",
+            "push refs/heads/main:refs/heads/feature",
+            "push :refs/heads/old",
+        ]
+    )
+    assert res == [
+        "ok refs/heads/main\n",
+        "ok refs/heads/feature\n",
+        "ok refs/heads/old\n",
+    ]
+    # A single pack of the objects the remote does not have
+    pack_objects_mock.assert_called_once_with(folder=ANY, tips=[SHA2], exclude=[SHA1])
+    put_calls = session_client_mock.return_value.put_object.call_args_list
+    assert [c.kwargs["Key"] for c in put_calls] == [
+        "test_prefix/packs/pack-2.pack",
+        "test_prefix/packs/pack-2.idx",
+        "test_prefix/manifest.json",
+    ]
+    manifest = json.loads(put_calls[-1].kwargs["Body"])
+    assert manifest["layout"] == "pack"
+    assert manifest["packs"][1] == {"name": "pack-2", "size": 4, "tips": [SHA2]}
+    assert manifest["refs"] == {
+        "refs/heads/main": {"sha": SHA2, "packs": 2, "protected": False},
+        "refs/heads/feature": {"sha": SHA2, "packs": 2, "protected": False},
+    }
+    session_client_mock.return_value.delete_object.assert_not_called()
+
+
+@patch("boto3.Session.client")
+def test_push_packs_keeps_protected_ref(session_client_mock, no_manifest):
+    manifest = create_pack_manifest()
+    manifest.set_protected("refs/heads/old", True)
+    no_manifest.return_value = manifest
+    s3_remote = S3Remote(UriScheme.S3_PACK, None, "test_bucket", "test_prefix")
+    res = s3_remote.push_batch(["push :refs/heads/old"])
+    assert res == ['error refs/heads/old "refs/heads/old is protected"?\n']
+    session_client_mock.return_value.put_object.assert_not_called()
+
+
+@patch("git_remote_s3.git.pack_object_count", return_value=3)
+@patch("git_remote_s3.git.pack_objects", side_effect=write_pack)
+@patch("git_remote_s3.git.missing_objects", return_value=[])
+@patch("git_remote_s3.git.is_ancestor", return_value=True)
+@patch("git_remote_s3.git.rev_parse", return_value=SHA2)
+@patch("boto3.Session.client")
+def test_push_packs_manifest_written_concurrently(
+    session_client_mock,
+    rev_parse_mock,
+    is_ancestor_mock,
+    missing_objects_mock,
+    pack_objects_mock,
+    pack_object_count_mock,
+    no_manifest,
+):
+    concurrent = create_pack_manifest()
+    # another client pushed a pack and a tag between the read and the write
+    concurrent.add_pack({"name": "pack-3", "size": 10, "tips": [SHA1]})
+    concurrent.set_pack_ref("refs/tags/v1", sha=SHA1, pack="pack-3")
+    manifests = [create_pack_manifest(), create_pack_manifest(), concurrent]
+    for i, manifest in enumerate(manifests):
+        manifest.etag = f'"{i}"'
+    no_manifest.side_effect = lambda *args: manifests.pop(0)
+    client = session_client_mock.return_value
+
+    def put_object(Key, **kwargs):
+        if kwargs.get("IfMatch") == '"1"':
+            raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+        return {"ETag": '"3"'}
+
+    client.put_object.side_effect = put_object
+    s3_remote = S3Remote(UriScheme.S3_PACK, None, "test_bucket", "test_prefix")
+    res = s3_remote.push_batch(["push refs/heads/main:refs/heads/main"])
+    assert res == ["ok refs/heads/main\n"]
+    manifest = json.loads(client.put_object.call_args_list[-1].kwargs["Body"])
+    assert [p["name"] for p in manifest["packs"]] == ["pack-1", "pack-3", "pack-2"]
+    assert manifest["refs"]["refs/heads/main"]["sha"] == SHA2
+    assert manifest["refs"]["refs/tags/v1"]["sha"] == SHA1
+
+
+def index_pack(path):
+    with open(path.replace(".pack", ".idx"), "wb") as f:
+        f.write(b"idx")
+    return path.split("/pack-")[-1].removesuffix(".pack")
+
+
+@patch("git_remote_s3.git.index_pack", side_effect=index_pack)
+@patch("git_remote_s3.git.pack_dir")
+@patch("git_remote_s3.git.missing_objects", return_value=[SHA2])
+@patch("boto3.Session.client")
+def test_fetch_packs(
+    session_client_mock,
+    missing_objects_mock,
+    pack_dir_mock,
+    index_pack_mock,
+    no_manifest,
+):
+    manifest = create_pack_manifest()
+    manifest.add_pack({"name": "pack-2", "size": 10, "tips": [SHA2]})
+    manifest.set_pack_ref("refs/heads/feature", sha=SHA2, pack="pack-2")
+    no_manifest.return_value = manifest
+    pack_dir_mock.return_value = tempfile.mkdtemp()
+    session_client_mock.return_value.get_object.side_effect = lambda Key, **_: {
+        "Body": BytesIO(Key.encode("utf8"))
+    }
+    s3_remote = S3Remote(UriScheme.S3_PACK, None, "test_bucket", "test_prefix")
+    s3_remote.fetch_batch([f"fetch {SHA2} refs/heads/feature"])
+
+    # The first pack is complete locally, its tip being present
+    missing_objects_mock.assert_called_once_with([SHA1, SHA2])
+    assert sorted(os.listdir(pack_dir_mock.return_value)) == [
+        "pack-2.idx",
+        "pack-2.pack",
+    ]
+    # The index is built from the downloaded pack, which checks it
+    session_client_mock.return_value.get_object.assert_called_once()
+    assert index_pack_mock.call_args.args[0].endswith("/pack-2.pack")
+    assert s3_remote.fetched_refs == [SHA2]
+
+
+@patch("boto3.Session.client")
+def test_layout_mismatch(session_client_mock, no_manifest):
+    no_manifest.return_value = create_pack_manifest()
+    s3_remote = S3Remote(UriScheme.S3, None, "test_bucket", "test_prefix")
+    with pytest.raises(LayoutMismatchError):
+        s3_remote.cmd_list()
+
+
+@patch("sys.stdout", new_callable=StringIO)
+@patch("boto3.Session.client")
+def test_pack_layout_without_manifest(session_client_mock, stdout_mock):
+    s3_remote = S3Remote(UriScheme.S3_PACK, None, "test_bucket", "test_prefix")
+    # An empty remote lists no refs
+    session_client_mock.return_value.list_objects_v2.side_effect = (
+        create_list_objects_v2_mock(shas=[], no_head=True)
+    )
+    s3_remote.cmd_list(for_push=True)
+    assert stdout_mock.getvalue() == "\n"
+
+    # The refs of a remote without manifest are bundles
+    s3_remote = S3Remote(UriScheme.S3_PACK, None, "test_bucket", "test_prefix")
+    session_client_mock.return_value.list_objects_v2.side_effect = (
+        create_list_objects_v2_mock(shas=[SHA1])
+    )
+    with pytest.raises(LayoutMismatchError) as e:
+        s3_remote.cmd_list()
+    assert e.value.layout == "bundle"
+    with pytest.raises(LayoutMismatchError):
+        s3_remote.fetch_packs({SHA1: f"refs/heads/{BRANCH}"})
+
+
+@patch("git_remote_s3.git.index_pack", return_value="3")
+@patch("git_remote_s3.git.pack_dir")
+@patch("git_remote_s3.git.missing_objects", return_value=[SHA1])
+@patch("boto3.Session.client")
+def test_fetch_packs_rejects_corrupted_pack(
+    session_client_mock,
+    missing_objects_mock,
+    pack_dir_mock,
+    index_pack_mock,
+    no_manifest,
+):
+    no_manifest.return_value = create_pack_manifest()
+    pack_dir_mock.return_value = tempfile.mkdtemp()
+    session_client_mock.return_value.get_object.side_effect = lambda Key, **_: {
+        "Body": BytesIO(Key.encode("utf8"))
+    }
+    s3_remote = S3Remote(UriScheme.S3_PACK, None, "test_bucket", "test_prefix")
+    with pytest.raises(GitError):
+        s3_remote.fetch_batch([f"fetch {SHA1} refs/heads/main"])
+    assert os.listdir(pack_dir_mock.return_value) == []
+    assert s3_remote.fetched_refs == []
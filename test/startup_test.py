@@ -0,0 +1,79 @@
+import json
+import os
+import subprocess
+import tempfile
+import sys
+import time
+
+# Runs the remote helper main loop for a session of commands that do not need S3
+# and reports which AWS modules it imported
+HELPER = """
+import sys
+sys.argv = ["git-remote-s3", "origin", "s3://test-bucket/test-prefix"]
+from git_remote_s3 import remote
+remote.main()
+print(",".join(m for m in ["boto3", "botocore.config", "s3transfer"] if m in sys.modules))
+"""
+
+# Generous upper bound, the helper starts in well under a second on a laptop
+MAX_STARTUP_SECONDS = 5
+
+
+def run_helper(stdin: str, **extra_env) -> subprocess.CompletedProcess:
+    env = dict(
+        os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__)), **extra_env
+    )
+    return subprocess.run(
+        [sys.executable, "-c", HELPER],
+        input=stdin.encode("utf8"),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env,
+    )
+
+
+def test_capabilities_and_option_without_aws_imports():
+    start = time.monotonic()
+    result = run_helper("capabilities\noption verbosity 1\n")
+    elapsed = time.monotonic() - start
+
+    assert result.returncode == 0, result.stderr
+    lines = result.stdout.decode("utf8").split("\n")
+    assert lines[:5] == ["*push", "*fetch", "option", "", "unsupported"]
+    # no AWS module has been imported to answer the commands
+    assert lines[5] == ""
+    assert elapsed < MAX_STARTUP_SECONDS
+
+
+def test_package_import_is_lazy():
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__)))
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, git_remote_s3.remote; print('boto3' in sys.modules)",
+        ],
+        stdout=subprocess.PIPE,
+        env=env,
+    )
+    assert result.stdout.decode("utf8").strip() == "False"
+
+
+def test_metrics_record_written_on_exit():
+    metrics_file = os.path.join(tempfile.mkdtemp("test_metrics"), "metrics.jsonl")
+    for _ in range(2):
+        result = run_helper(
+            "capabilities\noption verbosity 1\n",
+            GIT_REMOTE_S3_METRICS_FILE=metrics_file,
+        )
+        assert result.returncode == 0, result.stderr
+
+    # One record per invocation
+    with open(metrics_file) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 2
+    assert records[0]["process"] == "git-remote-s3"
+    assert set(records[0]["commands"]) == {"capabilities", "option"}
+    assert records[0]["commands"]["option"]["count"] == 1
+    assert records[0]["s3"] == {}
+    assert records[0]["bytes"] == {"uploaded": 0, "downloaded": 0}
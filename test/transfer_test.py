@@ -0,0 +1,160 @@
+import os
+import re
+import tempfile
+import pytest
+from io import BytesIO
+from mock import MagicMock, patch
+from botocore.exceptions import ClientError
+from git_remote_s3.transfer import MultipartUploader, RangedDownloader
+
+CONTENT = b"0123456789abcdefghij"
+
+
+def create_s3_mock():
+    s3 = MagicMock()
+    s3.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+    s3.upload_part.side_effect = lambda PartNumber, **kwargs: {
+        "ETag": f"etag-{PartNumber}"
+    }
+    return s3
+
+
+def test_upload_small_object_uses_put_object():
+    s3 = create_s3_mock()
+    uploader = MultipartUploader(s3, part_size=len(CONTENT) + 1)
+    uploader.upload(BytesIO(CONTENT), bucket="bucket", key="key", Metadata={"a": "b"})
+    s3.put_object.assert_called_once_with(
+        Bucket="bucket", Key="key", Body=CONTENT, Metadata={"a": "b"}
+    )
+    s3.create_multipart_upload.assert_not_called()
+
+
+@patch("git_remote_s3.transfer.MIN_PART_SIZE", 1)
+def test_upload_multipart():
+    s3 = create_s3_mock()
+    uploader = MultipartUploader(s3, part_size=8, concurrency=2)
+    uploader.upload(BytesIO(CONTENT), bucket="bucket", key="key", Metadata={"a": "b"})
+    s3.put_object.assert_not_called()
+    s3.create_multipart_upload.assert_called_once_with(
+        Bucket="bucket", Key="key", Metadata={"a": "b"}
+    )
+    bodies = {
+        c.kwargs["PartNumber"]: c.kwargs["Body"] for c in s3.upload_part.call_args_list
+    }
+    assert bodies == {1: CONTENT[:8], 2: CONTENT[8:16], 3: CONTENT[16:]}
+    s3.complete_multipart_upload.assert_called_once_with(
+        Bucket="bucket",
+        Key="key",
+        UploadId="upload-id",
+        MultipartUpload={
+            "Parts": [{"ETag": f"etag-{i}", "PartNumber": i} for i in [1, 2, 3]]
+        },
+    )
+    s3.abort_multipart_upload.assert_not_called()
+
+
+@patch("git_remote_s3.transfer.RETRY_DELAY", 0)
+@patch("git_remote_s3.transfer.MIN_PART_SIZE", 1)
+def test_upload_multipart_retries_failed_part():
+    s3 = create_s3_mock()
+    failures = []
+
+    def upload_part(PartNumber, **kwargs):
+        if PartNumber == 2 and not failures:
+            failures.append(PartNumber)
+            raise ClientError({"Error": {"Code": "InternalError"}}, "upload_part")
+        return {"ETag": f"etag-{PartNumber}"}
+
+    s3.upload_part.side_effect = upload_part
+    uploader = MultipartUploader(s3, part_size=8, concurrency=2)
+    uploader.upload(BytesIO(CONTENT), bucket="bucket", key="key")
+    assert s3.upload_part.call_count == 4
+    s3.complete_multipart_upload.assert_called_once()
+    s3.abort_multipart_upload.assert_not_called()
+
+
+@patch("git_remote_s3.transfer.RETRY_DELAY", 0)
+@patch("git_remote_s3.transfer.MIN_PART_SIZE", 1)
+def test_upload_multipart_aborts_on_failure():
+    s3 = create_s3_mock()
+    s3.upload_part.side_effect = ClientError(
+        {"Error": {"Code": "InternalError"}}, "upload_part"
+    )
+    uploader = MultipartUploader(s3, part_size=8, concurrency=1)
+    with pytest.raises(ClientError):
+        uploader.upload(BytesIO(CONTENT), bucket="bucket", key="key")
+    s3.complete_multipart_upload.assert_not_called()
+    s3.abort_multipart_upload.assert_called_once_with(
+        Bucket="bucket", Key="key", UploadId="upload-id"
+    )
+
+
+def create_ranged_s3_mock(failures=None):
+    s3 = MagicMock()
+
+    def get_object(Range=None, **kwargs):
+        if failures is not None and Range in failures:
+            failures.remove(Range)
+            raise ClientError({"Error": {"Code": "InternalError"}}, "get_object")
+        first, last = [int(x) for x in re.match(r"bytes=(\d+)-(\d+)", Range).groups()]
+        data = CONTENT[first : last + 1]
+        return {
+            "Body": BytesIO(data),
+            "ContentRange": f"bytes {first}-{first + len(data) - 1}/{len(CONTENT)}",
+            "ETag": '"etag"',
+            "Metadata": {"a": "b"},
+        }
+
+    s3.get_object.side_effect = get_object
+    return s3
+
+
+def test_download_small_object_single_get():
+    s3 = create_ranged_s3_mock()
+    path = os.path.join(tempfile.mkdtemp(), "object")
+    downloader = RangedDownloader(s3, part_size=len(CONTENT) + 1)
+    obj = downloader.download(bucket="bucket", key="key", path=path)
+    assert obj["Metadata"] == {"a": "b"}
+    s3.get_object.assert_called_once_with(
+        Bucket="bucket", Key="key", Range=f"bytes=0-{len(CONTENT)}"
+    )
+    with open(path, "rb") as f:
+        assert f.read() == CONTENT
+
+
+@patch("git_remote_s3.transfer.RETRY_DELAY", 0)
+def test_download_ranges_retries_failed_part():
+    failures = ["bytes=8-15"]
+    s3 = create_ranged_s3_mock(failures)
+    path = os.path.join(tempfile.mkdtemp(), "object")
+    downloader = RangedDownloader(s3, part_size=8, concurrency=2)
+    downloader.download(bucket="bucket", key="key", path=path)
+    with open(path, "rb") as f:
+        assert f.read() == CONTENT
+    ranges = [c.kwargs["Range"] for c in s3.get_object.call_args_list]
+    assert sorted(ranges) == ["bytes=0-7", "bytes=16-19", "bytes=8-15", "bytes=8-15"]
+    # The parts after the first are pinned to its version of the object
+    assert all(
+        c.kwargs["IfMatch"] == '"etag"' for c in s3.get_object.call_args_list[1:]
+    )
+
+
+@patch("git_remote_s3.transfer.RETRY_DELAY", 0)
+def test_download_ranges_object_changed():
+    s3 = create_ranged_s3_mock()
+    original = s3.get_object.side_effect
+
+    def get_object(**kwargs):
+        if "IfMatch" in kwargs:
+            raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "get_object")
+        return original(**kwargs)
+
+    s3.get_object.side_effect = get_object
+    downloader = RangedDownloader(s3, part_size=8, concurrency=1)
+    with pytest.raises(ClientError) as e:
+        downloader.download(
+            bucket="bucket", key="key", path=os.path.join(tempfile.mkdtemp(), "o")
+        )
+    assert e.value.response["Error"]["Code"] == "PreconditionFailed"
+    # Not retried, the object is gone
+    assert s3.get_object.call_count == 2